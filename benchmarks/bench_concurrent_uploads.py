@@ -0,0 +1,101 @@
+"""
+bench_concurrent_uploads.py
+Lanza el servidor P2P del cliente (client._listen_thread_function) y muchos
+descargadores simultáneos de un mismo fichero, uno de ellos lento. Mide el
+caudal agregado y el tiempo de la descarga rápida más lenta.
+
+Con --max-uploads 1 el servidor atiende a un cliente cada vez, como el bucle de
+aceptación anterior; con el valor por defecto las subidas se sirven en paralelo
+desde el pool.
+
+Uso: python3 benchmarks/bench_concurrent_uploads.py [--clients 32] [--size-mb 16]
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from client import client
+
+
+def download(port, path, results, index, slow=False):
+    start = time.perf_counter()
+    s = socket.create_connection(('127.0.0.1', port))
+    r = client.SocketReader(s)
+    client.send_string(s, "GET_FILE")
+    client.send_string(s, path)
+    received = 0
+    if r.read_byte() == 0:
+        size = int(r.read_string())
+        while received < size:
+            data = r.recv(min(1 << 16, size - received))
+            if not data:
+                break
+            received += len(data)
+            if slow:
+                time.sleep(0.01)  # Descargador con poco ancho de banda
+    s.close()
+    results[index] = (received, time.perf_counter() - start)
+
+
+def run(max_uploads, clients, path):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    client._listen_port = sock.getsockname()[1]
+    sock.close()
+
+    client._share(os.path.basename(path), path)
+    client._max_uploads = max_uploads
+    client._running = True
+    client._listen_thread = threading.Thread(target=client._listen_thread_function)
+    client._listen_thread.start()
+    time.sleep(0.2)
+
+    results = [None] * (clients + 1)
+    threads = [threading.Thread(target=download, args=(client._listen_port, path, results, 0, True))]
+    threads += [threading.Thread(target=download, args=(client._listen_port, path, results, i))
+                for i in range(1, clients + 1)]
+    start = time.perf_counter()
+    threads[0].start()
+    time.sleep(0.05)  # El descargador lento llega primero
+    for t in threads[1:]:
+        t.start()
+    for t in threads[1:]:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    client._stop_listen_thread()
+    threads[0].join()
+
+    fast = results[1:]
+    total = sum(received for received, _ in fast)
+    worst = max(t for _, t in fast)
+    print(f"max_uploads={max_uploads:3d} clientes={clients} MB/s_agregado={total / elapsed / 2**20:8.1f} "
+          f"peor_descarga_rapida_s={worst:6.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--size-mb', type=int, default=16)
+    parser.add_argument('--max-uploads', type=int, default=client._max_uploads)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(os.urandom(args.size_mb << 20))
+        path = f.name
+    try:
+        run(1, args.clients, path)
+        run(args.max_uploads, args.clients, path)
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
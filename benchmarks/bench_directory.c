@@ -0,0 +1,156 @@
+/*
+ * bench_directory.c
+ * Microbenchmark del directorio de usuarios y ficheros de server.c: mide la
+ * latencia media de cada operación mientras el directorio crece hasta un
+ * millón de usuarios y ficheros, y la memoria máxima del proceso. Con los
+ * índices hash la latencia debe mantenerse plana; con las búsquedas lineales
+ * crecía con el tamaño.
+ *
+ * Cada usuario publica un fichero y uno de ellos publica además varios, para
+ * medir LIST_CONTENT. SEARCH busca el nombre de un fichero al azar y un
+ * prefijo común a todos (con límite 10). Las respuestas se escriben en
+ * /dev/null.
+ *
+ * Uso: ./bench_directory [operaciones_por_medida]
+ */
+#define main p2p_server_main
+#include "../server.c"
+#undef main
+
+#include <fcntl.h>
+#include <time.h>
+#include <sys/resource.h>
+
+#define LIST_FILES 10
+
+static const int sizes[] = {1000, 10000, 100000, 1000000};
+#define NUM_SIZES (int)(sizeof(sizes) / sizeof(sizes[0]))
+
+static int null_fd;
+static FILE *out;       // Resultados (stdout queda redirigido a /dev/null)
+
+static double now_seconds(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+// Añade usuarios conectados hasta tener n, cada uno con un fichero
+static void grow_directory(int n) {
+    char name[MAX_STRING];
+    for (int i = user_count; i < n; i++) {
+        snprintf(name, sizeof(name), "user%d", i);
+        int idx = user_add(name);
+        const char *ip = intern("127.0.0.1");
+        user_set_connected(idx, true, ip, 10000 + i % 50000);
+        release(ip);
+        snprintf(name, sizeof(name), "file%d.dat", i);
+        file_add(idx, name, "descripcion");
+    }
+}
+
+// Imprime la latencia media en microsegundos de ops operaciones
+static void report(const char *op, double elapsed, int ops) {
+    fprintf(out, " %s=%.3f", op, elapsed * 1e6 / ops);
+}
+
+static void measure(int n, int ops) {
+    char user[MAX_STRING], other[MAX_STRING], file[MAX_STRING];
+    double t0;
+
+    // REGISTER y UNREGISTER de usuarios nuevos
+    t0 = now_seconds();
+    for (int i = 0; i < ops; i++) {
+        snprintf(user, sizeof(user), "nuevo%d", i);
+        handle_register(null_fd, user);
+    }
+    report("REGISTER", now_seconds() - t0, ops);
+    t0 = now_seconds();
+    for (int i = 0; i < ops; i++) {
+        snprintf(user, sizeof(user), "nuevo%d", i);
+        handle_unregister(null_fd, user);
+    }
+    report("UNREGISTER", now_seconds() - t0, ops);
+
+    // PUBLISH y DELETE de un segundo fichero de usuarios al azar
+    srand(n);
+    t0 = now_seconds();
+    for (int i = 0; i < ops; i++) {
+        snprintf(user, sizeof(user), "user%d", rand() % n);
+        snprintf(file, sizeof(file), "extra%d.dat", i);
+        handle_publish(null_fd, user, file, "descripcion");
+    }
+    report("PUBLISH", now_seconds() - t0, ops);
+    srand(n);
+    t0 = now_seconds();
+    for (int i = 0; i < ops; i++) {
+        snprintf(user, sizeof(user), "user%d", rand() % n);
+        snprintf(file, sizeof(file), "extra%d.dat", i);
+        handle_delete(null_fd, user, file);
+    }
+    report("DELETE", now_seconds() - t0, ops);
+
+    // LOOKUP_FILE de ficheros al azar
+    t0 = now_seconds();
+    for (int i = 0; i < ops; i++) {
+        int target = rand() % n;
+        snprintf(user, sizeof(user), "user%d", rand() % n);
+        snprintf(other, sizeof(other), "user%d", target);
+        snprintf(file, sizeof(file), "file%d.dat", target);
+        handle_lookup_file(null_fd, user, other, file);
+    }
+    report("LOOKUP_FILE", now_seconds() - t0, ops);
+
+    // LIST_CONTENT del usuario con LIST_FILES ficheros
+    t0 = now_seconds();
+    for (int i = 0; i < ops; i++) {
+        snprintf(user, sizeof(user), "user%d", rand() % n);
+        handle_list_content(null_fd, user, "user0");
+    }
+    report("LIST_CONTENT", now_seconds() - t0, ops);
+
+    // SEARCH del nombre completo de un fichero al azar y de una palabra que
+    // aparece en todas las descripciones (cortada por el límite)
+    t0 = now_seconds();
+    for (int i = 0; i < ops; i++) {
+        snprintf(user, sizeof(user), "user%d", rand() % n);
+        snprintf(file, sizeof(file), "file%d", rand() % n);
+        handle_search(null_fd, user, file, "10");
+    }
+    report("SEARCH", now_seconds() - t0, ops);
+    t0 = now_seconds();
+    for (int i = 0; i < ops; i++) {
+        snprintf(user, sizeof(user), "user%d", rand() % n);
+        handle_search(null_fd, user, "descrip", "10");
+    }
+    report("SEARCH_COMMON", now_seconds() - t0, ops);
+}
+
+int main(int argc, char *argv[]) {
+    int ops = (argc > 1) ? atoi(argv[1]) : 20000;
+    null_fd = open("/dev/null", O_WRONLY);
+
+    // handle_list_content escribe una traza por petición: se descarta
+    out = fdopen(dup(STDOUT_FILENO), "w");
+    setvbuf(out, NULL, _IOLBF, 0);
+    dup2(null_fd, STDOUT_FILENO);
+
+    grow_directory(1);
+    char file[MAX_STRING];
+    for (int i = 1; i < LIST_FILES; i++) {
+        snprintf(file, sizeof(file), "lista%d.dat", i);
+        file_add(find_user("user0"), file, "descripcion");
+    }
+
+    fprintf(out, "latencia media por operación (us), %d operaciones por medida\n", ops);
+    for (int s = 0; s < NUM_SIZES; s++) {
+        grow_directory(sizes[s]);
+        fprintf(out, "usuarios=%-7d ficheros=%-7d", user_count, file_count);
+        measure(sizes[s], ops);
+
+        struct rusage ru;
+        getrusage(RUSAGE_SELF, &ru);
+        fprintf(out, " rss_max=%.1fMiB\n", ru.ru_maxrss / 1024.0);
+    }
+    return 0;
+}
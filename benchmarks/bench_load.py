@@ -0,0 +1,448 @@
+"""
+bench_load.py
+Benchmark de carga del sistema completo. Arranca servidor_web.py, servidor_rpc y
+server en un directorio temporal y los somete a N clientes simulados que hablan
+el mismo protocolo que client.py. Cada cliente se registra, se conecta y publica
+un fichero, y después repite operaciones elegidas al azar según una mezcla
+configurable hasta que se acaba el tiempo:
+
+  register   REGISTER de un usuario nuevo
+  connect    DISCONNECT y CONNECT del propio usuario (se miden por separado)
+  publish    PUBLISH de un fichero nuevo
+  list       LIST_USERS o LIST_CONTENT de otro usuario, alternando
+  get_file   LOOKUP_FILE del fichero de otro usuario y descarga desde su cliente
+
+Por cada operación muestra las operaciones por segundo, la latencia p50/p95/p99
+y los códigos de error, y lo escribe todo en un fichero JSON (--output) para
+comparar una ejecución con otra. Las fechas de las peticiones se calculan como en
+client.py, sincronizando el reloj con servidor_web.py.
+
+Los clientes se reparten entre varios procesos (--procs) para no quedar
+limitados por el GIL. Cada proceso tiene un servidor P2P
+(client._listen_thread_function) que atiende los GET_FILE de todos sus usuarios.
+
+Necesita los ejecutables de make. Con --no-launch usa servidores ya en marcha.
+
+Uso: python3 benchmarks/bench_load.py [--clients 32] [--duration 10]
+         [--mix register=1,connect=1,publish=2,list=4,get_file=2]
+         [--server-args "-m epoll"] [--session] [--output bench_load.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from client import client
+
+OPERATIONS = ("register", "connect", "publish", "list", "get_file")
+DEFAULT_MIX = "register=1,connect=1,publish=2,list=4,get_file=2"
+WEB_URL = "http://localhost:8000"
+
+
+def parse_mix(text):
+    """'register=1,list=4' -> {'register': 1.0, 'list': 4.0}"""
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"operación desconocida: {name}")
+        mix[name] = float(weight) if weight else 1.0
+    if not any(w > 0 for w in mix.values()):
+        raise argparse.ArgumentTypeError("la mezcla no tiene ninguna operación")
+    return mix
+
+
+def percentile(values, p):
+    """Percentil por rango más cercano de una lista ordenada"""
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+class SimClient:
+    """Usuario simulado: ejecuta operaciones y guarda la latencia de cada una"""
+
+    def __init__(self, user, listen_port, payload, peers, session):
+        self.user = user
+        self.listen_port = listen_port
+        self.payload = payload
+        self.peers = [p for p in peers if p != user]
+        self.session = session
+        self.sock = None
+        self.reader = None
+        self.counter = 0
+        self.list_toggle = False
+        self.rng = random.Random()
+        self.latencies = {}
+        self.errors = {}
+
+    def _open(self):
+        if self.sock is not None:
+            return self.sock, self.reader
+        s = socket.create_connection((client._server, client._port))
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        r = client.SocketReader(s)
+        if self.session:
+            self.sock, self.reader = s, r
+        return s, r
+
+    def _close(self, s):
+        if s is not self.sock:
+            s.close()
+
+    def _drop_session(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = self.reader = None
+
+    def request(self, command, fields, read_body=None):
+        """Envía una petición y devuelve su código de respuesta"""
+        s, r = self._open()
+        try:
+            s.sendall(client._encode_request(command, fields))
+            code = r.read_byte()
+            if code is None:
+                raise ConnectionError(command)
+            if code == 0 and read_body is not None:
+                read_body(r)
+            return code
+        except Exception:
+            self._drop_session()
+            raise
+        finally:
+            self._close(s)
+
+    def record(self, name, start, code):
+        self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+        if code != 0:
+            key = str(code)
+            errors = self.errors.setdefault(name, {})
+            errors[key] = errors.get(key, 0) + 1
+
+    def timed(self, name, func):
+        start = time.perf_counter()
+        try:
+            code = func()
+        except Exception:
+            code = "exc"
+        self.record(name, start, code)
+        return code
+
+    def setup(self):
+        """Registro, conexión y publicación del fichero que descargan los demás"""
+        for command, fields in (("REGISTER", [self.user]),
+                                ("CONNECT", [self.user, str(self.listen_port)]),
+                                ("PUBLISH", [self.user, self.user + "-seed.dat", "semilla"])):
+            code = self.request(command, fields)
+            if code != 0:
+                raise RuntimeError(f"{command} {self.user}: código {code}")
+
+    def teardown(self):
+        try:
+            self.request("DISCONNECT", [self.user])
+        except Exception:
+            pass
+        self._drop_session()
+
+    # Operaciones de la mezcla
+
+    def op_register(self):
+        self.counter += 1
+        self.timed("register", lambda: self.request("REGISTER", [f"{self.user}-r{self.counter}"]))
+
+    def op_connect(self):
+        self.timed("disconnect", lambda: self.request("DISCONNECT", [self.user]))
+        self.timed("connect", lambda: self.request("CONNECT", [self.user, str(self.listen_port)]))
+
+    def op_publish(self):
+        self.counter += 1
+        self.timed("publish", lambda: self.request(
+            "PUBLISH", [self.user, f"{self.user}-f{self.counter}.dat", "fichero de prueba"]))
+
+    def op_list(self):
+        self.list_toggle = not self.list_toggle
+        if self.list_toggle:
+            def users(r):
+                for _ in range(int(r.read_string()) * 3):
+                    r.read_string()
+            self.timed("list_users", lambda: self.request("LIST_USERS", [self.user], users))
+        else:
+            def content(r):
+                for _ in range(int(r.read_string())):
+                    r.read_string()
+            peer = self.rng.choice(self.peers) if self.peers else self.user
+            self.timed("list_content", lambda: self.request("LIST_CONTENT", [self.user, peer], content))
+
+    def op_get_file(self):
+        def get_file():
+            owner = self.rng.choice(self.peers) if self.peers else self.user
+            address = []
+
+            def lookup(r):
+                address.extend([r.read_string(), int(r.read_string()), r.read_string()])
+                for _ in range(int(r.read_string()) * 4):
+                    r.read_string()
+
+            code = self.request("LOOKUP_FILE", [self.user, owner, owner + "-seed.dat"], lookup)
+            if code != 0:
+                return code
+            # Descarga completa del fichero desde el cliente del dueño
+            with socket.create_connection((address[0], address[1])) as s:
+                r = client.SocketReader(s)
+                s.sendall(client._encode_fields(["GET_FILE", self.payload]))
+                code = r.read_byte()
+                if code != 0:
+                    return "peer" if code is None else code
+                size = int(r.read_string())
+                received = 0
+                while received < size:
+                    data = r.recv(min(1 << 16, size - received))
+                    if not data:
+                        return "peer"
+                    received += len(data)
+            return 0
+        self.timed("get_file", get_file)
+
+
+def worker(index, users, all_users, args, payload, barrier, results):
+    """Proceso de clientes: un servidor P2P y un hilo por usuario simulado"""
+    client._server = args.host
+    client._port = args.port
+    client._web_url = args.web_url
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    client._listen_port = sock.getsockname()[1]
+    sock.close()
+    client._share(os.path.basename(payload), payload)
+    client._max_uploads = max(client._max_uploads, len(users))
+    client._running = True
+    client._listen_thread = threading.Thread(target=client._listen_thread_function, daemon=True)
+    client._listen_thread.start()
+
+    sims = [SimClient(user, client._listen_port, payload, all_users, args.session) for user in users]
+    names = [name for name, weight in args.mix.items() if weight > 0]
+    weights = [args.mix[name] for name in names]
+
+    error = None
+    try:
+        for sim in sims:
+            sim.setup()
+    except Exception as e:
+        error = str(e)
+    barrier.wait()  # Todos los usuarios existen y están conectados
+    deadline = time.monotonic() + args.duration
+
+    def run(sim, seed):
+        sim.rng.seed(seed)
+        while time.monotonic() < deadline:
+            getattr(sim, "op_" + sim.rng.choices(names, weights)[0])()
+
+    threads = []
+    if error is None:
+        threads = [threading.Thread(target=run, args=(sim, args.seed * 7919 + i))
+                   for i, sim in enumerate(sims)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    barrier.wait()  # Nadie se desconecta mientras otros siguen descargando
+
+    for sim in sims:
+        sim.teardown()
+    client._stop_listen_thread()
+
+    latencies, errors = {}, {}
+    for sim in sims:
+        for name, values in sim.latencies.items():
+            latencies.setdefault(name, []).extend(values)
+        for name, codes in sim.errors.items():
+            merged = errors.setdefault(name, {})
+            for code, n in codes.items():
+                merged[code] = merged.get(code, 0) + n
+    results.put((index, error, latencies, errors))
+
+
+def summarize(latencies, errors, elapsed):
+    operations = {}
+    for name in sorted(latencies):
+        values = sorted(latencies[name])
+        codes = errors.get(name, {})
+        operations[name] = {
+            "count": len(values),
+            "errors": sum(codes.values()),
+            "error_codes": codes,
+            "ops_per_s": len(values) / elapsed,
+            "mean_ms": sum(values) / len(values) * 1000,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "max_ms": values[-1] * 1000,
+        }
+    total = sum(op["count"] for op in operations.values())
+    return operations, {"count": total, "errors": sum(op["errors"] for op in operations.values()),
+                        "ops_per_s": total / elapsed}
+
+
+def wait_for(check, what, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f"{what} no responde")
+
+
+def start_services(args, workdir):
+    """Arranca servidor_web.py, servidor_rpc y server con workdir como directorio
+    de trabajo (ahí quedan logs.txt y el registro estructurado)"""
+    for exe in ("server", "servidor_rpc"):
+        if not os.path.exists(os.path.join(ROOT, exe)):
+            raise RuntimeError(f"falta ./{exe}, compila con make")
+
+    def spawn(cmd, log):
+        return subprocess.Popen(cmd, cwd=workdir, stdout=open(os.path.join(workdir, log), "wb"),
+                                stderr=subprocess.STDOUT)
+
+    procs = [spawn([sys.executable, os.path.join(ROOT, "servidor_web.py")], "web.log")]
+    wait_for(lambda: urllib.request.urlopen(args.web_url + "/sync", timeout=1).status == 200,
+             "servidor_web.py")
+    procs.append(spawn([os.path.join(ROOT, "servidor_rpc")], "rpc.log"))
+    time.sleep(0.5)  # Registro en rpcbind
+    procs.append(spawn([os.path.join(ROOT, "server"), "-p", str(args.port)] + shlex.split(args.server_args),
+                       "server.log"))
+    wait_for(lambda: socket.create_connection((args.host, args.port), timeout=1).close() is None, "server")
+    for p in procs:
+        if p.poll() is not None:  # Otro proceso tenía ya el puerto
+            stop_services(procs)
+            raise RuntimeError(f"{p.args[-1]} terminó al arrancar, ver {workdir}")
+    return procs
+
+
+def stop_services(procs):
+    # SIGTERM: servidor_rpc vuelca a logs.txt lo que tenga pendiente
+    for p in reversed(procs):
+        if p.poll() is None:
+            p.send_signal(signal.SIGTERM)
+    for p in procs:
+        try:
+            p.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--procs', type=int, default=min(os.cpu_count() or 1, 8))
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument('--file-kb', type=int, default=64, help="tamaño del fichero de get_file")
+    parser.add_argument('--session', action='store_true', help="una conexión persistente por cliente")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7400)
+    parser.add_argument('--web-url', default=WEB_URL)
+    parser.add_argument('--server-args', default="", help="opciones extra de server, p. ej. \"-m epoll\"")
+    parser.add_argument('--no-launch', action='store_true', help="usar servidores ya en marcha")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default="bench_load.json")
+    args = parser.parse_args()
+    args.procs = max(1, min(args.procs, args.clients))
+
+    workdir = tempfile.mkdtemp(prefix="bench_load_")
+    procs = []
+    try:
+        if not args.no_launch:
+            procs = start_services(args, workdir)
+        payload = os.path.join(workdir, "payload.dat")
+        with open(payload, "wb") as f:
+            f.write(os.urandom(args.file_kb << 10))
+
+        # Nombres únicos por ejecución, para poder repetir contra el mismo servidor
+        prefix = f"b{os.getpid()}x{int(time.time()) % 100000}"
+        all_users = [f"{prefix}u{i}" for i in range(args.clients)]
+        ctx = multiprocessing.get_context("fork")
+        barrier = ctx.Barrier(args.procs + 1)
+        results = ctx.Queue()
+        workers = [ctx.Process(target=worker, args=(p, all_users[p::args.procs], all_users, args,
+                                                     payload, barrier, results))
+                   for p in range(args.procs)]
+        for w in workers:
+            w.start()
+        barrier.wait()
+        start = time.perf_counter()
+        barrier.wait()
+        elapsed = time.perf_counter() - start
+
+        latencies, errors = {}, {}
+        for _ in workers:
+            index, error, lat, err = results.get()
+            if error is not None:
+                raise RuntimeError(f"proceso {index}: {error}")
+            for name, values in lat.items():
+                latencies.setdefault(name, []).extend(values)
+            for name, codes in err.items():
+                merged = errors.setdefault(name, {})
+                for code, n in codes.items():
+                    merged[code] = merged.get(code, 0) + n
+        for w in workers:
+            w.join()
+    finally:
+        stop_services(procs)
+
+    operations, total = summarize(latencies, errors, elapsed)
+    log_path = os.path.join(workdir, "logs.txt")
+    if os.path.exists(log_path):
+        with open(log_path, "rb") as f:
+            total["rpc_log_entries"] = sum(1 for _ in f)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"clientes={args.clients} procesos={args.procs} duración_s={elapsed:.1f} "
+          f"sesión={'sí' if args.session else 'no'} server_args={args.server_args!r}")
+    print(f"{'operación':<14}{'ops':>8}{'ops/s':>10}{'p50_ms':>9}{'p95_ms':>9}{'p99_ms':>9}  errores")
+    for name, op in operations.items():
+        codes = " ".join(f"{c}:{n}" for c, n in sorted(op["error_codes"].items())) or "-"
+        print(f"{name:<14}{op['count']:>8}{op['ops_per_s']:>10.1f}{op['p50_ms']:>9.2f}"
+              f"{op['p95_ms']:>9.2f}{op['p99_ms']:>9.2f}  {codes}")
+    print(f"{'total':<14}{total['count']:>8}{total['ops_per_s']:>10.1f}")
+    if "rpc_log_entries" in total:
+        print(f"entradas en logs.txt: {total['rpc_log_entries']}")
+
+    config = {k: v for k, v in vars(args).items() if k != "output"}
+    with open(args.output, "w") as f:
+        json.dump({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "git_commit": git_commit(),
+                   "config": config, "elapsed_s": elapsed, "operations": operations, "total": total},
+                  f, indent=2)
+    print(f"resultados en {args.output}")
+
+
+if __name__ == "__main__":
+    main()
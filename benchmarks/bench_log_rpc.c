@@ -0,0 +1,85 @@
+/*
+ * bench_log_rpc.c
+ * Benchmark del registro RPC contra un servidor_rpc en marcha: compara una
+ * llamada log_operation (versión 1) por entrada con lotes de log_operations
+ * (versión 2) de distintos tamaños. Mide las entradas por segundo que acepta
+ * el servidor con un único cliente persistente, como el del proxy.
+ *
+ * El tiempo de volcado a logs.txt depende de LOG_FLUSH_BYTES, LOG_FLUSH_MS y
+ * LOG_FSYNC en el entorno de servidor_rpc.
+ *
+ * Uso: ./bench_log_rpc [num_entradas]
+ */
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+#include "claves_rpc.h"
+
+static const int batch_sizes[] = {16, 256};
+#define NUM_BATCH_SIZES (int)(sizeof(batch_sizes) / sizeof(batch_sizes[0]))
+#define MAX_BATCH 256
+
+static double now_seconds(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static CLIENT *connect_version(unsigned long version) {
+    CLIENT *clnt = clnt_create("localhost", CLAVESRPC_PROG, version, "tcp");
+    if (clnt == NULL) {
+        clnt_pcreateerror("localhost");
+    }
+    return clnt;
+}
+
+int main(int argc, char *argv[]) {
+    int total = (argc > 1) ? atoi(argv[1]) : 20000;
+    struct log_entry entries[MAX_BATCH];
+    for (int i = 0; i < MAX_BATCH; i++) {
+        entries[i].usuario = "bench";
+        entries[i].operacion = "PUBLISH";
+        entries[i].param1 = "fichero.dat";
+        entries[i].fecha = "01/01/2025 00:00:00";
+    }
+
+    printf("entradas por medida: %d\n", total);
+
+    // Versión 1: una llamada por entrada
+    CLIENT *clnt = connect_version(CLAVESRPC_VERS);
+    if (clnt == NULL) {
+        return 1;
+    }
+    double t0 = now_seconds();
+    for (int i = 0; i < total; i++) {
+        if (log_operation_1(&entries[0], clnt) == NULL) {
+            clnt_perror(clnt, "log_operation_1");
+            return 1;
+        }
+    }
+    double elapsed = now_seconds() - t0;
+    printf("v1 una entrada por llamada: %9.0f entradas/s\n", total / elapsed);
+    clnt_destroy(clnt);
+
+    // Versión 2: lotes
+    clnt = connect_version(CLAVESRPC_VERS_BATCH);
+    if (clnt == NULL) {
+        return 1;
+    }
+    for (int b = 0; b < NUM_BATCH_SIZES; b++) {
+        log_batch batch;
+        batch.log_batch_val = entries;
+        t0 = now_seconds();
+        for (int sent = 0; sent < total; sent += batch.log_batch_len) {
+            batch.log_batch_len = (total - sent < batch_sizes[b]) ? total - sent : batch_sizes[b];
+            if (log_operations_2(&batch, clnt) == NULL) {
+                clnt_perror(clnt, "log_operations_2");
+                return 1;
+            }
+        }
+        elapsed = now_seconds() - t0;
+        printf("v2 lotes de %-3d entradas:   %9.0f entradas/s\n", batch_sizes[b], total / elapsed);
+    }
+    clnt_destroy(clnt);
+    return 0;
+}
@@ -0,0 +1,139 @@
+/*
+ * bench_readline.c
+ * Microbenchmark del parseo de peticiones en server.c: compara el readLine
+ * original (un read() por byte) con el readLine sobre el buffer de la conexión.
+ *
+ * Mide, para una secuencia de peticiones PUBLISH enviadas por un socketpair,
+ * el número de llamadas a read() por petición y las peticiones por segundo.
+ * Las llamadas se cuentan con -Wl,--wrap=read (ver objetivo bench del makefile).
+ *
+ * Uso: ./bench_readline [num_peticiones]
+ */
+#define main p2p_server_main
+#include "../server.c"
+#undef main
+
+#include <time.h>
+
+ssize_t __real_read(int fd, void *buf, size_t count);
+
+static unsigned long read_calls = 0;
+
+// Cuenta cada read() que hacen los dos parsers
+ssize_t __wrap_read(int fd, void *buf, size_t count) {
+    read_calls++;
+    return __real_read(fd, buf, count);
+}
+
+// readLine original: una llamada a read() por cada byte
+static ssize_t legacy_readLine(int fd, void *buffer, size_t n) {
+    ssize_t numRead;
+    size_t totRead;
+    char *buf;
+    char ch;
+
+    buf = buffer;
+    totRead = 0;
+
+    for (;;) {
+        numRead = read(fd, &ch, 1);
+
+        if (numRead == -1) {
+            if (errno == EINTR)
+                continue;
+            else
+                return -1;
+        } else if (numRead == 0) {
+            if (totRead == 0)
+                return 0;
+            else
+                break;
+        } else {
+            if (ch == '\n' || ch == '\0')
+                break;
+            if (totRead < n - 1) {
+                totRead++;
+                *buf++ = ch;
+            }
+        }
+    }
+
+    *buf = '\0';
+    return totRead;
+}
+
+#define FIELDS_PER_REQUEST 5
+
+static const char request[] =
+    "PUBLISH\0" "18/10/2026 12:00:00\0" "usuario_de_prueba\0"
+    "fichero_de_ejemplo.dat\0" "descripcion del fichero publicado\0";
+
+typedef struct {
+    int fd;
+    int count;
+} WriterArgs;
+
+static void *writer_thread(void *arg) {
+    WriterArgs *args = arg;
+    for (int i = 0; i < args->count; i++) {
+        size_t off = 0;
+        while (off < sizeof(request) - 1) {
+            ssize_t w = write(args->fd, request + off, sizeof(request) - 1 - off);
+            if (w <= 0) return NULL;
+            off += w;
+        }
+    }
+    shutdown(args->fd, SHUT_WR);
+    return NULL;
+}
+
+static double now_seconds(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+static void run(const char *name, int count, int buffered) {
+    int sv[2];
+    if (socketpair(AF_UNIX, SOCK_STREAM, 0, sv) < 0) {
+        perror("socketpair");
+        exit(1);
+    }
+
+    WriterArgs args = { sv[1], count };
+    pthread_t writer;
+    pthread_create(&writer, NULL, writer_thread, &args);
+
+    Connection conn;
+    conn_init(&conn, sv[0]);
+    char field[MAX_STRING];
+    int parsed = 0;
+
+    read_calls = 0;
+    double t0 = now_seconds();
+    for (;;) {
+        ssize_t r = 0;
+        for (int f = 0; f < FIELDS_PER_REQUEST; f++) {
+            r = buffered ? readLine(&conn, field, MAX_STRING)
+                         : legacy_readLine(sv[0], field, MAX_STRING);
+            if (r <= 0) break;
+        }
+        if (r <= 0) break;
+        parsed++;
+    }
+    double elapsed = now_seconds() - t0;
+
+    pthread_join(writer, NULL);
+    close(sv[0]);
+    close(sv[1]);
+
+    printf("%-10s peticiones=%d read()/peticion=%.2f peticiones/s=%.0f\n",
+           name, parsed, (double)read_calls / parsed, parsed / elapsed);
+}
+
+int main(int argc, char *argv[]) {
+    int count = (argc > 1) ? atoi(argv[1]) : 200000;
+    run("legacy", count, 0);
+    run("buffered", count, 1);
+    return 0;
+}
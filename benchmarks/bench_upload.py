@@ -0,0 +1,133 @@
+"""
+bench_upload.py
+Compara el envío de ficheros del servidor P2P del cliente: la versión anterior
+(conn.sendall(f.read()), que carga el fichero entero en memoria) frente a la
+actual (socket.sendfile, copia en el kernel o bloques acotados).
+
+Cada variante se ejecuta en un proceso hijo que sirve GET_FILE en localhost; el
+proceso padre descarga el fichero varias veces, mide el caudal y al final pide
+al hijo su pico de memoria residente (ru_maxrss).
+
+Uso: python3 benchmarks/bench_upload.py [--size-mb 512] [--rounds 3]
+"""
+import argparse
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def legacy_listener(listen_socket):
+    """Bucle de aceptación original: lee el fichero completo antes de enviarlo"""
+    from client import client
+    while True:
+        conn, addr = listen_socket.accept()
+        r = client.SocketReader(conn)
+        if r.read_string() == "GET_FILE":
+            filename = r.read_string()
+            conn.sendall(bytes([0]))
+            client.send_string(conn, str(os.path.getsize(filename)))
+            with open(filename, 'rb') as f:
+                conn.sendall(f.read())
+        conn.close()
+
+
+def child(mode, path):
+    """Proceso servidor: sirve GET_FILE hasta recibir una línea por stdin"""
+    from client import client
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+
+    if mode == "legacy":
+        s.listen(5)
+        target = lambda: legacy_listener(s)
+    else:
+        s.close()
+        client._share(os.path.basename(path), path)
+        client._listen_port = port
+        client._running = True
+        target = client._listen_thread_function
+    threading.Thread(target=target, daemon=True).start()
+
+    print(port, flush=True)
+    sys.stdin.readline()
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, flush=True)
+
+
+def download(port, path):
+    from client import client
+    s = socket.create_connection(('127.0.0.1', port))
+    r = client.SocketReader(s)
+    client.send_string(s, "GET_FILE")
+    client.send_string(s, path)
+    if r.read_byte() != 0:
+        raise RuntimeError("GET_FILE rechazado")
+    size = int(r.read_string())
+    received = 0
+    while received < size:
+        data = r.recv(min(1 << 20, size - received))
+        if not data:
+            break
+        received += len(data)
+    s.close()
+    if received != size:
+        raise RuntimeError("descarga incompleta")
+    return size
+
+
+def run(mode, path, rounds):
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", mode, "--path", path],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    port = int(proc.stdout.readline())
+    # El servidor P2P del cliente puede tardar un instante en llamar a listen()
+    time.sleep(0.2)
+
+    total = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        total += download(port, path)
+    elapsed = time.perf_counter() - start
+
+    proc.stdin.write("\n")
+    proc.stdin.flush()
+    max_rss_kb = int(proc.stdout.readline())
+    proc.kill()
+    proc.wait()
+    print(f"{mode:8s} MB/s={total / elapsed / 2**20:8.1f} pico_RSS_MB={max_rss_kb / 1024:8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--child', choices=["legacy", "sendfile"])
+    parser.add_argument('--path', help="fichero que sirve el proceso hijo")
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.path)
+        return
+
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        block = os.urandom(1 << 20)
+        for _ in range(args.size_mb):
+            f.write(block)
+        path = f.name
+    try:
+        print(f"fichero de {args.size_mb} MB, {args.rounds} descargas por variante")
+        run("legacy", path, args.rounds)
+        run("sendfile", path, args.rounds)
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,8 +10,14 @@ struct log_entry {
     string fecha<256>;
 };
 
+/* Varias entradas en una sola llamada */
+typedef log_entry log_batch<>;
+
 program CLAVESRPC_PROG {
     version CLAVESRPC_VERS {
         int log_operation(log_entry) = 1;
     } = 1;
+    version CLAVESRPC_VERS_BATCH {
+        int log_operations(log_batch) = 1;
+    } = 2;
 } = 0x31234567;
@@ -1,11 +1,16 @@
 from enum import Enum
 import argparse
+import json
+import hashlib
 import socket
+import select
 import threading
 import os
 import sys
 import time
-import requests 
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 class client:
 
@@ -17,6 +22,69 @@ class client:
         ERROR = 1
         USER_ERROR = 2
 
+    # *
+    # * @brief Buffered reader for the NULL-terminated protocol fields
+    class SocketReader:
+        """Lee del socket en bloques grandes y separa los campos terminados en NULL
+        desde su propio buffer, guardando los bytes sobrantes para el siguiente campo"""
+
+        CHUNK_SIZE = 65536
+
+        def __init__(self, sock):
+            self._sock = sock
+            self._buffer = bytearray()
+            self._pos = 0  # Inicio de los bytes aún no consumidos
+
+        def _fill(self):
+            """Recibe un nuevo bloque del socket. Devuelve False si la conexión se cerró"""
+            data = self._sock.recv(self.CHUNK_SIZE)
+            if not data:
+                return False
+            if self._pos:
+                # Descartar lo ya consumido antes de crecer el buffer
+                del self._buffer[:self._pos]
+                self._pos = 0
+            self._buffer += data
+            return True
+
+        def read_string(self):
+            """Lee una cadena terminada en NULL. Devuelve None si hay error de conexión"""
+            searched = self._pos
+            while True:
+                end = self._buffer.find(b'\0', searched)
+                if end != -1:
+                    break
+                searched = len(self._buffer) - self._pos
+                if not self._fill():
+                    return None  # Error de conexión
+                searched += self._pos
+            field = bytes(self._buffer[self._pos:end])
+            self._pos = end + 1
+            try:
+                return field.decode('utf-8')
+            except UnicodeDecodeError:
+                return None
+
+        def read_byte(self):
+            """Lee un único byte (código de respuesta). Devuelve None si hay error de conexión"""
+            if self._pos >= len(self._buffer) and not self._fill():
+                return None
+            value = self._buffer[self._pos]
+            self._pos += 1
+            return value
+
+        def pending(self):
+            """Indica si quedan en el buffer bytes recibidos y no consumidos"""
+            return self._pos < len(self._buffer)
+
+        def recv(self, size):
+            """Devuelve hasta size bytes, primero los del buffer y si no hay, del socket"""
+            if self._pos < len(self._buffer):
+                data = bytes(self._buffer[self._pos:self._pos + size])
+                self._pos += len(data)
+                return data
+            return self._sock.recv(size)
+
     # ****************** ATTRIBUTES ******************
     _server = None
     _port = -1
@@ -25,6 +93,37 @@ class client:
     _listen_thread = None
     _connected_user = None
     _running = False
+    LISTEN_BACKLOG = 128
+    _max_uploads = 8          # Subidas simultáneas a otros clientes
+    _upload_timeout = 30.0    # Segundos sin actividad antes de cortar una subida
+    _upload_pool = None
+    _upload_slots = None
+    _upload_conns = set()
+    _upload_lock = threading.Lock()
+    _chunk_size = 4 * 1024 * 1024   # Tamaño de los rangos en las descargas
+    _download_connections = 8       # Conexiones simultáneas por descarga
+    CHUNK_RETRIES = 3               # Bloques corruptos de un mismo cliente antes de descartarlo
+    _published = {}                 # Nombre publicado -> ruta local
+    _published_paths = {}           # Ruta local -> nombre publicado
+    _manifests = {}                 # Ruta local -> manifiesto (hash de cada bloque y raíz)
+    _hash_pool = None
+    _web_url = "http://localhost:8000"
+    CLOCK_SYNC_INTERVAL = 60.0      # Segundos entre sincronizaciones con el servicio web
+    CLOCK_SYNC_TIMEOUT = 2.0
+    _http_session = None
+    _clock_base = None              # Hora del servicio web (epoch) en la última sincronización
+    _clock_mono = None              # time.monotonic() en ese mismo instante
+    _clock_lock = threading.Lock()
+    _clock_sync_lock = threading.Lock()  # Lo tiene el hilo que sincroniza en segundo plano
+    _session_enabled = False  # Modo sesión: una conexión persistente tras CONNECT
+    _session = None
+    _session_reader = None
+    LIST_PAGE_SIZE = 1000     # Entradas por página al pedir un listado completo
+    _users_mirror = None      # Copia local de LIST_USERS: {"version", "entries": {usuario: (ip, puerto)}}
+    _content_mirrors = {}     # Usuario remoto -> copia local de su LIST_CONTENT
+    _subscription = None      # Conexión de SUBSCRIBE
+    _watch = None             # Vista de SUBSCRIBE: {"version", "users": {usuario: (ip, puerto)}, "files": {dueño: {fichero: None}}}
+    _watch_lock = threading.Lock()
 
     # ******************** METHODS *******************
 
@@ -40,757 +139,1478 @@ class client:
             return False
 
     @staticmethod
-    def read_string(sock):
-        """Lee una cadena terminada en NULL del socket"""
-        a = bytearray()
-        while True:
-            msg = sock.recv(1)
-            if not msg:
-                return None  # Error de conexión
-            if msg == b'\0':
-                break
-            a += msg
+    def _sync_clock():
+        """Sincroniza el reloj con el servicio web: guarda la hora del servicio junto
+        con el instante del reloj monotónico local en que se obtuvo"""
+        if client._http_session is None:
+            import requests  # Solo se necesita al sincronizar, no al arrancar
+            client._http_session = requests.Session()  # Reutiliza la conexión HTTP
+
+        start = time.monotonic()
+        response = client._http_session.get(client._web_url + "/sync", timeout=client.CLOCK_SYNC_TIMEOUT)
+        end = time.monotonic()
+        response.raise_for_status()
+
+        # La hora del servicio corresponde aproximadamente a la mitad del viaje
+        with client._clock_lock:
+            client._clock_base = float(response.text)
+            client._clock_mono = (start + end) / 2
+
+    @staticmethod
+    def _sync_clock_background():
         try:
-            return a.decode('utf-8')
-        except UnicodeDecodeError:
-            return None
+            client._sync_clock()
+        except Exception:
+            pass  # Se sigue usando la sincronización anterior
+        finally:
+            client._clock_sync_lock.release()
 
     @staticmethod
     def get_current_datetime():
-        try:
-            response = requests.get("http://localhost:8000/fecha")
-            if response.status_code == 200:
-                return response.text.strip()
-            else:
+        """Fecha y hora del servicio web, calculada localmente a partir de la última
+        sincronización. Solo la primera llamada espera al servicio; después se
+        vuelve a sincronizar en segundo plano cada CLOCK_SYNC_INTERVAL segundos"""
+        if client._clock_mono is None:
+            try:
+                client._sync_clock()
+            except Exception:
+                print("ERROR AL OBTENER FECHA DEL SERVICIO WEB")
                 return None
-        except Exception as e:
-            print("ERROR AL OBTENER FECHA DEL SERVICIO WEB")
-            return None
+        elif (time.monotonic() - client._clock_mono > client.CLOCK_SYNC_INTERVAL
+              and client._clock_sync_lock.acquire(blocking=False)):
+            # Solo un hilo lanza la sincronización; el cerrojo lo suelta ese hilo al terminar
+            threading.Thread(target=client._sync_clock_background, daemon=True).start()
+
+        with client._clock_lock:
+            now = client._clock_base + (time.monotonic() - client._clock_mono)
+        return time.strftime("%d/%m/%Y %H:%M:%S", time.localtime(now))
+
+    #Manifiesto de integridad: hash SHA-256 de cada bloque y raíz Merkle.
+    @staticmethod
+    def merkle_root(leaves):
+        """Raíz del árbol de Merkle construido sobre los hashes (hex) de los bloques"""
+        level = [bytes.fromhex(leaf) for leaf in leaves]
+        if not level:
+            return hashlib.sha256(b"").hexdigest()
+        while len(level) > 1:
+            level = [hashlib.sha256(level[i] + level[i + 1]).digest() if i + 1 < len(level) else level[i]
+                     for i in range(0, len(level), 2)]
+        return level[0].hex()
+
+    @staticmethod
+    def compute_manifest(path):
+        """Calcula el manifiesto de un archivo leyéndolo bloque a bloque"""
+        st = os.stat(path)
+        leaves = []
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(client._chunk_size)
+                if not block:
+                    break
+                leaves.append(hashlib.sha256(block).hexdigest())
+        return {"size": st.st_size, "mtime": st.st_mtime_ns, "chunk_size": client._chunk_size,
+                "leaves": leaves, "root": client.merkle_root(leaves)}
+
+    @staticmethod
+    def _hash_published(path, name, user):
+        """Calcula el manifiesto de un archivo publicado y registra su raíz en el
+        servidor con SET_HASH. Se ejecuta en el worker de hashing, no en la shell"""
+        s = r = None
+        try:
+            manifest = client.compute_manifest(path)
+            client._manifests[path] = manifest
+
+            # Conexión propia: la de sesión pertenece a la shell
+            s, r = client._open_server(use_session=False)
+            request = client._encode_request("SET_HASH", [user, name, manifest["root"]])
+            if request is None:
+                raise OSError("sin fecha")
+            s.sendall(request)
+            if r.read_byte() != 0:
+                raise OSError("SET_HASH rechazado")
+        except Exception:
+            print(f"SET_HASH FAIL {name}")
+        finally:
+            if s is not None:
+                s.close()
+
+    SET_HASH_BATCH = 256
+
+    @staticmethod
+    def _hash_published_many(items, user):
+        """Como _hash_published para los ficheros de un PUBLISH_DIR: calcula los
+        manifiestos y envía los SET_HASH encadenados por una sola conexión"""
+        s = r = None
+        try:
+            s, r = client._open_server(use_session=False)
+            for start in range(0, len(items), client.SET_HASH_BATCH):
+                pending = []
+                names = []
+                for path, name in items[start:start + client.SET_HASH_BATCH]:
+                    try:
+                        manifest = client.compute_manifest(path)
+                    except OSError:
+                        print(f"SET_HASH FAIL {name}")
+                        continue
+                    client._manifests[path] = manifest
+                    request = client._encode_request("SET_HASH", [user, name, manifest["root"]])
+                    if request is None:
+                        raise OSError("sin fecha")
+                    pending.append(request)
+                    names.append(name)
+                s.sendall(b"".join(pending))
+                for name in names:
+                    if r.read_byte() != 0:
+                        print(f"SET_HASH FAIL {name}")
+        except Exception:
+            print("SET_HASH FAIL")
+        finally:
+            if s is not None:
+                s.close()
 
-    
     #Para transferencia de archivos entre clientes (P2P).
     @staticmethod
-    def _listen_thread_function():
+    def _serve_peer(conn):
+        """Atiende las peticiones de otro cliente. Se ejecuta en el pool de subidas"""
         try:
-            client._listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client._listen_socket.bind(('0.0.0.0', client._listen_port))
-            client._listen_socket.listen(5)
-            
-            while client._running:
-                conn, addr = client._listen_socket.accept()
-                
+            conn.settimeout(client._upload_timeout)
+
+            # Atender peticiones hasta que el otro cliente cierre la conexión
+            r = client.SocketReader(conn)
+            while True:
                 # Leer operación
-                command = client.read_string(conn)
+                command = r.read_string()
                 if command is None:
-                    conn.close()
-                    continue
-                
+                    return
+
                 if command == "GET_FILE":
                     # Leer nombre de archivo
-                    filename = client.read_string(conn)
+                    filename = r.read_string()
                     if filename is None:
-                        conn.close()
-                        continue
-                    
-                    # Verificar si el archivo existe
-                    if os.path.exists(filename):
+                        return
+
+                    # Verificar que el archivo está publicado y existe
+                    path = client._resolve_shared(filename)
+                    if path is not None:
                         conn.sendall(bytes([0]))  # Código de éxito
-                        
+
                         # Enviar tamaño del archivo
-                        size = os.path.getsize(filename)
+                        size = os.path.getsize(path)
                         if not client.send_string(conn, str(size)):
-                            conn.close()
-                            continue
-                        
-                        # Enviar contenido del archivo
-                        with open(filename, 'rb') as f:
-                            conn.sendall(f.read())
+                            return
+
+                        # Enviar contenido del archivo sin cargarlo en memoria
+                        with open(path, 'rb') as f:
+                            conn.sendfile(f, 0, size)
                     else:
                         conn.sendall(bytes([1]))  # Archivo no existe
-                
-                conn.close()
-                
+
+                elif command == "FILE_INFO":
+                    # Tamaño y fecha de modificación del fichero, para repartir la
+                    # descarga en rangos y detectar cambios al reanudarla
+                    filename = r.read_string()
+                    if filename is None:
+                        return
+
+                    path = client._resolve_shared(filename)
+                    if path is None:
+                        conn.sendall(bytes([1]))  # Archivo no existe
+                        continue
+                    st = os.stat(path)
+                    conn.sendall(bytes([0]) + client._encode_fields([str(st.st_size), str(st.st_mtime_ns)]))
+
+                elif command == "GET_RANGE":
+                    # Leer nombre de archivo, desplazamiento y longitud del rango
+                    filename = r.read_string()
+                    offset = r.read_string()
+                    length = r.read_string()
+                    if filename is None or offset is None or length is None:
+                        return
+
+                    path = client._resolve_shared(filename)
+                    if path is None:
+                        conn.sendall(bytes([1]))  # Archivo no existe
+                        continue
+
+                    size = os.path.getsize(path)
+                    try:
+                        offset = int(offset)
+                        length = int(length)
+                    except ValueError:
+                        offset = length = -1
+                    if offset < 0 or length < 0 or offset > size:
+                        conn.sendall(bytes([2]))  # Rango no válido
+                        continue
+
+                    # El último rango puede ser más corto que el pedido
+                    length = min(length, size - offset)
+                    conn.sendall(bytes([0]) + (str(length) + "\0").encode())
+                    # sendfile con count 0 enviaría hasta el final del fichero
+                    if length > 0:
+                        with open(path, 'rb') as f:
+                            conn.sendfile(f, offset, length)
+
+                elif command == "GET_MANIFEST":
+                    # Hash de cada bloque del fichero, para verificar las descargas
+                    filename = r.read_string()
+                    if filename is None:
+                        return
+
+                    path = client._resolve_shared(filename)
+                    if path is None:
+                        conn.sendall(bytes([1]))  # Archivo no existe
+                        continue
+                    manifest = client._manifests.get(path)
+                    st = os.stat(path)
+                    if manifest is None or (manifest["size"], manifest["mtime"]) != (st.st_size, st.st_mtime_ns):
+                        conn.sendall(bytes([3]))  # Manifiesto aún no calculado o desactualizado
+                        continue
+                    conn.sendall(bytes([0]) + client._encode_fields(
+                        [str(manifest["chunk_size"]), str(len(manifest["leaves"]))] + manifest["leaves"]))
+
+                else:
+                    return  # Operación desconocida
+
         except Exception as e:
+            # Un error con un cliente (timeout, conexión cortada) no afecta al resto
             if client._running:
-                print(f"Error en hilo de escucha: {str(e)}")
+                print(f"Error en subida P2P: {str(e)}")
         finally:
-            if client._listen_socket:
-                client._listen_socket.close()
+            with client._upload_lock:
+                client._upload_conns.discard(conn)
+            conn.close()
+            client._upload_slots.release()
 
-    #Metodos de la clase cliente para interactuar con el servidor.
     @staticmethod
-    def register(user):
-        try:
-            # Crear socket y conectar al servidor
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((client._server, client._port))
-            
-            # Enviar comando REGISTER
-            if not client.send_string(s, "REGISTER"):
-                print("REGISTER FAIL")
-                return client.RC.ERROR
-            
-            fecha = client.get_current_datetime()
-            if not client.send_string(s, fecha):
-                print("REGISTER FAIL")
-                return client.RC.ERROR
+    def _share(name, path):
+        """Apunta un archivo publicado para servirlo por su nombre o su ruta"""
+        client._published[name] = path
+        client._published_paths[path] = name
 
-            
-            # Enviar nombre de usuario
-            if not client.send_string(s, user):
-                print("REGISTER FAIL")
-                return client.RC.ERROR
-            
-            # Recibir respuesta
-            response = s.recv(1)
-            if not response:
-                print("REGISTER FAIL")
-                return client.RC.ERROR
-            
-            response_code = response[0]
-            
-            if response_code == 0:
-                print("REGISTER OK")
-                return client.RC.OK
-            elif response_code == 1:
-                print("USERNAME IN USE")
-                return client.RC.USER_ERROR
-            else:
-                print("REGISTER FAIL")
-                return client.RC.ERROR
-                
-        except Exception as e:
-            print("REGISTER FAIL")
-            return client.RC.ERROR
-        finally:
-            s.close()
+    @staticmethod
+    def _resolve_shared(name):
+        """Ruta local del archivo pedido por otro cliente: una ruta absoluta (como en
+        GET_FILE) o el nombre con el que se publicó. Solo se sirven archivos
+        publicados; cualquier otra ruta se trata como inexistente"""
+        if os.path.isabs(name):
+            path = name if name in client._published_paths else None
+        else:
+            path = client._published.get(name)
+        if path is None or not os.path.isfile(path):
+            return None
+        return path
 
     @staticmethod
-    def unregister(user):
+    def _listen_thread_function():
         try:
-            # Crear socket y conectar al servidor
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((client._server, client._port))
-            
-            # Enviar comando UNREGISTER
-            if not client.send_string(s, "UNREGISTER"):
-                print("UNREGISTER FAIL")
-                return client.RC.ERROR
-            
-            fecha = client.get_current_datetime()
-            if not client.send_string(s, fecha):
-                print("UNREGISTER FAIL")
-                return client.RC.ERROR
+            client._listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client._listen_socket.bind(('0.0.0.0', client._listen_port))
+            client._listen_socket.listen(client.LISTEN_BACKLOG)
+            client._upload_slots = threading.BoundedSemaphore(client._max_uploads)
+            client._upload_pool = ThreadPoolExecutor(max_workers=client._max_uploads,
+                                                     thread_name_prefix="upload")
+
+            while client._running:
+                # Esperar a que haya una subida libre antes de aceptar otra conexión;
+                # mientras tanto las nuevas conexiones esperan en la cola de listen
+                if not client._upload_slots.acquire(timeout=0.5):
+                    continue
+
+                try:
+                    conn, addr = client._listen_socket.accept()
+                except OSError:
+                    client._upload_slots.release()
+                    if client._running:
+                        raise
+                    break  # disconnect cerró el socket de escucha
+
+                with client._upload_lock:
+                    client._upload_conns.add(conn)
+                client._upload_pool.submit(client._serve_peer, conn)
 
-            
-            # Enviar nombre de usuario
-            if not client.send_string(s, user):
-                print("UNREGISTER FAIL")
-                return client.RC.ERROR
-            
-            # Recibir respuesta
-            response = s.recv(1)
-            if not response:
-                print("UNREGISTER FAIL")
-                return client.RC.ERROR
-            
-            response_code = response[0]
-            
-            if response_code == 0:
-                print("UNREGISTER OK")
-                return client.RC.OK
-            elif response_code == 1:
-                print("USER DOES NOT EXIST")
-                return client.RC.USER_ERROR
-            else:
-                print("UNREGISTER FAIL")
-                return client.RC.ERROR
-                
         except Exception as e:
-            print("UNREGISTER FAIL")
-            return client.RC.ERROR
+            if client._running:
+                print(f"Error en hilo de escucha: {str(e)}")
         finally:
-            s.close()
+            if client._listen_socket:
+                client._listen_socket.close()
+
+    @staticmethod
+    def _stop_listen_thread():
+        """Detiene el servidor P2P: deja de aceptar conexiones, corta las subidas en
+        curso y espera a que terminen el hilo de escucha y el pool"""
+        client._running = False
+        if client._listen_socket:
+            try:
+                # Desbloquea el accept del hilo de escucha
+                client._listen_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
+        with client._upload_lock:
+            for conn in client._upload_conns:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+        if client._listen_thread:
+            client._listen_thread.join()
+        if client._upload_pool:
+            client._upload_pool.shutdown(wait=True)
+            client._upload_pool = None
 
+    #Conexión con el servidor: una conexión nueva por operación o la conexión de sesión.
     @staticmethod
-    def connect(user):
+    def _open_server(use_session=True):
+        """Devuelve (socket, lector) para una operación con el servidor. En modo sesión
+        reutiliza la conexión persistente mientras siga viva"""
+        if use_session and client._session is not None:
+            if client._session_alive():
+                return client._session, client._session_reader
+            client._close_session()
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((client._server, client._port))
+        return s, client.SocketReader(s)
+
+    @staticmethod
+    def _close_server(s, r):
+        """Cierra la conexión de una operación. La conexión de sesión se mantiene abierta
+        salvo que hayan quedado bytes sin leer (respuesta desincronizada)"""
+        if s is None:
+            return
+        if s is client._session:
+            if r.pending():
+                client._close_session()
+            return
+        s.close()
+
+    @staticmethod
+    def _open_session():
+        """Abre la conexión persistente que usarán las siguientes operaciones"""
         try:
-            # Buscar puerto libre
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.bind(('', 0))
-            client._listen_port = s.getsockname()[1]
-            s.close()
-            
-            # Crear socket y conectar al servidor
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.connect((client._server, client._port))
-            
-            # Enviar comando CONNECT
-            if not client.send_string(s, "CONNECT"):
-                print("CONNECT FAIL")
-                return client.RC.ERROR
-            
-            fecha = client.get_current_datetime()
-            if not client.send_string(s, fecha):
-                print("CONNECT FAIL")
-                return client.RC.ERROR
+            client._session = s
+            client._session_reader = client.SocketReader(s)
+        except Exception:
+            client._session = None
+            client._session_reader = None
 
-            
-            # Enviar nombre de usuario
-            if not client.send_string(s, user):
-                print("CONNECT FAIL")
-                return client.RC.ERROR
-            
-            # Enviar puerto de escucha
-            if not client.send_string(s, str(client._listen_port)):
-                print("CONNECT FAIL")
-                return client.RC.ERROR
-            
-            # Recibir respuesta
-            response = s.recv(1)
-            if not response:
-                print("CONNECT FAIL")
-                return client.RC.ERROR
-            
-            response_code = response[0]
-            
-            if response_code == 0:
-                # Iniciar hilo de escucha
-                client._running = True
-                client._listen_thread = threading.Thread(target=client._listen_thread_function)
-                client._listen_thread.start()
-                client._connected_user = user
-                print("CONNECT OK")
-                return client.RC.OK
-            elif response_code == 1:
-                print("CONNECT FAIL, USER DOES NOT EXIST")
-                return client.RC.USER_ERROR
-            elif response_code == 2:
-                print("USER ALREADY CONNECTED")
-                return client.RC.USER_ERROR
-            else:
-                print("CONNECT FAIL")
-                return client.RC.ERROR
-                
-        except Exception as e:
-            print("CONNECT FAIL")
-            return client.RC.ERROR
-        finally:
-            s.close()
+    @staticmethod
+    def _close_session():
+        if client._session is not None:
+            client._session.close()
+        client._session = None
+        client._session_reader = None
 
     @staticmethod
-    def disconnect(user):
+    def _session_alive():
+        """Comprueba sin bloquear que el servidor no ha cerrado la conexión de sesión"""
         try:
-            # Crear socket y conectar al servidor
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((client._server, client._port))
-            
-            # Enviar comando DISCONNECT
-            if not client.send_string(s, "DISCONNECT"):
-                print("DISCONNECT FAIL")
-                return client.RC.ERROR
-            
-            fecha = client.get_current_datetime()
-            if not client.send_string(s, fecha):
-                print("DISCONNECT FAIL")
-                return client.RC.ERROR
+            readable, _, _ = select.select([client._session], [], [], 0)
+            if not readable:
+                return True
+            # Sin una petición en curso solo puede llegar el cierre de la conexión
+            return client._session.recv(1, socket.MSG_PEEK) != b''
+        except OSError:
+            return False
 
-            
-            # Enviar nombre de usuario
-            if not client.send_string(s, user):
-                print("DISCONNECT FAIL")
-                return client.RC.ERROR
-            
-            # Recibir respuesta
-            response = s.recv(1)
-            if not response:
-                print("DISCONNECT FAIL")
-                return client.RC.ERROR
-            
-            response_code = response[0]
-            
-            if response_code == 0:
-                # Detener hilo de escucha
-                client._running = False
-                if client._listen_socket:
-                    # Crear conexión ficticia para desbloquear el accept
-                    temp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    temp_socket.connect(('localhost', client._listen_port))
-                    temp_socket.close()
-                
-                if client._listen_thread:
-                    client._listen_thread.join()
-                
-                client._connected_user = None
-                print("DISCONNECT OK")
-                return client.RC.OK
-            elif response_code == 1:
-                print("DISCONNECT FAIL, USER DOES NOT EXIST")
-                return client.RC.USER_ERROR
-            elif response_code == 2:
-                print("DISCONNECT FAIL, USER NOT CONNECTED")
-                return client.RC.USER_ERROR
-            else:
-                print("DISCONNECT FAIL")
+    @staticmethod
+    def _encode_fields(fields):
+        """Codifica una lista de campos terminados en NULL para enviarlos de una vez"""
+        return "".join(field + "\0" for field in fields).encode()
+
+    @staticmethod
+    def _encode_request(command, fields):
+        """Codifica una petición completa: comando, fecha y parámetros terminados en NULL"""
+        fecha = client.get_current_datetime()
+        if fecha is None:
+            return None
+        return client._encode_fields([command, fecha] + fields)
+
+    @staticmethod
+    def _execute(operation):
+        """Envía una operación preparada por una conexión con el servidor y procesa su respuesta"""
+        if isinstance(operation, client.RC):
+            return operation  # Falló la validación local, ya se mostró el error
+        command, fields, handler = operation
+        s = r = None
+        try:
+            s, r = client._open_server()
+            request = client._encode_request(command, fields)
+            if request is None:
+                print(f"{command} FAIL")
                 return client.RC.ERROR
-                
-        except Exception as e:
-            print("DISCONNECT FAIL")
+            s.sendall(request)
+            return handler(r)
+        except Exception:
+            # La respuesta puede llegar más tarde: no reutilizar la sesión
+            if s is not None and s is client._session:
+                client._close_session()
+            print(f"{command} FAIL")
             return client.RC.ERROR
         finally:
-            s.close()
+            client._close_server(s, r)
 
     @staticmethod
-    def publish(fileName, description):
-        try:
-            # Verificar si el archivo existe localmente
-            if not os.path.exists(fileName):
-                print("PUBLISH FAIL, FILE NOT FOUND")
-                return client.RC.ERROR
-            
-            # Comprobar que se pasa una ruta completa
-            if not os.path.isabs(fileName):
-                print("PUBLISH FAIL, MUST USE ABSOLUTE PATH")
-                return client.RC.ERROR
-            
-            # Extraer solo el nombre del archivo para mostrarlo en LIST_CONTENT
-            fileName_base = os.path.basename(fileName)
+    def _code_response(command, messages, on_ok=None):
+        """Manejador de las respuestas de un solo byte. messages asocia cada código con
+        (mensaje, RC); cualquier otro código se muestra como '<command> FAIL'"""
+        def handler(r):
+            response_code = r.read_byte()
+            if response_code == 0 and on_ok is not None:
+                on_ok()
+            message, rc = messages.get(response_code, (f"{command} FAIL", client.RC.ERROR))
+            print(message)
+            return rc
+        return handler
+
+    #Cada operación se prepara como (comando, parámetros, manejador de la respuesta)
+    #para poder ejecutarla sola o encadenada en un PIPELINE.
+    @staticmethod
+    def _prepare_register(user):
+        return ("REGISTER", [user], client._code_response("REGISTER", {
+            0: ("REGISTER OK", client.RC.OK),
+            1: ("USERNAME IN USE", client.RC.USER_ERROR),
+        }))
 
-            # Crear socket y conectar al servidor
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((client._server, client._port))
-            
-            # Enviar comando PUBLISH
-            if not client.send_string(s, "PUBLISH"):
-                print("PUBLISH FAIL")
-                return client.RC.ERROR
-            
-            fecha = client.get_current_datetime()
-            if not client.send_string(s, fecha):
-                print("PUBLISH FAIL")
-                return client.RC.ERROR
+    @staticmethod
+    def _prepare_unregister(user):
+        return ("UNREGISTER", [user], client._code_response("UNREGISTER", {
+            0: ("UNREGISTER OK", client.RC.OK),
+            1: ("USER DOES NOT EXIST", client.RC.USER_ERROR),
+        }))
 
-            
-            # Enviar nombre de usuario
-            if not client.send_string(s, client._connected_user):
-                print("PUBLISH FAIL")
-                return client.RC.ERROR
-            
-            # Enviar nombre de archivo
-            if not client.send_string(s, fileName_base):
-                print("PUBLISH FAIL")
-                return client.RC.ERROR
-            
-            # Enviar descripción
-            if not client.send_string(s, description):
-                print("PUBLISH FAIL")
-                return client.RC.ERROR
-            
-            # Recibir respuesta
-            response = s.recv(1)
-            if not response:
-                print("PUBLISH FAIL")
-                return client.RC.ERROR
-            
-            response_code = response[0]
-            
-            if response_code == 0:
-                print("PUBLISH OK")
-                return client.RC.OK
-            elif response_code == 1:
-                print("PUBLISH FAIL, USER DOES NOT EXIST")
-                return client.RC.USER_ERROR
-            elif response_code == 2:
-                print("PUBLISH FAIL, USER NOT CONNECTED")
-                return client.RC.USER_ERROR
-            elif response_code == 3:
-                print("PUBLISH FAIL, CONTENT ALREADY PUBLISHED")
-                return client.RC.USER_ERROR
-            else:
-                print("PUBLISH FAIL")
-                return client.RC.ERROR
-                
-        except Exception as e:
+    @staticmethod
+    def _prepare_connect(user):
+        # Buscar puerto libre
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('', 0))
+        client._listen_port = s.getsockname()[1]
+        s.close()
+
+        def on_ok():
+            # Iniciar hilo de escucha
+            client._running = True
+            client._listen_thread = threading.Thread(target=client._listen_thread_function)
+            client._listen_thread.start()
+            client._connected_user = user
+            client._reset_mirrors()
+            if client._session_enabled:
+                client._open_session()
+
+        return ("CONNECT", [user, str(client._listen_port)], client._code_response("CONNECT", {
+            0: ("CONNECT OK", client.RC.OK),
+            1: ("CONNECT FAIL, USER DOES NOT EXIST", client.RC.USER_ERROR),
+            2: ("USER ALREADY CONNECTED", client.RC.USER_ERROR),
+        }, on_ok))
+
+    @staticmethod
+    def _prepare_disconnect(user):
+        def on_ok():
+            # Detener hilo de escucha
+            client._stop_listen_thread()
+
+            client._connected_user = None
+            client._reset_mirrors()
+            client._close_subscription()
+            client._close_session()
+
+        return ("DISCONNECT", [user], client._code_response("DISCONNECT", {
+            0: ("DISCONNECT OK", client.RC.OK),
+            1: ("DISCONNECT FAIL, USER DOES NOT EXIST", client.RC.USER_ERROR),
+            2: ("DISCONNECT FAIL, USER NOT CONNECTED", client.RC.USER_ERROR),
+        }, on_ok))
+
+    @staticmethod
+    def _prepare_publish(fileName, description):
+        # Verificar si el archivo existe localmente
+        if not os.path.exists(fileName):
+            print("PUBLISH FAIL, FILE NOT FOUND")
+            return client.RC.ERROR
+
+        # Comprobar que se pasa una ruta completa
+        if not os.path.isabs(fileName):
+            print("PUBLISH FAIL, MUST USE ABSOLUTE PATH")
+            return client.RC.ERROR
+
+        if client._connected_user is None:
             print("PUBLISH FAIL")
             return client.RC.ERROR
-        finally:
-            s.close()
 
-    @staticmethod
-    def delete(filePath):
-        try:
-            if not os.path.isabs(filePath):
-                print("DELETE FAIL, MUST USE ABSOLUTE PATH")
-                return client.RC.ERROR
+        # Extraer solo el nombre del archivo para mostrarlo en LIST_CONTENT
+        fileName_base = os.path.basename(fileName)
 
-            if not os.path.exists(filePath):
-                print("DELETE FAIL, FILE DOES NOT EXIST LOCALLY")
-                return client.RC.ERROR
-            
-            fileName = os.path.basename(filePath)
+        user = client._connected_user
 
-            # Crear socket y conectar al servidor
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((client._server, client._port))
-            
-            # Enviar comando DELETE
-            if not client.send_string(s, "DELETE"):
-                print("DELETE FAIL")
-                return client.RC.ERROR
-            
-            fecha = client.get_current_datetime()
-            if not client.send_string(s, fecha):
-                print("DELETE FAIL")
-                return client.RC.ERROR
+        def on_ok():
+            # Recordar la ruta para servir el archivo por su nombre publicado y
+            # calcular su manifiesto en segundo plano
+            client._share(fileName_base, fileName)
+            if client._hash_pool is None:
+                client._hash_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hash")
+            client._hash_pool.submit(client._hash_published, fileName, fileName_base, user)
 
-            
-            # Enviar nombre de usuario
-            if not client.send_string(s, client._connected_user):
-                print("DELETE FAIL")
-                return client.RC.ERROR
+        return ("PUBLISH", [client._connected_user, fileName_base, description], client._code_response("PUBLISH", {
+            0: ("PUBLISH OK", client.RC.OK),
+            1: ("PUBLISH FAIL, USER DOES NOT EXIST", client.RC.USER_ERROR),
+            2: ("PUBLISH FAIL, USER NOT CONNECTED", client.RC.USER_ERROR),
+            3: ("PUBLISH FAIL, CONTENT ALREADY PUBLISHED", client.RC.USER_ERROR),
+        }, on_ok))
 
-            # Enviar nombre de archivo
-            if not client.send_string(s, fileName):
-                print("DELETE FAIL")
-                return client.RC.ERROR
-            
-            # Recibir respuesta
-            response = s.recv(1)
-            if not response:
-                print("DELETE FAIL")
-                return client.RC.ERROR
-            
-            response_code = response[0]
-            
-            if response_code == 0:
-                print("DELETE OK")
-                return client.RC.OK
-            elif response_code == 1:
-                print("DELETE FAIL, USER DOES NOT EXIST")
-                return client.RC.USER_ERROR
-            elif response_code == 2:
-                print("DELETE FAIL, USER NOT CONNECTED")
-                return client.RC.USER_ERROR
-            elif response_code == 3:
-                print("DELETE FAIL, CONTENT NOT PUBLISHED")
-                return client.RC.USER_ERROR
-            else:
-                print("DELETE FAIL")
-                return client.RC.ERROR
-                
-        except Exception as e:
+    @staticmethod
+    def _prepare_delete(filePath):
+        if not os.path.isabs(filePath):
+            print("DELETE FAIL, MUST USE ABSOLUTE PATH")
+            return client.RC.ERROR
+
+        if not os.path.exists(filePath):
+            print("DELETE FAIL, FILE DOES NOT EXIST LOCALLY")
+            return client.RC.ERROR
+
+        if client._connected_user is None:
             print("DELETE FAIL")
             return client.RC.ERROR
-        finally:
-            s.close()
+
+        fileName = os.path.basename(filePath)
+
+        def on_ok():
+            path = client._published.pop(fileName, None)
+            if path is not None:
+                client._published_paths.pop(path, None)
+
+        return ("DELETE", [client._connected_user, fileName], client._code_response("DELETE", {
+            0: ("DELETE OK", client.RC.OK),
+            1: ("DELETE FAIL, USER DOES NOT EXIST", client.RC.USER_ERROR),
+            2: ("DELETE FAIL, USER NOT CONNECTED", client.RC.USER_ERROR),
+            3: ("DELETE FAIL, CONTENT NOT PUBLISHED", client.RC.USER_ERROR),
+        }, on_ok))
 
     @staticmethod
-    def listusers():
-        try:
-            # Crear socket y conectar al servidor
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((client._server, client._port))
-            
-            # Enviar comando LIST_USERS
-            if not client.send_string(s, "LIST_USERS"):
-                print("LIST_USERS FAIL1")
-                return client.RC.ERROR
-            
-            fecha = client.get_current_datetime()
-            if not client.send_string(s, fecha):
-                print("DELETE FAIL")
-                return client.RC.ERROR
+    def _show_users(code, mirror):
+        """Guarda la copia de LIST_USERS y muestra el resultado"""
+        client._users_mirror = mirror
+        if code == 0:
+            print("LIST_USERS OK")
+            for username, (ip, port) in mirror["entries"].items():
+                print(f"{username} {ip} {port}")
+            return client.RC.OK
+        elif code == 1:
+            print("LIST_USERS FAIL, USER DOES NOT EXIST")
+            return client.RC.USER_ERROR
+        elif code == 2:
+            print("LIST_USERS FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+        print("LIST_USERS FAIL")
+        return client.RC.ERROR
 
-            
-            # Enviar nombre de usuario
-            if not client.send_string(s, client._connected_user):
-                print("LIST_USERS FAIL2")
-                return client.RC.ERROR
-            
-            
-            # Recibir respuesta (y parte del número si llega de golpe)
-            response = s.recv(2)  # código de estado + posible primer byte del número
-            if not response or len(response) < 1:
-                print("LIST_USERS FAIL3")
-                return client.RC.ERROR
+    @staticmethod
+    def _prepare_listusers():
+        if client._connected_user is None:
+            print("LIST_USERS FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+        return client._prepare_listing("LIST_USERS", [client._connected_user],
+                                       client._users_mirror, 3, 4, client._show_users)
 
-            response_code = response[0]
+    @staticmethod
+    def _show_content(user, code, mirror):
+        """Guarda la copia de LIST_CONTENT de user y muestra el resultado"""
+        if mirror is None:
+            client._content_mirrors.pop(user, None)
+        else:
+            client._content_mirrors[user] = mirror
+
+        if code == 0 and mirror["entries"]:
+            print("LIST_CONTENT OK")
+            for filename in mirror["entries"]:
+                print(filename)
+            return client.RC.OK
+        elif code == 0:
+            print("LIST_CONTENT FAIL, USER HAS NO FILES")
+            return client.RC.USER_ERROR
+        elif code == 2:
+            print("LIST_CONTENT FAIL, USER NOT CONNECTED")
+        elif code == 3:
+            print("LIST_CONTENT FAIL, REMOTE USER DOES NOT EXIST")
+        else:
+            print("LIST_CONTENT FAIL")
+        return client.RC.ERROR
 
-            # Preparamos buffer restante con cualquier byte extra recibido
-            remaining = response[1:] if len(response) > 1 else b''
+    @staticmethod
+    def _prepare_listcontent(user):
+        if not client._connected_user:
+            print("LIST_CONTENT FAIL, USER NOT CONNECTED")
+            return client.RC.ERROR
 
+        if not user:
+            print("Syntax error. Usage: LIST_CONTENT <userName>")
+            return client.RC.ERROR
 
-            if response_code == 0:
-                # Leer número de usuarios
-                time.sleep(0.05)  # pequeña espera opcional
-                num_users = client.read_string_with_buffer(s, remaining)
+        return client._prepare_listing("LIST_CONTENT", [client._connected_user, user],
+                                       client._content_mirrors.get(user), 1, 6,
+                                       lambda code, mirror: client._show_content(user, code, mirror))
 
-                if num_users is None:
-                    print("LIST_USERS FAIL4")
-                    return client.RC.ERROR
-                
-                
+    #Copias locales de LIST_USERS y LIST_CONTENT. Cada copia guarda la versión del
+    #catálogo con la que está al día y sus entradas en el orden del servidor, y las
+    #consultas siguientes piden solo los cambios desde esa versión.
+    @staticmethod
+    def _reset_mirrors():
+        client._users_mirror = None
+        client._content_mirrors = {}
 
-                try:
-                    num_users = int(num_users)
-                except:
-                    print("LIST_USERS FAIL (número inválido)")
-                    return client.RC.ERROR
+    @staticmethod
+    def _read_listing_entry(r, nfields):
+        """Lee una entrada de nfields campos. Devuelve (clave, resto de campos)"""
+        entry = [r.read_string() for _ in range(nfields)]
+        if None in entry:
+            raise ConnectionError("respuesta incompleta")
+        return entry[0], tuple(entry[1:])
 
-                print("LIST_USERS OK")
+    @staticmethod
+    def _read_changes(r, mirror, nfields):
+        """Lee una respuesta de <command>_CHANGES con código 0 y la aplica a la copia"""
+        version = r.read_string()
+        count = int(r.read_string())
+        entries = mirror["entries"]
+        for _ in range(count):
+            sign = r.read_string()
+            key, values = client._read_listing_entry(r, nfields)
+            entries.pop(key, None)
+            if sign == "+":
+                entries[key] = values
+        mirror["version"] = version
 
-                # Recibir información de cada usuario
-                for _ in range(num_users):
-                    username = client.read_string(s)
-                    if username is None:
-                        print("LIST_USERS FAIL5")
-                        return client.RC.ERROR
+    @staticmethod
+    def _read_page(r, entries, nfields):
+        """Lee una respuesta de <command>_PAGE con código 0 y añade sus entradas.
+        Devuelve (versión, cursor siguiente)"""
+        version = r.read_string()
+        cursor = r.read_string()
+        count = int(r.read_string())
+        for _ in range(count):
+            key, values = client._read_listing_entry(r, nfields)
+            entries[key] = values
+        return version, cursor
 
-                    ip = client.read_string(s)
-                    if ip is None:
-                        print("LIST_USERS FAIL6")
-                        return client.RC.ERROR
+    @staticmethod
+    def _sync_listing(command, fields, mirror, nfields, resync_code, use_session=True):
+        """Pone al día la copia local de un listado por una sola conexión. Con copia pide
+        <command>_CHANGES desde su versión; sin copia, o si el servidor ya no tiene esos
+        cambios, pide el listado completo con <command>_PAGE y después los cambios que
+        hubo mientras tanto. Cada entrada tiene nfields campos y el primero es la clave.
+        Devuelve (código del servidor, copia actualizada); el código es None si falla
+        la conexión"""
+        s = r = None
+        try:
+            s, r = client._open_server(use_session)
+
+            def request(name, extra):
+                data = client._encode_request(name, fields + extra)
+                if data is None:
+                    return None
+                s.sendall(data)
+                return r.read_byte()
+
+            # Una copia nueva siempre va seguida de los cambios; si el servidor
+            # descarta esos cambios mientras tanto se vuelve a empezar
+            for _ in range(3):
+                if mirror is not None:
+                    code = request(command + "_CHANGES", [mirror["version"]])
+                    if code != 0 and code != resync_code:
+                        return code, None
+                    if code == 0:
+                        client._read_changes(r, mirror, nfields)
+                        return 0, mirror
+
+                entries = {}
+                version = None
+                cursor = "0:"
+                while True:
+                    code = request(command + "_PAGE", [cursor, str(client.LIST_PAGE_SIZE)])
+                    if code != 0:
+                        return code, None
+                    page_version, cursor = client._read_page(r, entries, nfields)
+                    if version is None:
+                        version = page_version
+                    if not cursor:
+                        break
+                mirror = {"version": version, "entries": entries}
+            return resync_code, None
+        except Exception:
+            # La respuesta puede haber quedado a medias: no reutilizar la sesión
+            if s is not None and s is client._session:
+                client._close_session()
+            return None, None
+        finally:
+            client._close_server(s, r)
 
-                    port = client.read_string(s)
-                    if port is None:
-                        print("LIST_USERS FAIL7")
-                        return client.RC.ERROR
+    @staticmethod
+    def _prepare_listing(command, fields, mirror, nfields, resync_code, done):
+        """Operación que pone al día la copia local de un listado con una sola petición,
+        para poder encadenarla en un PIPELINE: con copia pide los cambios y sin copia la
+        primera página. Si eso no basta (hay más páginas o el servidor ya no tiene los
+        cambios) termina con _sync_listing por una conexión aparte, porque en la sesión
+        quedan por leer las respuestas de las operaciones siguientes. done(código, copia)
+        guarda la copia y muestra el resultado"""
+        def finish():
+            return done(*client._sync_listing(command, fields, None, nfields, resync_code,
+                                              use_session=False))
+
+        if mirror is not None:
+            def changes_handler(r):
+                code = r.read_byte()
+                if code == 0:
+                    client._read_changes(r, mirror, nfields)
+                    return done(0, mirror)
+                return finish() if code == resync_code else done(code, None)
+            return (command + "_CHANGES", fields + [mirror["version"]], changes_handler)
+
+        def page_handler(r):
+            code = r.read_byte()
+            if code != 0:
+                return done(code, None)
+            entries = {}
+            version, cursor = client._read_page(r, entries, nfields)
+            # Una sola página es una copia consistente con su versión
+            return finish() if cursor else done(0, {"version": version, "entries": entries})
+        return (command + "_PAGE", fields + ["0:", str(client.LIST_PAGE_SIZE)], page_handler)
+
+    #Suscripción a los cambios del catálogo: una conexión propia por la que el servidor
+    #envía primero el estado completo (SNAPSHOT) y después lotes de cambios (EVENTS).
+    #Un hilo en segundo plano los aplica a client._watch, que WATCH muestra sin
+    #consultar al servidor.
+    @staticmethod
+    def _apply_event(view, r):
+        """Lee un evento y lo aplica a la vista"""
+        kind = r.read_string()
+        if kind == "U+":
+            user, ip, port = r.read_string(), r.read_string(), r.read_string()
+            if port is None:
+                raise ConnectionError("evento incompleto")
+            view["users"].pop(user, None)
+            view["users"][user] = (ip, port)
+        elif kind == "U-":
+            view["users"].pop(r.read_string(), None)
+        elif kind in ("F+", "F-"):
+            owner, filename = r.read_string(), r.read_string()
+            if filename is None:
+                raise ConnectionError("evento incompleto")
+            files = view["files"].setdefault(owner, {})
+            files.pop(filename, None)
+            if kind == "F+":
+                files[filename] = None
+            elif not files:
+                del view["files"][owner]
+        else:
+            raise ConnectionError("evento no válido")
 
-                    print(f"{username} {ip} {port}")
+    @staticmethod
+    def _subscription_thread(s, r):
+        try:
+            while True:
+                frame = r.read_string()
+                version = r.read_string()
+                count = r.read_string()
+                if frame not in ("SNAPSHOT", "EVENTS") or count is None:
+                    break
+                with client._watch_lock:
+                    view = client._watch
+                    if frame == "SNAPSHOT" or view is None:
+                        view = {"version": None, "users": {}, "files": {}}
+                    for _ in range(int(count)):
+                        client._apply_event(view, r)
+                    view["version"] = version
+                    if client._subscription is s:
+                        client._watch = view
+        except (OSError, ValueError):
+            pass
+        finally:
+            with client._watch_lock:
+                if client._subscription is s:
+                    client._subscription = None
+            s.close()
 
-                return client.RC.OK
+    @staticmethod
+    def _close_subscription():
+        with client._watch_lock:
+            s = client._subscription
+            client._subscription = None
+            client._watch = None
+        if s is not None:
+            try:
+                s.shutdown(socket.SHUT_RDWR)  # Despierta al hilo que lee de ella
+            except OSError:
+                pass
 
-            
-            elif response_code == 1:
-                print("LIST_USERS FAIL, USER DOES NOT EXIST")
-                return client.RC.USER_ERROR
-            elif response_code == 2:
-                print("LIST_USERS FAIL, USER NOT CONNECTED")
-                return client.RC.USER_ERROR
-            else:
-                print("LIST_USERS FAIL")
+    SEARCH_DEFAULT_LIMIT = 50
+
+    @staticmethod
+    def _search_response(r):
+        response_code = r.read_byte()
+        if response_code is None:
+            print("SEARCH FAIL")
+            return client.RC.ERROR
+
+        if response_code == 0:
+            num_results = r.read_string()
+            try:
+                num_results = int(num_results)
+            except (TypeError, ValueError):
+                print("SEARCH FAIL")
                 return client.RC.ERROR
-                
-        except Exception as e:
-            print(f"Se produjo una excepción: {e}")
-            print("LIST_USERS FAIL")
+
+            print("SEARCH OK")
+            for _ in range(num_results):
+                owner = r.read_string()
+                filename = r.read_string()
+                description = r.read_string()
+                if owner is None or filename is None or description is None:
+                    print("SEARCH FAIL")
+                    return client.RC.ERROR
+                print(f"{owner} {filename} {description}")
+            return client.RC.OK
+
+        elif response_code == 1:
+            print("SEARCH FAIL, USER DOES NOT EXIST")
+            return client.RC.USER_ERROR
+        elif response_code == 2:
+            print("SEARCH FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+        else:
+            print("SEARCH FAIL")
             return client.RC.ERROR
-        finally:
-            s.close()
 
     @staticmethod
-    def read_string_with_buffer(sock, initial_bytes):
-        """Lee una cadena terminada en NULL del socket, usando bytes leídos previamente si los hay"""
-        chars = []
+    def _prepare_search(words):
+        """SEARCH [-n <maxResults>] <text>: ficheros de cualquier usuario cuyo nombre o
+        descripción tiene palabras que empiezan por cada palabra de text"""
+        if client._connected_user is None:
+            print("SEARCH FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+
+        limit = client.SEARCH_DEFAULT_LIMIT
+        if len(words) >= 2 and words[0] == "-n":
+            try:
+                limit = int(words[1])
+            except ValueError:
+                limit = 0
+            words = words[2:]
+        if not words or limit <= 0:
+            print("Syntax error. Usage: SEARCH [-n <maxResults>] <text>")
+            return client.RC.ERROR
 
-        # Procesar los bytes que ya fueron leídos (por ejemplo en s.recv(2))
-        for b in initial_bytes:
-            if b == 0:
-                return ''.join(chars)
-            chars.append(chr(b))  # convertir directamente a carácter
+        return ("SEARCH", [client._connected_user, ' '.join(words), str(limit)], client._search_response)
 
-        # Leer desde el socket hasta encontrar \0
-        while True:
-            msg = sock.recv(1)
-            if not msg:
-                return None
-            if msg == b'\0':
-                break
-            chars.append(msg.decode())
+    @staticmethod
+    def _stats_response(r):
+        response_code = r.read_byte()
+        if response_code == 0:
+            text = r.read_string()
+            if text is not None:
+                print("STATS OK")
+                print(text, end="")
+                return client.RC.OK
+        print("STATS FAIL")
+        return client.RC.ERROR
+
+    @staticmethod
+    def _prepare_stats():
+        """STATS: métricas del servidor (peticiones, latencias, conexiones, cerrojos
+        y registro RPC) en formato de texto de Prometheus"""
+        return ("STATS", [client._connected_user or "-"], client._stats_response)
+
+    #Metodos de la clase cliente para interactuar con el servidor.
+    @staticmethod
+    def register(user):
+        return client._execute(client._prepare_register(user))
+
+    @staticmethod
+    def unregister(user):
+        return client._execute(client._prepare_unregister(user))
+
+    @staticmethod
+    def connect(user):
+        try:
+            operation = client._prepare_connect(user)
+        except Exception:
+            print("CONNECT FAIL")
+            return client.RC.ERROR
+        return client._execute(operation)
 
-        return ''.join(chars)
+    @staticmethod
+    def disconnect(user):
+        return client._execute(client._prepare_disconnect(user))
 
+    @staticmethod
+    def publish(fileName, description):
+        return client._execute(client._prepare_publish(fileName, description))
+
+    @staticmethod
+    def delete(filePath):
+        return client._execute(client._prepare_delete(filePath))
 
+    @staticmethod
+    def listusers():
+        operation = client._prepare_listusers()
+        if isinstance(operation, client.RC):
+            return operation
+        return client._show_users(*client._sync_listing("LIST_USERS", [client._connected_user],
+                                                        client._users_mirror, 3, 4))
 
     @staticmethod
     def listcontent(user):
-        if not client._connected_user:
-            print("LIST_CONTENT FAIL, USER NOT CONNECTED")
+        operation = client._prepare_listcontent(user)
+        if isinstance(operation, client.RC):
+            return operation
+        return client._show_content(user, *client._sync_listing(
+            "LIST_CONTENT", [client._connected_user, user], client._content_mirrors.get(user), 1, 6))
+
+    @staticmethod
+    def search(words):
+        return client._execute(client._prepare_search(words))
+
+    @staticmethod
+    def stats():
+        return client._execute(client._prepare_stats())
+
+    PUBLISH_DIR_CHUNK = 1024  # Registros por envío al servidor
+
+    @staticmethod
+    def _dir_files(dirPath, report=False):
+        """Genera la ruta y el nombre publicado de cada fichero del árbol, siempre en
+        el mismo orden. Con report se muestran los nombres que no se pueden publicar"""
+        for root, dirs, names in os.walk(dirPath):
+            dirs.sort()
+            for fileName in sorted(names):
+                path = os.path.join(root, fileName)
+                if not os.path.isfile(path):
+                    continue
+                name = os.path.relpath(path, dirPath).replace(os.sep, "/")
+                if len(name.encode()) >= 256 or "\n" in name:
+                    if report:
+                        print(f"{name}: FAIL, NAME NOT VALID")
+                    continue
+                yield path, name
+
+    @staticmethod
+    def publish_dir(dirPath, description):
+        """Publica todos los ficheros de un árbol de directorios con una sola operación
+        PUBLISH_DIR. Cada fichero se publica con su ruta relativa al directorio.
+
+        El árbol se recorre dos veces sin guardarlo: una para contar los ficheros,
+        que van en la cabecera, y otra para enviarlos a medida que aparecen. Hasta
+        la respuesta solo se guarda el nombre de cada fichero enviado"""
+        if not os.path.isabs(dirPath):
+            print("PUBLISH_DIR FAIL, MUST USE ABSOLUTE PATH")
+            return client.RC.ERROR
+        if not os.path.isdir(dirPath):
+            print("PUBLISH_DIR FAIL, DIRECTORY NOT FOUND")
+            return client.RC.ERROR
+        if client._connected_user is None:
+            print("PUBLISH_DIR FAIL")
             return client.RC.ERROR
+        user = client._connected_user
+        count = sum(1 for _ in client._dir_files(dirPath))
+
+        def records(names, unhashed):
+            # (nombre publicado, raíz Merkle si ya se conoce o "-") de cada fichero
+            for path, name in islice(client._dir_files(dirPath, report=True), count):
+                manifest = client._manifests.get(path)
+                st = os.stat(path)
+                if manifest is None or manifest["size"] != st.st_size or manifest["mtime"] != st.st_mtime_ns:
+                    manifest = None
+                names.append(name)
+                unhashed.append(manifest is None)
+                yield name, manifest["root"] if manifest else "-"
+
+        names = []
+        unhashed = bytearray()          # 1 si el fichero aún no tiene manifiesto
+        # Conexión propia, nunca la de sesión: si la operación se corta a medias el
+        # servidor seguiría esperando registros y leería como tales lo siguiente
+        s = r = None
+        try:
+            s, r = client._open_server(use_session=False)
+            request = client._encode_request("PUBLISH_DIR", [user, str(count)])
+            if request is None:
+                print("PUBLISH_DIR FAIL")
+                return client.RC.ERROR
+            s.sendall(request)
+            pending = records(names, unhashed)
+            while True:
+                chunk = list(islice(pending, client.PUBLISH_DIR_CHUNK))
+                if not chunk:
+                    break
+                s.sendall(b"".join(client._encode_fields([name, description, root]) for name, root in chunk))
+            if len(names) != count:
+                # El árbol perdió ficheros entre las dos pasadas: el servidor
+                # esperaría registros que no van a llegar
+                print("PUBLISH_DIR FAIL, DIRECTORY CHANGED")
+                return client.RC.ERROR
 
-        if not user:
-            print("Syntax error. Usage: LIST_CONTENT <userName>")
+            response_code = r.read_byte()
+            results = r.read_string() if response_code == 0 else None
+        except Exception:
+            response_code = results = None
+        finally:
+            client._close_server(s, r)
+
+        if results is None or len(results) != count:
+            print("PUBLISH_DIR FAIL")
             return client.RC.ERROR
 
-        try:
+        messages = {
+            "1": "USER DOES NOT EXIST",
+            "2": "USER NOT CONNECTED",
+            "3": "CONTENT ALREADY PUBLISHED",
+        }
+        published = []
+        for i, (name, result) in enumerate(zip(names, results)):
+            if result == "0":
+                path = os.path.join(dirPath, *name.split("/"))
+                client._share(name, path)
+                if unhashed[i]:
+                    published.append((path, name))
+            else:
+                print(f"{name}: FAIL, {messages.get(result, 'SERVER ERROR')}")
+        print(f"PUBLISH_DIR OK {results.count('0')}/{count}")
 
-             # Crear socket temporal para esta operación
+        # Manifiestos de los publicados que aún no lo tienen, en segundo plano
+        if published:
+            if client._hash_pool is None:
+                client._hash_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hash")
+            client._hash_pool.submit(client._hash_published_many, published, user)
+        return client.RC.OK if results.count("0") == count else client.RC.USER_ERROR
+
+    @staticmethod
+    def subscribe(user_pattern="*", file_pattern="*"):
+        if client._connected_user is None:
+            print("SUBSCRIBE FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+        client._close_subscription()
+
+        s = None
+        try:
+            request = client._encode_request("SUBSCRIBE", [client._connected_user, user_pattern, file_pattern])
+            if request is None:
+                print("SUBSCRIBE FAIL")
+                return client.RC.ERROR
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.connect((client._server, client._port))
+            s.sendall(request)
+            r = client.SocketReader(s)
+            response_code = r.read_byte()
+        except Exception:
+            response_code = None
+
+        if response_code != 0:
+            if s is not None:
+                s.close()
+            if response_code == 1:
+                print("SUBSCRIBE FAIL, USER DOES NOT EXIST")
+                return client.RC.USER_ERROR
+            if response_code == 2:
+                print("SUBSCRIBE FAIL, USER NOT CONNECTED")
+                return client.RC.USER_ERROR
+            print("SUBSCRIBE FAIL")
+            return client.RC.ERROR
 
-            # Enviar comando
-            s.sendall(b"LIST_CONTENT\0")
-            fecha = client.get_current_datetime()
-            if fecha is None:
-                print("LIST_CONTENT FAIL")
-                return client.RC.ERROR
-            s.sendall(fecha.encode() + b"\0")
+        with client._watch_lock:
+            client._subscription = s
+        threading.Thread(target=client._subscription_thread, args=(s, r), daemon=True).start()
+        print("SUBSCRIBE OK")
+        return client.RC.OK
 
-            s.sendall(client._connected_user.encode() + b"\0")
-            s.sendall(user.encode() + b"\0")
+    @staticmethod
+    def unsubscribe():
+        if client._subscription is None:
+            print("UNSUBSCRIBE FAIL, NOT SUBSCRIBED")
+            return client.RC.USER_ERROR
+        client._close_subscription()
+        print("UNSUBSCRIBE OK")
+        return client.RC.OK
 
-            # Recibir código de respuesta
-            response = s.recv(1)
-            if not response:
-                print("LIST_CONTENT FAIL")
+    @staticmethod
+    def watch():
+        """Muestra la vista local de la suscripción: usuarios conectados y ficheros publicados"""
+        with client._watch_lock:
+            view = client._watch
+            if client._subscription is None:
+                print("WATCH FAIL, NOT SUBSCRIBED")
+                return client.RC.USER_ERROR
+            if view is None:
+                print("WATCH FAIL, NO DATA YET")
                 return client.RC.ERROR
+            print("WATCH OK")
+            print(f"USERS {len(view['users'])}")
+            for user, (ip, port) in view["users"].items():
+                print(f"{user} {ip} {port}")
+            print(f"FILES {sum(len(files) for files in view['files'].values())}")
+            for owner, files in view["files"].items():
+                for filename in files:
+                    print(f"{owner} {filename}")
+        return client.RC.OK
 
-            response_code = response[0]
+    @staticmethod
+    def pipeline(commands):
+        """Envía seguidas varias operaciones por la conexión de sesión, sin esperar cada
+        respuesta, y procesa después las respuestas en el mismo orden"""
+        if client._session is None:
+            print("PIPELINE FAIL, SESSION NOT ACTIVE")
+            return client.RC.ERROR
 
-            if response_code == 0:
-                # Leer número de archivos
-                num_files = client.read_string(s)
-                if num_files is None:
-                    print("LIST_CONTENT FAIL")
-                    return client.RC.ERROR
+        operations = []
+        for command in commands:
+            operation = client._prepare_line(command.split())
+            if operation is None:
+                print("PIPELINE FAIL, INVALID COMMAND: " + command.strip())
+                return client.RC.ERROR
+            if isinstance(operation, client.RC):
+                return operation
+            operations.append(operation)
 
-                try:
-                    num_files = int(num_files.strip())
-                except ValueError:
-                    print("LIST_CONTENT FAIL (número inválido)")
+        s = r = None
+        try:
+            s, r = client._open_server()
+            requests_data = []
+            for command, fields, _ in operations:
+                request = client._encode_request(command, fields)
+                if request is None:
+                    print("PIPELINE FAIL")
                     return client.RC.ERROR
+                requests_data.append(request)
+            s.sendall(b"".join(requests_data))
+
+            result = client.RC.OK
+            for _, _, handler in operations:
+                rc = handler(r)
+                if rc != client.RC.OK:
+                    result = rc
+            return result
+        except Exception:
+            # Pueden quedar respuestas por llegar: no reutilizar la sesión
+            if s is not None and s is client._session:
+                client._close_session()
+            print("PIPELINE FAIL")
+            return client.RC.ERROR
+        finally:
+            client._close_server(s, r)
 
-                print("LIST_CONTENT OK")
+    @staticmethod
+    def _prepare_line(line):
+        """Prepara una operación a partir de una línea de la shell. Solo admite las
+        operaciones que no cambian la conexión (ni CONNECT ni DISCONNECT)"""
+        if len(line) == 0:
+            return None
+        name = line[0].upper()
+        if name == "REGISTER" and len(line) == 2:
+            return client._prepare_register(line[1])
+        if name == "UNREGISTER" and len(line) == 2:
+            return client._prepare_unregister(line[1])
+        if name == "PUBLISH" and len(line) >= 3:
+            return client._prepare_publish(line[1], ' '.join(line[2:]))
+        if name == "DELETE" and len(line) == 2:
+            return client._prepare_delete(line[1])
+        if name == "LIST_USERS" and len(line) == 1:
+            return client._prepare_listusers()
+        if name == "LIST_CONTENT" and len(line) == 2:
+            return client._prepare_listcontent(line[1])
+        if name == "SEARCH" and len(line) >= 2:
+            return client._prepare_search(line[1:])
+        if name == "STATS" and len(line) == 1:
+            return client._prepare_stats()
+        return None
+
+
+    #Descarga por rangos (FILE_INFO / GET_RANGE) desde uno o varios clientes.
+    @staticmethod
+    def _peer_file_info(endpoint, name):
+        """Pide a otro cliente el tamaño y la fecha de modificación de un archivo.
+        Devuelve (código, tamaño, mtime); el código es None si el cliente no responde
+        o no admite FILE_INFO"""
+        s = None
+        try:
+            s = socket.create_connection(endpoint, timeout=client._upload_timeout)
+            r = client.SocketReader(s)
+            s.sendall(client._encode_fields(["FILE_INFO", name]))
+            response_code = r.read_byte()
+            if response_code != 0:
+                return response_code, None, None
+            return 0, int(r.read_string()), r.read_string()
+        except (OSError, TypeError, ValueError):
+            return None, None, None
+        finally:
+            if s is not None:
+                s.close()
 
-                for i in range(num_files):
-                    attempts = 0
-                    filename = None
-                    while attempts < 3 and filename is None:
-                        filename = client.read_string(s)
-                        if filename is None:
-                            time.sleep(0.05)
-                            attempts += 1
+    @staticmethod
+    def _extra_sources(seeders, owner, filename, root):
+        """Otros clientes con una copia del mismo archivo, es decir, con la misma raíz
+        Merkle. Sin raíz no hay forma de comprobar sus bloques, así que se descarga
+        solo del propietario"""
+        if not root:
+            return []
+        return [(endpoint, filename) for username, endpoint, seeder_root in seeders
+                if username not in (owner, client._connected_user) and seeder_root == root]
 
-                    if filename is None:
-                        print(f"LIST_CONTENT FAIL al recibir archivo {i+1}/{num_files}")
-                        return client.RC.ERROR
+    @staticmethod
+    def _peer_manifest(endpoint, name):
+        """Pide a otro cliente el hash de cada bloque de un archivo. Devuelve la lista
+        de hashes o None si no está disponible"""
+        s = None
+        try:
+            s = socket.create_connection(endpoint, timeout=client._upload_timeout)
+            r = client.SocketReader(s)
+            s.sendall(client._encode_fields(["GET_MANIFEST", name]))
+            if r.read_byte() != 0:
+                return None
+            if int(r.read_string()) != client._chunk_size:
+                return None
+            return [r.read_string() for _ in range(int(r.read_string()))]
+        except (OSError, TypeError, ValueError):
+            return None
+        finally:
+            if s is not None:
+                s.close()
 
-                    print(filename)
+    @staticmethod
+    def _fetch_range(s, r, name, offset, length, fd, expected=None):
+        """Descarga un rango por una conexión ya abierta y lo escribe en su posición.
+        Si se indica expected, comprueba el hash del bloque a medida que llega.
+        Devuelve False si el bloque no coincide; como se ha leído entero, la conexión
+        sigue sincronizada. Los errores de la conexión se lanzan como excepción"""
+        s.sendall(client._encode_fields(["GET_RANGE", name, str(offset), str(length)]))
+        if r.read_byte() != 0 or int(r.read_string()) != length:
+            raise OSError("rango rechazado")
+
+        digest = hashlib.sha256()
+        done = 0
+        while done < length:
+            data = r.recv(min(client.SocketReader.CHUNK_SIZE, length - done))
+            if not data:
+                raise OSError("conexión cerrada")
+            os.pwrite(fd, data, offset + done)
+            digest.update(data)
+            done += len(data)
+
+        return expected is None or digest.hexdigest() == expected
 
-                return client.RC.OK
+    @staticmethod
+    def _range_worker(source, pending, lock, failed, fd, size, leaves, on_chunk, mismatches):
+        """Toma bloques pendientes y los descarga de source por una sola conexión. Un
+        bloque que no coincide con su hash en leaves se vuelve a pedir por la misma
+        conexión; mismatches cuenta los fallos de cada (source, bloque) y, tras
+        CHUNK_RETRIES, o si falla la conexión, source se da por perdido y el bloque
+        vuelve a la cola para otro cliente"""
+        endpoint, name = source
+        s = None
+        try:
+            s = socket.create_connection(endpoint, timeout=client._upload_timeout)
+            r = client.SocketReader(s)
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    index = pending.popleft()
+
+                offset = index * client._chunk_size
+                try:
+                    ok = client._fetch_range(s, r, name, offset, min(client._chunk_size, size - offset), fd,
+                                             leaves[index] if leaves else None)
+                except Exception:
+                    with lock:
+                        pending.appendleft(index)
+                    raise
+                if ok:
+                    on_chunk(index)
+                    continue
+                with lock:
+                    pending.appendleft(index)
+                    mismatches[(source, index)] = mismatches.get((source, index), 0) + 1
+                    if mismatches[(source, index)] >= client.CHUNK_RETRIES:
+                        failed.add(source)
+                        return
+        except Exception:
+            with lock:
+                failed.add(source)
+        finally:
+            if s is not None:
+                s.close()
 
-            elif response_code == 2:
-                print("LIST_CONTENT FAIL, USER NOT CONNECTED")
-            elif response_code == 3:
-                print("LIST_CONTENT FAIL, REMOTE USER DOES NOT EXIST")
-            elif response_code == 4:
-                print("LIST_CONTENT FAIL, USER HAS NO FILES")
-                return client.RC.USER_ERROR  # <-- AÑADE ESTE RETURN
-            else:
-                print("LIST_CONTENT FAIL")
+    @staticmethod
+    def _load_checkpoint(path, identity):
+        """Bloques verificados de una descarga anterior del mismo archivo remoto. Si
+        no hay checkpoint o el archivo remoto ha cambiado, devuelve un conjunto vacío"""
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if any(state.get(key) != value for key, value in identity.items()):
+            return set()
+        return set(state.get("done", []))
 
-            return client.RC.ERROR
+    @staticmethod
+    def _save_checkpoint(path, identity, done):
+        """Guarda de forma atómica los bloques ya escritos en el archivo parcial"""
+        verified = sum(min(client._chunk_size, identity["size"] - i * client._chunk_size) for i in done)
+        state = dict(identity, done=sorted(done), verified_bytes=verified)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
 
-        except Exception as e:
-            print("LIST_CONTENT FAIL:", str(e))
-            return client.RC.ERROR
+    @staticmethod
+    def _download_ranges(sources, local_FileName, size, identity, leaves=None):
+        """Divide el archivo en bloques de _chunk_size y los descarga en paralelo por
+        hasta _download_connections conexiones repartidas entre sources. Con leaves
+        (el hash de cada bloque) se verifica cada bloque al recibirlo; si solo se
+        conoce la raíz Merkle (identity["root"]) se verifica el archivo al final.
+
+        Los datos se escriben en <local>.part y cada bloque terminado se apunta en
+        <local>.part.json junto con el origen, el tamaño y el mtime remotos. Si la
+        descarga falla se conservan los dos ficheros y el siguiente GET_FILE del
+        mismo archivo solo pide los bloques que faltan"""
+        part_path = local_FileName + ".part"
+        checkpoint_path = part_path + ".json"
+        num_chunks = (size + client._chunk_size - 1) // client._chunk_size
+
+        done = client._load_checkpoint(checkpoint_path, identity)
+        if done and (not os.path.exists(part_path) or os.path.getsize(part_path) != size):
+            done = set()
+        pending = deque(i for i in range(num_chunks) if i not in done)
+        lock = threading.Lock()
+        failed = set()
+        mismatches = {}
+
+        flags = os.O_WRONLY | os.O_CREAT | (0 if done else os.O_TRUNC)
+        fd = os.open(part_path, flags, 0o644)
+
+        def on_chunk(index):
+            # El bloque solo cuenta como verificado cuando está en disco
+            os.fdatasync(fd)
+            with lock:
+                done.add(index)
+                client._save_checkpoint(checkpoint_path, identity, done)
+
+        try:
+            os.ftruncate(fd, size)
+            if not done:
+                client._save_checkpoint(checkpoint_path, identity, done)
+
+            # Si falla un cliente sus bloques se reparten entre los que quedan
+            while pending:
+                alive = [source for source in sources if source not in failed]
+                if not alive:
+                    return False
+                workers = min(client._download_connections, len(pending))
+                threads = [threading.Thread(target=client._range_worker,
+                                            args=(alive[i % len(alive)], pending, lock, failed, fd, size, leaves, on_chunk,
+                                                  mismatches))
+                           for i in range(workers)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
         finally:
-            s.close()
+            os.close(fd)
 
+        if identity["root"] and not leaves:
+            # Sin manifiesto no se pudo verificar cada bloque: comprobar el archivo entero
+            if client.compute_manifest(part_path)["root"] != identity["root"]:
+                os.remove(part_path)
+                os.remove(checkpoint_path)
+                return False
 
+        os.replace(part_path, local_FileName)
+        os.remove(checkpoint_path)
+        return True
 
     @staticmethod
     def getfile(user, remote_FileName, local_FileName):
         from os.path import basename  # Necesario para extraer solo el nombre del archivo
 
         try:
-            # 1. Verificar que el archivo esté publicado por el usuario remoto
-            s_check = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s_check.connect((client._server, client._port))
-            client.send_string(s_check, "LIST_CONTENT")
-            fecha = client.get_current_datetime()
-            if not client.send_string(s_check, fecha):
+            # 1. Comprobar con una sola petición que el archivo está publicado y
+            #    obtener la dirección del usuario remoto y la de los demás que lo publican
+            # Una ruta absoluta se publicó por su nombre; un nombre relativo (de
+            # PUBLISH_DIR) es ya el nombre publicado
+            published_name = basename(remote_FileName) if os.path.isabs(remote_FileName) else remote_FileName
+            s_check, r_check = client._open_server()
+            request = client._encode_request("LOOKUP_FILE", [client._connected_user, user, published_name])
+            if request is None:
                 print("GET_FILE FAIL")
-                s_check.close()
                 return client.RC.ERROR
+            s_check.sendall(request)
 
-            client.send_string(s_check, client._connected_user)
-            client.send_string(s_check, user)
-            
-            response = s_check.recv(1)
-            if not response or response[0] != 0:
+            response_code = r_check.read_byte()
+            if response_code == 4:
+                print("GET_FILE FAIL, FILE NOT PUBLISHED")
+                return client.RC.USER_ERROR
+            elif response_code == 5:
+                print("GET_FILE FAIL, USER NOT CONNECTED")
+                return client.RC.USER_ERROR
+            elif response_code != 0:
                 print("GET_FILE FAIL, COULD NOT VERIFY FILE")
-                s_check.close()
                 return client.RC.ERROR
 
-            num_files = client.read_string(s_check)
-            if num_files is None:
-                print("GET_FILE FAIL, COULD NOT VERIFY FILE")
-                s_check.close()
-                return client.RC.ERROR
+            ip, port, root = r_check.read_string(), r_check.read_string(), r_check.read_string()
+            user_info = (ip, int(port))
 
-            num_files = int(num_files.strip())
-            found = False
-            for _ in range(num_files):
-                filename = client.read_string(s_check)
+            # Otros usuarios conectados que publican un archivo con el mismo nombre
+            seeders = []
+            for _ in range(int(r_check.read_string())):
+                username, ip, port, seeder_root = (r_check.read_string(), r_check.read_string(),
+                                                   r_check.read_string(), r_check.read_string())
+                seeders.append((username, (ip, int(port)), seeder_root))
 
-                #  CORRECCIÓN: solo comparamos el nombre base, no el path completo
-                if filename == basename(remote_FileName):
-                    found = True
-                    break
+            client._close_server(s_check, r_check)
+            s_check = None
 
-            s_check.close()
-            if not found:
-                print("GET_FILE FAIL, FILE NOT PUBLISHED")
+            # 3. Preguntar al cliente remoto el tamaño y la fecha del archivo
+            response_code, size, mtime = client._peer_file_info(user_info, remote_FileName)
+            if response_code == 1:
+                print("GET_FILE FAIL, FILE NOT EXIST")
                 return client.RC.USER_ERROR
-
-            # 2. Obtener IP y puerto del usuario remoto
-            user_info = None
-            s_list = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s_list.connect((client._server, client._port))
-            client.send_string(s_list, "LIST_USERS")
-            fecha = client.get_current_datetime()
-            if not client.send_string(s_list, fecha):
-                print("GET_FILE FAIL")
-                s_list.close()
-                return client.RC.ERROR
-
-            client.send_string(s_list, client._connected_user)
-            
-            response = s_list.recv(1)
-            if not response or response[0] != 0:
-                print("GET_FILE FAIL")
-                s_list.close()
-                return client.RC.ERROR
-            
-            num_users = client.read_string(s_list)
-            if num_users is None:
+            if response_code == 0:
+                # Hash de cada bloque, válido solo si reproduce la raíz registrada
+                leaves = None
+                if root:
+                    leaves = client._peer_manifest(user_info, remote_FileName)
+                    if leaves is not None and (len(leaves) != -(-size // client._chunk_size)
+                                               or client.merkle_root(leaves) != root):
+                        leaves = None
+
+                # Descargar por rangos en paralelo, también de los demás clientes
+                # que tienen el mismo archivo
+                sources = [(user_info, remote_FileName)]
+                if size > client._chunk_size:
+                    sources += client._extra_sources(seeders, user, published_name, root)
+
+                # Identifica el archivo remoto para poder reanudar la descarga
+                identity = {"owner": user, "remote": remote_FileName, "size": size,
+                            "mtime": mtime, "chunk_size": client._chunk_size, "root": root}
+                if client._download_ranges(sources, local_FileName, size, identity, leaves):
+                    print("GET_FILE OK")
+                    return client.RC.OK
                 print("GET_FILE FAIL")
-                s_list.close()
                 return client.RC.ERROR
-            
-            found = False
-            for _ in range(int(num_users)):
-                username = client.read_string(s_list)
-                ip = client.read_string(s_list)
-                port = client.read_string(s_list)
-                if username == user:
-                    user_info = (ip, int(port))
-                    found = True
-                    break
 
-            s_list.close()
-            if not found:
-                print("GET_FILE FAIL, USER NOT CONNECTED")
-                return client.RC.USER_ERROR
-
-            # 3. Conectar al cliente remoto y solicitar el archivo
+            # 4. El cliente remoto no admite rangos: solicitar el archivo completo
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.connect((user_info[0], user_info[1]))
+            r = client.SocketReader(s)
 
             # Enviamos la ruta completa, como pide el enunciado
             client.send_string(s, "GET_FILE")
             client.send_string(s, remote_FileName)
 
-            response = s.recv(1)
-            if not response:
+            response_code = r.read_byte()
+            if response_code is None:
                 print("GET_FILE FAIL")
                 return client.RC.ERROR
-
-            response_code = response[0]
             if response_code == 0:
-                size_str = client.read_string(s)
+                size_str = r.read_string()
                 if size_str is None:
                     print("GET_FILE FAIL")
                     return client.RC.ERROR
@@ -799,7 +1619,7 @@ class client:
                 received = 0
                 with open(local_FileName, 'wb') as f:
                     while received < size:
-                        data = s.recv(min(4096, size - received))
+                        data = r.recv(min(client.SocketReader.CHUNK_SIZE, size - received))
                         if not data:
                             break
                         f.write(data)
@@ -821,15 +1641,17 @@ class client:
                 print("GET_FILE FAIL")
                 return client.RC.ERROR
 
-        except Exception as e:
+        except Exception:
+            # LOOKUP_FILE a medias: no reutilizar la sesión
+            if locals().get('s_check') is not None and s_check is client._session:
+                client._close_session()
             if 'local_FileName' in locals() and os.path.exists(local_FileName):
                 os.remove(local_FileName)
             print("GET_FILE FAIL")
             return client.RC.ERROR
         finally:
             if 's' in locals(): s.close()
-            if 's_check' in locals(): s_check.close()
-            if 's_list' in locals(): s_list.close()
+            if 's_check' in locals(): client._close_server(s_check, r_check)
 
 
 
@@ -890,6 +1712,42 @@ class client:
                         else:
                             print("Syntax error. Usage: LIST_CONTENT <userName>")
 
+                    elif(line[0]=="SEARCH"):
+                        if (len(line) >= 2):
+                            client.search(line[1:])
+                        else:
+                            print("Syntax error. Usage: SEARCH [-n <maxResults>] <text>")
+
+                    elif(line[0]=="STATS"):
+                        if (len(line) == 1):
+                            client.stats()
+                        else:
+                            print("Syntax error. Use: STATS")
+
+                    elif(line[0]=="PUBLISH_DIR"):
+                        if (len(line) >= 3):
+                            client.publish_dir(line[1], ' '.join(line[2:]))
+                        else:
+                            print("Syntax error. Usage: PUBLISH_DIR <absoluteDirPath> <description>")
+
+                    elif(line[0]=="SUBSCRIBE"):
+                        if (1 <= len(line) <= 3):
+                            client.subscribe(*line[1:])
+                        else:
+                            print("Syntax error. Usage: SUBSCRIBE [<userPattern> [<filePattern>]]")
+
+                    elif(line[0]=="UNSUBSCRIBE"):
+                        if (len(line) == 1):
+                            client.unsubscribe()
+                        else:
+                            print("Syntax error. Use: UNSUBSCRIBE")
+
+                    elif(line[0]=="WATCH"):
+                        if (len(line) == 1):
+                            client.watch()
+                        else:
+                            print("Syntax error. Use: WATCH")
+
                     elif(line[0]=="DISCONNECT"):
                         if (len(line) == 2):
                             client.disconnect(line[1])
@@ -902,6 +1760,12 @@ class client:
                         else:
                             print("Syntax error. Usage: GET_FILE <userName> <remote_fileName> <local_fileName>")
 
+                    elif(line[0]=="PIPELINE"):
+                        if (len(line) >= 2):
+                            client.pipeline(' '.join(line[1:]).split(';'))
+                        else:
+                            print("Syntax error. Usage: PIPELINE <command> ; <command> ...")
+
                     elif(line[0]=="QUIT"):
                         if (len(line) == 1):
                             if client._connected_user:
@@ -918,7 +1782,7 @@ class client:
     # * @brief Prints program usage
     @staticmethod
     def usage():
-        print("Usage: python3 client.py -s <server> -p <port>")
+        print("Usage: python3 client.py -s <server> -p <port> [--session]")
 
     # *
     # * @brief Parses program execution arguments
@@ -927,10 +1791,14 @@ class client:
         parser = argparse.ArgumentParser()
         parser.add_argument('-s', type=str, required=True, help='Server IP')
         parser.add_argument('-p', type=int, required=True, help='Server Port')
+        parser.add_argument('--session', action='store_true', help='Keep one server connection open after CONNECT')
+        parser.add_argument('--max-uploads', type=int, default=client._max_uploads, help='Maximum concurrent uploads to other peers')
+        parser.add_argument('--download-connections', type=int, default=client._download_connections, help='Parallel connections per GET_FILE')
+        parser.add_argument('--upload-timeout', type=float, default=client._upload_timeout, help='Seconds of inactivity before an upload is aborted')
         args = parser.parse_args()
 
         if (args.s is None):
-            parser.error("Usage: python3 client.py -s <server> -p <port>")
+            parser.error("Usage: python3 client.py -s <server> -p <port> [--session]")
             return False
 
         if ((args.p < 1024) or (args.p > 65535)):
@@ -939,6 +1807,14 @@ class client:
         
         client._server = args.s
         client._port = args.p
+        client._session_enabled = args.session
+
+        if (args.max_uploads < 1):
+            parser.error("Error: --max-uploads must be at least 1")
+            return False
+        client._max_uploads = args.max_uploads
+        client._download_connections = max(1, args.download_connections)
+        client._upload_timeout = args.upload_timeout
 
         return True
 
@@ -0,0 +1,339 @@
+"""Consultas sobre el registro estructurado que escribe servidor_rpc (ver
+log_estructurado.c para el formato). Solo se leen los segmentos cuyo intervalo
+de tiempo se solapa con el pedido y, en los segmentos cerrados, los que
+contienen al usuario y la operación buscados; dentro de cada segmento se salta
+al primer registro del intervalo con el índice disperso de instantes.
+
+Ejemplos:
+    python3 consulta_logs.py --user ana --from "01/05/2025 10:00" --to "01/05/2025 12:00"
+    python3 consulta_logs.py --op PUBLISH --count-by hour
+    python3 consulta_logs.py --segments
+"""
+import argparse
+import bisect
+import mmap
+import os
+import re
+import struct
+import sys
+from collections import Counter
+from datetime import datetime
+
+RECORD = struct.Struct("<qqIIII")        # ts_us, fecha, user, op, param_off, param_len
+INDEX_HEADER = struct.Struct("<8sQqqII")  # magic, count, min_ts, max_ts, n_sparse, n_keys
+SPARSE = struct.Struct("<qQ")            # ts_us, registro
+KEY = struct.Struct("<III")              # id, count, first
+POSTING = struct.Struct("<I")
+DICT_ENTRY = struct.Struct("<BH")        # tipo, longitud
+MAGIC = b"P2PSEG1\0"
+DICT_USER, DICT_OP = 0, 1
+SEGMENT_RE = re.compile(r"^segmento-(\d+)\.(rec|idx)$")
+TIME_FORMATS = ("%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d/%m/%Y",
+                "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d")
+
+
+def _map(path):
+    """Proyecta un fichero en memoria (None si no existe o está vacío)"""
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+
+
+def load_dictionary(directory):
+    """Devuelve la lista de (tipo, nombre) por identificador y el índice inverso"""
+    names, ids = [], {}
+    try:
+        with open(os.path.join(directory, "diccionario.dat"), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return names, ids
+    pos = 0
+    while pos + DICT_ENTRY.size <= len(data):
+        kind, length = DICT_ENTRY.unpack_from(data, pos)
+        pos += DICT_ENTRY.size
+        if pos + length > len(data):
+            break
+        name = data[pos:pos + length].decode("utf-8", "replace")
+        pos += length
+        ids[(kind, name)] = len(names)
+        names.append((kind, name))
+    return names, ids
+
+
+class Segment:
+    """Un segmento: registros, parámetros y, si está cerrado, su índice"""
+
+    def __init__(self, directory, number):
+        base = os.path.join(directory, "segmento-%06d" % number)
+        self.number = number
+        self.records = _map(base + ".rec")
+        self.params = _map(base + ".par")
+        self.index = _map(base + ".idx")
+        if self.index is not None and self.index[:8] != MAGIC:
+            self.index = None
+
+        if self.index is not None:
+            _, count, self.min_ts, self.max_ts, self.n_sparse, self.n_keys = INDEX_HEADER.unpack_from(self.index)
+            self.count = count
+        else:
+            # Segmento abierto: los registros están ordenados, basta con el primero y el último
+            self.count = len(self.records) // RECORD.size if self.records is not None else 0
+            self.n_sparse = self.n_keys = 0
+            self.min_ts = self.ts(0) if self.count else 0
+            self.max_ts = self.ts(self.count - 1) if self.count else 0
+        if self.records is None:
+            self.count = 0
+
+    @property
+    def sealed(self):
+        return self.index is not None
+
+    def record(self, i):
+        return RECORD.unpack_from(self.records, i * RECORD.size)
+
+    def ts(self, i):
+        return struct.unpack_from("<q", self.records, i * RECORD.size)[0]
+
+    def column(self, name):
+        """Vista de una columna de los registros: "ts", "user" u "op" """
+        view = memoryview(self.records)[:self.count * RECORD.size]
+        if name == "ts":
+            return view.cast("q")[0::4]
+        return view.cast("I")[4 if name == "user" else 5::8]
+
+    def param(self, offset, length):
+        if self.params is None:
+            return ""
+        return self.params[offset:offset + length].decode("utf-8", "replace")
+
+    def lower_bound(self, ts):
+        """Primer registro con instante >= ts"""
+        lo, hi = 0, self.count
+        if self.n_sparse:
+            # Acotar la búsqueda al bloque del índice disperso
+            a, b = 0, self.n_sparse
+            while a < b:
+                mid = (a + b) // 2
+                if SPARSE.unpack_from(self.index, INDEX_HEADER.size + mid * SPARSE.size)[0] < ts:
+                    a = mid + 1
+                else:
+                    b = mid
+            if a > 0:
+                lo = SPARSE.unpack_from(self.index, INDEX_HEADER.size + (a - 1) * SPARSE.size)[1]
+            if a < self.n_sparse:
+                hi = SPARSE.unpack_from(self.index, INDEX_HEADER.size + a * SPARSE.size)[1]
+        return bisect.bisect_left(self.column("ts"), ts, lo, hi)
+
+    def postings(self, kind, key_id):
+        """Registros que contienen key_id, en orden. Los segmentos cerrados lo
+        leen de su índice; en el abierto se busca en la columna"""
+        if not self.sealed:
+            data = self.column("user" if kind == DICT_USER else "op").tobytes()
+            pattern = POSTING.pack(key_id)
+            found = []
+            i = data.find(pattern)
+            while i >= 0:
+                if i % POSTING.size == 0:
+                    found.append(i // POSTING.size)
+                    i = data.find(pattern, i + POSTING.size)
+                else:
+                    i = data.find(pattern, i + 1)
+            return found
+
+        keys_at = INDEX_HEADER.size + self.n_sparse * SPARSE.size
+        lo, hi = 0, self.n_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            kid, count, first = KEY.unpack_from(self.index, keys_at + mid * KEY.size)
+            if kid < key_id:
+                lo = mid + 1
+            elif kid > key_id:
+                hi = mid
+            else:
+                postings_at = keys_at + self.n_keys * KEY.size
+                start = postings_at + first * POSTING.size
+                return memoryview(self.index)[start:start + count * POSTING.size].cast("I")
+        return []
+
+    def matches(self, start, end, key_ids):
+        """Números, en orden, de los registros del intervalo [start, end) que
+        contienen todas las claves (pares (tipo, identificador))"""
+        first = self.lower_bound(start) if start is not None else 0
+        last = self.lower_bound(end) if end is not None else self.count
+        if not key_ids:
+            return range(first, last)
+
+        # Manda la lista más corta, recortada al intervalo; el resto de claves
+        # se comprueba en su columna
+        lists = [(self.postings(kind, key_id), kind, key_id) for kind, key_id in key_ids]
+        lists.sort(key=lambda item: len(item[0]))
+        shortest = lists[0][0]
+        found = shortest[bisect.bisect_left(shortest, first):bisect.bisect_left(shortest, last)]
+        for _, kind, key_id in lists[1:]:
+            column = self.column("user" if kind == DICT_USER else "op")
+            found = [r for r in found if column[r] == key_id]
+        return found
+
+
+def list_segments(directory):
+    """Genera los segmentos del directorio en orden"""
+    numbers = set()
+    try:
+        for name in os.listdir(directory):
+            m = SEGMENT_RE.match(name)
+            if m:
+                numbers.add(int(m.group(1)))
+    except FileNotFoundError:
+        pass
+    # Se abren de uno en uno para no tener proyectados todos a la vez
+    for n in sorted(numbers):
+        yield Segment(directory, n)
+
+
+def select(directory, names_ids, user=None, op=None, start=None, end=None):
+    """Genera (segmento, registros) con los números de los registros de cada
+    segmento que cumplen los filtros. start y end son instantes en
+    microsegundos"""
+    _, ids = names_ids
+    key_ids = []
+    for kind, value in ((DICT_USER, user), (DICT_OP, op)):
+        if value is not None:
+            if (kind, value) not in ids:
+                return      # Nunca ha aparecido: ningún registro puede cumplirlo
+            key_ids.append((kind, ids[(kind, value)]))
+
+    for seg in list_segments(directory):
+        if seg.count == 0:
+            continue
+        if (start is not None and seg.max_ts < start) or (end is not None and seg.min_ts >= end):
+            continue
+        if seg.sealed and any(len(seg.postings(kind, key_id)) == 0 for kind, key_id in key_ids):
+            continue
+        found = seg.matches(start, end, key_ids)
+        if len(found):
+            yield seg, found
+
+
+def query(directory, user=None, op=None, start=None, end=None):
+    """Genera (ts_us, fecha, usuario, operación, parámetro) de los registros que
+    cumplen los filtros"""
+    names_ids = load_dictionary(directory)
+    names = names_ids[0]
+    for seg, found in select(directory, names_ids, user, op, start, end):
+        for i in found:
+            ts, fecha, uid, oid, poff, plen = seg.record(i)
+            yield (ts, fecha,
+                   names[uid][1] if uid < len(names) else "?",
+                   names[oid][1] if oid < len(names) else "?",
+                   seg.param(poff, plen))
+
+
+def count(directory, count_by=None, user=None, op=None, start=None, end=None):
+    """Cuenta los registros que cumplen los filtros, en total (count_by None)
+    o por grupo: "hour", "day", "user" u "op". Trabaja sobre las columnas sin
+    decodificar cada registro"""
+    names_ids = load_dictionary(directory)
+    names = names_ids[0]
+    counts = Counter()
+    for seg, found in select(directory, names_ids, user, op, start, end):
+        if count_by is None:
+            counts[None] += len(found)
+            continue
+        if count_by in ("user", "op"):
+            column = seg.column(count_by).tolist()
+            counts.update(column[r] for r in found)
+            continue
+        # Por cuartos de hora: así los grupos en hora local salen exactos en
+        # cualquier zona horaria
+        column = seg.column("ts").tolist()
+        counts.update(column[r] // 900000000 for r in found)
+
+    if count_by is None:
+        return counts[None]
+    grouped = Counter()
+    if count_by in ("user", "op"):
+        for key_id, n in counts.items():
+            grouped[names[key_id][1] if key_id < len(names) else "?"] += n
+        return grouped
+    fmt = "%d/%m/%Y %H:00" if count_by == "hour" else "%d/%m/%Y"
+    for quarter in sorted(counts):
+        grouped[datetime.fromtimestamp(quarter * 900).strftime(fmt)] += counts[quarter]
+    return grouped
+
+
+def parse_time(text):
+    for fmt in TIME_FORMATS:
+        try:
+            return int(datetime.strptime(text, fmt).timestamp() * 1000000)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid date: %s (use dd/mm/YYYY [HH:MM[:SS]])" % text)
+
+
+def format_time(seconds):
+    return datetime.fromtimestamp(seconds).strftime("%d/%m/%Y %H:%M:%S")
+
+
+def print_segments(directory):
+    print("%-8s %-8s %10s  %-19s  %-19s" % ("SEGMENT", "STATE", "RECORDS", "FROM", "TO"))
+    for seg in list_segments(directory):
+        if seg.records is None:
+            continue
+        print("%-8d %-8s %10d  %-19s  %-19s" % (
+            seg.number, "sealed" if seg.sealed else "open", seg.count,
+            format_time(seg.min_ts / 1000000) if seg.count else "-",
+            format_time(seg.max_ts / 1000000) if seg.count else "-"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the structured operation log written by servidor_rpc")
+    parser.add_argument("-d", "--dir", default=os.environ.get("LOG_SEGMENT_DIR", "logs_estructurados"),
+                        help="log directory (default: $LOG_SEGMENT_DIR or logs_estructurados)")
+    parser.add_argument("--user", help="only operations of this user")
+    parser.add_argument("--op", help="only this operation (REGISTER, PUBLISH, ...)")
+    parser.add_argument("--from", dest="start", type=parse_time, help="received at or after this date")
+    parser.add_argument("--to", dest="end", type=parse_time, help="received before this date")
+    parser.add_argument("--count-by", choices=("hour", "day", "user", "op"),
+                        help="print counts per group instead of the operations")
+    parser.add_argument("--count", action="store_true", help="print only the number of operations")
+    parser.add_argument("--limit", type=int, help="print at most this many operations")
+    parser.add_argument("--segments", action="store_true", help="list the segments and exit")
+    args = parser.parse_args()
+
+    if args.segments:
+        print_segments(args.dir)
+        return
+
+    if args.count:
+        print(count(args.dir, None, args.user, args.op, args.start, args.end))
+    elif args.count_by:
+        counts = count(args.dir, args.count_by, args.user, args.op, args.start, args.end)
+        if args.count_by in ("user", "op"):
+            keys = sorted(counts, key=lambda k: (-counts[k], k))
+        else:
+            keys = counts   # Ya en orden cronológico
+        for key in keys:
+            print("%s\t%d" % (key, counts[key]))
+    else:
+        out = sys.stdout
+        rows = query(args.dir, args.user, args.op, args.start, args.end)
+        for n, (ts, fecha, user, op, param) in enumerate(rows):
+            if args.limit is not None and n >= args.limit:
+                break
+            when = format_time(fecha) if fecha >= 0 else format_time(ts / 1000000)
+            # Mismo formato que logs.txt
+            if op in ("PUBLISH", "DELETE"):
+                out.write("[%s] %s -> %s %s\n" % (when, user, op, param))
+            else:
+                out.write("[%s] %s -> %s\n" % (when, user, op))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except BrokenPipeError:
+        sys.exit(0)
@@ -1,41 +1,495 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <stdbool.h>
+#include <pthread.h>
+#include <time.h>
+#include <errno.h>
 #include "claves_rpc.h"
 
-// Función para registrar una operación en el servidor RPC
-int registrar_log_rpc(const char *usuario, const char *operacion, const char *param1, const char *fecha) {
-    CLIENT *clnt;
-    int *result;
+// Registro asíncrono de operaciones: registrar_log_rpc solo copia la entrada a
+// una cola acotada en memoria y vuelve. Un hilo en segundo plano la vacía por
+// lotes y envía cada lote al servidor RPC en una sola llamada (log_operations,
+// versión 2; con servidores que solo tienen la versión 1, una llamada por
+// entrada) con un único cliente persistente,
+// que se vuelve a crear (con espera creciente) si la conexión falla. Cuando la
+// cola está llena se aplica la política configurada:
+//   drop:  la entrada se descarta y se cuenta
+//   block: registrar_log_rpc espera a que haya sitio
+//   spill: la entrada se añade a un fichero y se reenvía cuando la cola se vacía
 
-    // Conexión al servidor RPC en localhost
-    clnt = clnt_create("localhost", CLAVESRPC_PROG, CLAVESRPC_VERS, "tcp");
-    if (clnt == NULL) {
-        clnt_pcreateerror("Error al crear cliente RPC");
+#define LOG_DEFAULT_CAPACITY 4096
+#define LOG_BATCH 256                   // Entradas que el hilo saca de la cola de una vez
+#define LOG_CALL_TIMEOUT 5              // Segundos por llamada RPC
+#define LOG_RETRY_MIN_MS 100
+#define LOG_RETRY_MAX_MS 5000
+#define LOG_DEFAULT_SPILL "logs_pendientes.txt"
+
+typedef enum { POLICY_DROP, POLICY_BLOCK, POLICY_SPILL } LogPolicy;
+
+// Entrada de la cola: los cuatro campos van seguidos en un solo bloque
+typedef struct {
+    char *usuario;
+    char *operacion;
+    char *param1;
+    char *fecha;
+    char data[];
+} LogItem;
+
+static LogItem **queue = NULL;          // Cola circular
+static int queue_capacity = 0;
+static int queue_head = 0;
+static int queue_count = 0;
+static LogPolicy policy = POLICY_DROP;
+static char spill_path[256] = LOG_DEFAULT_SPILL;
+static FILE *spill_fp = NULL;           // Abierto mientras haya entradas sin reenviar
+static long spill_offset = 0;           // Parte del fichero ya reenviada
+static bool stopping = false;
+
+static pthread_mutex_t queue_mutex = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t not_empty = PTHREAD_COND_INITIALIZER;
+static pthread_cond_t not_full = PTHREAD_COND_INITIALIZER;
+static pthread_cond_t stop_cond = PTHREAD_COND_INITIALIZER;
+static pthread_t sender;
+static bool started = false;
+
+// Contadores (protegidos por queue_mutex)
+static unsigned long long count_queued = 0;
+static unsigned long long count_sent = 0;
+static unsigned long long count_dropped = 0;
+static unsigned long long count_spilled = 0;
+static unsigned long long count_retries = 0;
+
+static CLIENT *clnt = NULL;             // Solo lo usa el hilo de envío
+static bool batch_supported = false;    // clnt es de la versión con lotes
+
+static void *sender_thread(void *arg);
+
+// Arranca el hilo de envío. policy_name es "drop", "block" o "spill"; path es
+// el fichero de desbordamiento (NULL para el de por defecto). Si no se llama,
+// la primera entrada lo arranca con los valores por defecto.
+int log_rpc_start(int capacity, const char *policy_name, const char *path) {
+    pthread_mutex_lock(&queue_mutex);
+    if (started || stopping) {
+        pthread_mutex_unlock(&queue_mutex);
+        return started ? 0 : -1;
+    }
+
+    if (policy_name == NULL || strcmp(policy_name, "drop") == 0) {
+        policy = POLICY_DROP;
+    } else if (strcmp(policy_name, "block") == 0) {
+        policy = POLICY_BLOCK;
+    } else if (strcmp(policy_name, "spill") == 0) {
+        policy = POLICY_SPILL;
+    } else {
+        pthread_mutex_unlock(&queue_mutex);
         return -1;
     }
+    if (path != NULL) {
+        snprintf(spill_path, sizeof(spill_path), "%s", path);
+    }
+
+    queue_capacity = (capacity > 0) ? capacity : LOG_DEFAULT_CAPACITY;
+    queue = calloc(queue_capacity, sizeof(LogItem *));
+    if (queue == NULL) {
+        pthread_mutex_unlock(&queue_mutex);
+        return -1;
+    }
+
+    // Entradas que quedaron en el fichero de una ejecución anterior
+    if (policy == POLICY_SPILL) {
+        spill_fp = fopen(spill_path, "a+");
+        if (spill_fp != NULL) {
+            fseek(spill_fp, 0, SEEK_END);
+            if (ftell(spill_fp) == 0) {
+                fclose(spill_fp);
+                spill_fp = NULL;
+            }
+        }
+    }
+
+    if (pthread_create(&sender, NULL, sender_thread, NULL) != 0) {
+        free(queue);
+        queue = NULL;
+        pthread_mutex_unlock(&queue_mutex);
+        return -1;
+    }
+    started = true;
+    pthread_mutex_unlock(&queue_mutex);
+    return 0;
+}
+
+static LogItem *item_create(const char *usuario, const char *operacion, const char *param1, const char *fecha) {
+    size_t lu = strlen(usuario) + 1, lo = strlen(operacion) + 1;
+    size_t lp = strlen(param1) + 1, lf = strlen(fecha) + 1;
+    LogItem *item = malloc(sizeof(LogItem) + lu + lo + lp + lf);
+    if (item == NULL) {
+        return NULL;
+    }
+    item->usuario = memcpy(item->data, usuario, lu);
+    item->operacion = memcpy(item->usuario + lu, operacion, lo);
+    item->param1 = memcpy(item->operacion + lo, param1, lp);
+    item->fecha = memcpy(item->param1 + lp, fecha, lf);
+    return item;
+}
+
+// Añade una entrada al fichero de desbordamiento, una por línea con los campos
+// separados por '\0' (los campos del protocolo no pueden contener '\0' ni '\n').
+// Se llama con queue_mutex tomado.
+static int spill_write(const LogItem *item) {
+    if (spill_fp == NULL) {
+        spill_fp = fopen(spill_path, "a+"); // Las escrituras siempre van al final
+        spill_offset = 0;
+        if (spill_fp == NULL) {
+            return -1;
+        }
+    }
+    fprintf(spill_fp, "%s%c%s%c%s%c%s\n", item->usuario, '\0', item->operacion, '\0',
+            item->param1, '\0', item->fecha);
+    return fflush(spill_fp);
+}
 
-    // Crear la entrada de log
-    struct log_entry entrada;
-    entrada.usuario = strdup(usuario);
-    entrada.operacion = strdup(operacion);
-    entrada.fecha = strdup(fecha);
+// Encola una operación para registrarla en el servidor RPC. Devuelve -1 si la
+// entrada se ha descartado.
+int registrar_log_rpc(const char *usuario, const char *operacion, const char *param1, const char *fecha) {
+    if (!started && log_rpc_start(0, NULL, NULL) < 0) {
+        return -1; // Ya se ha llamado a log_rpc_stop
+    }
 
     // Si param1 es NULL, se pasa como cadena vacía
-    entrada.param1 = (param1 == NULL) ? strdup("\0") : strdup(param1);
+    LogItem *item = item_create(usuario, operacion, (param1 == NULL) ? "" : param1, fecha);
+
+    pthread_mutex_lock(&queue_mutex);
+    if (item == NULL) {
+        count_dropped++;
+        pthread_mutex_unlock(&queue_mutex);
+        return -1;
+    }
+
+    while (policy == POLICY_BLOCK && queue_count == queue_capacity && !stopping) {
+        pthread_cond_wait(&not_full, &queue_mutex);
+    }
+
+    int result = 0;
+    if (queue_count < queue_capacity && !stopping) {
+        queue[(queue_head + queue_count) % queue_capacity] = item;
+        queue_count++;
+        count_queued++;
+        pthread_cond_signal(&not_empty);
+        item = NULL;
+    } else if (policy == POLICY_SPILL && spill_write(item) == 0) {
+        count_spilled++;
+    } else {
+        count_dropped++;
+        result = -1;
+    }
+    pthread_mutex_unlock(&queue_mutex);
+
+    free(item);
+    return result;
+}
+
+// Espera ms milisegundos antes de reintentar, o menos si se llama a log_rpc_stop
+static void wait_retry(int ms) {
+    struct timespec deadline;
+    clock_gettime(CLOCK_REALTIME, &deadline);
+    deadline.tv_sec += ms / 1000;
+    deadline.tv_nsec += (ms % 1000) * 1000000L;
+    if (deadline.tv_nsec >= 1000000000L) {
+        deadline.tv_sec++;
+        deadline.tv_nsec -= 1000000000L;
+    }
+
+    pthread_mutex_lock(&queue_mutex);
+    while (!stopping && pthread_cond_timedwait(&stop_cond, &queue_mutex, &deadline) != ETIMEDOUT) {
+    }
+    pthread_mutex_unlock(&queue_mutex);
+}
 
-    // Llamar a la función remota
-    result = log_operation_1(&entrada, clnt);
+// Crea el cliente persistente. Se prefiere la versión que admite lotes; si el
+// servidor RPC solo tiene la versión 1, se hace una llamada por entrada.
+static int rpc_connect(void) {
+    clnt = clnt_create("localhost", CLAVESRPC_PROG, CLAVESRPC_VERS_BATCH, "tcp");
+    batch_supported = (clnt != NULL);
+    if (clnt == NULL) {
+        clnt = clnt_create("localhost", CLAVESRPC_PROG, CLAVESRPC_VERS, "tcp");
+        if (clnt == NULL) {
+            return -1;
+        }
+    }
+    struct timeval timeout = { LOG_CALL_TIMEOUT, 0 };
+    clnt_control(clnt, CLSET_TIMEOUT, (char *)&timeout);
+    return 0;
+}
 
-    if (result == NULL) {
-        clnt_perror(clnt, "Error al invocar log_operation");
+// Envía entradas por el cliente persistente, creándolo si hace falta.
+// Devuelve cuántas se enviaron antes del primer error.
+static int send_entries(struct log_entry *entries, int count) {
+    if (clnt == NULL && rpc_connect() < 0) {
+        return 0;
+    }
+
+    int sent = 0;
+    if (batch_supported) {
+        log_batch batch;
+        batch.log_batch_len = count;
+        batch.log_batch_val = entries;
+        if (log_operations_2(&batch, clnt) != NULL) {
+            sent = count;
+        }
+    } else {
+        while (sent < count && log_operation_1(&entries[sent], clnt) != NULL) {
+            sent++;
+        }
+    }
+
+    if (sent < count) {
         clnt_destroy(clnt);
-        return -1;
+        clnt = NULL;
+    }
+    return sent;
+}
+
+// Reintenta hasta enviar todas las entradas o hasta que el servidor se está
+// cerrando. Devuelve cuántas se enviaron.
+static int send_with_retry(struct log_entry *entries, int count) {
+    int wait_ms = LOG_RETRY_MIN_MS;
+    bool reported = false;
+    int sent = 0;
+
+    for (;;) {
+        sent += send_entries(entries + sent, count - sent);
+        if (sent == count) {
+            return sent;
+        }
+
+        pthread_mutex_lock(&queue_mutex);
+        count_retries++;
+        bool stop = stopping;
+        pthread_mutex_unlock(&queue_mutex);
+        if (stop) {
+            return sent;
+        }
+        if (!reported) {
+            fprintf(stderr, "s> Servidor RPC no disponible, reintentando el registro\n");
+            reported = true;
+        }
+        wait_retry(wait_ms);
+        wait_ms = (wait_ms * 2 > LOG_RETRY_MAX_MS) ? LOG_RETRY_MAX_MS : wait_ms * 2;
+    }
+}
+
+// Reenvía las entradas del fichero de desbordamiento, por lotes. Se llama sin
+// el cerrojo y con la cola vacía; las nuevas entradas que desborden mientras
+// tanto se añaden al final del mismo fichero.
+static void replay_spill(void) {
+    char *lines[LOG_BATCH] = { NULL };
+    size_t caps[LOG_BATCH] = { 0 };
+    long ends[LOG_BATCH];
+    struct log_entry entries[LOG_BATCH];
+
+    for (;;) {
+        pthread_mutex_lock(&queue_mutex);
+        if (spill_fp == NULL || queue_count > 0) {
+            pthread_mutex_unlock(&queue_mutex);
+            break;
+        }
+
+        // Leer hasta LOG_BATCH líneas: usuario\0operacion\0param1\0fecha\n
+        fseek(spill_fp, spill_offset, SEEK_SET);
+        int n = 0;
+        ssize_t len;
+        while (n < LOG_BATCH && (len = getline(&lines[n], &caps[n], spill_fp)) > 0) {
+            ends[n] = ftell(spill_fp);
+            char *line = lines[n];
+            line[len - 1] = '\0';
+            char *fields[4];
+            int nf = 0;
+            for (char *p = line; nf < 4 && p < line + len; p += strlen(p) + 1) {
+                fields[nf++] = p;
+            }
+            if (nf < 4) {
+                spill_offset = ends[n]; // Línea incompleta: se salta
+                continue;
+            }
+            entries[n].usuario = fields[0];
+            entries[n].operacion = fields[1];
+            entries[n].param1 = fields[2];
+            entries[n].fecha = fields[3];
+            n++;
+        }
+        if (n == 0) {
+            // Todo reenviado: el fichero se elimina
+            fclose(spill_fp);
+            spill_fp = NULL;
+            spill_offset = 0;
+            remove(spill_path);
+            pthread_mutex_unlock(&queue_mutex);
+            break;
+        }
+        pthread_mutex_unlock(&queue_mutex);
+
+        int sent = send_with_retry(entries, n);
+
+        pthread_mutex_lock(&queue_mutex);
+        if (sent > 0) {
+            spill_offset = ends[sent - 1];
+        }
+        count_sent += sent;
+        pthread_mutex_unlock(&queue_mutex);
+        if (sent < n) {
+            break;
+        }
+    }
+
+    for (int i = 0; i < LOG_BATCH; i++) {
+        free(lines[i]);
     }
+}
+
+static void *sender_thread(void *arg) {
+    LogItem *batch[LOG_BATCH];
+
+    for (;;) {
+        pthread_mutex_lock(&queue_mutex);
+        while (queue_count == 0 && !stopping && spill_fp == NULL) {
+            pthread_cond_wait(&not_empty, &queue_mutex);
+        }
+        if (queue_count == 0 && stopping) {
+            pthread_mutex_unlock(&queue_mutex);
+            break;
+        }
+
+        // Sacar un lote completo de una vez
+        int n = 0;
+        while (n < LOG_BATCH && queue_count > 0) {
+            batch[n++] = queue[queue_head];
+            queue_head = (queue_head + 1) % queue_capacity;
+            queue_count--;
+        }
+        pthread_cond_broadcast(&not_full);
+        pthread_mutex_unlock(&queue_mutex);
+
+        if (n == 0) {
+            replay_spill();
+            continue;
+        }
+
+        struct log_entry entries[LOG_BATCH];
+        for (int i = 0; i < n; i++) {
+            entries[i].usuario = batch[i]->usuario;
+            entries[i].operacion = batch[i]->operacion;
+            entries[i].param1 = batch[i]->param1;
+            entries[i].fecha = batch[i]->fecha;
+        }
+        int sent = send_with_retry(entries, n);
+
+        pthread_mutex_lock(&queue_mutex);
+        count_sent += sent;
+        // Cerrando sin servidor RPC: lo que no se pudo enviar va al fichero o se pierde
+        for (int i = sent; i < n; i++) {
+            if (policy == POLICY_SPILL && spill_write(batch[i]) == 0) {
+                count_spilled++;
+            } else {
+                count_dropped++;
+            }
+        }
+        pthread_mutex_unlock(&queue_mutex);
+
+        for (int i = 0; i < n; i++) {
+            free(batch[i]);
+        }
+    }
+
+    if (clnt != NULL) {
+        clnt_destroy(clnt);
+        clnt = NULL;
+    }
+    return NULL;
+}
+
+// Quita del fichero de desbordamiento las entradas ya reenviadas, para que la
+// siguiente ejecución no las repita. Se llama con queue_mutex tomado.
+static void spill_compact(void) {
+    if (spill_offset == 0) {
+        return;
+    }
+    char tmp_path[sizeof(spill_path) + 4];
+    snprintf(tmp_path, sizeof(tmp_path), "%s.tmp", spill_path);
+    FILE *tmp = fopen(tmp_path, "w");
+    if (tmp == NULL) {
+        return;
+    }
+
+    char chunk[8192];
+    size_t n;
+    fseek(spill_fp, spill_offset, SEEK_SET);
+    while ((n = fread(chunk, 1, sizeof(chunk), spill_fp)) > 0) {
+        fwrite(chunk, 1, n, tmp);
+    }
+    if (fclose(tmp) == 0) {
+        rename(tmp_path, spill_path);
+    }
+    spill_offset = 0;
+}
+
+// Envía lo que quede en la cola y para el hilo de envío. Si el servidor RPC no
+// responde, las entradas pendientes se vuelcan al fichero (spill) o se descartan.
+void log_rpc_stop(void) {
+    pthread_mutex_lock(&queue_mutex);
+    if (!started) {
+        pthread_mutex_unlock(&queue_mutex);
+        return;
+    }
+    stopping = true;
+    pthread_cond_broadcast(&not_empty);
+    pthread_cond_broadcast(&not_full);
+    pthread_cond_broadcast(&stop_cond);
+    pthread_mutex_unlock(&queue_mutex);
+
+    pthread_join(sender, NULL);
+
+    pthread_mutex_lock(&queue_mutex);
+    while (queue_count > 0) {
+        LogItem *item = queue[queue_head];
+        queue_head = (queue_head + 1) % queue_capacity;
+        queue_count--;
+        if (policy == POLICY_SPILL && spill_write(item) == 0) {
+            count_spilled++;
+        } else {
+            count_dropped++;
+        }
+        free(item);
+    }
+    if (spill_fp != NULL) {
+        spill_compact();
+        fclose(spill_fp);
+        spill_fp = NULL;
+    }
+    started = false;
+    pthread_mutex_unlock(&queue_mutex);
+}
+
+// Imprime el estado de la cola de registro junto con las estadísticas del servidor
+void log_rpc_print_stats(void) {
+    pthread_mutex_lock(&queue_mutex);
+    printf("s> LOG RPC: queued=%llu sent=%llu pending=%d/%d dropped=%llu spilled=%llu retries=%llu\n",
+           count_queued, count_sent, queue_count, queue_capacity,
+           count_dropped, count_spilled, count_retries);
+    pthread_mutex_unlock(&queue_mutex);
+    fflush(stdout);
+}
 
-    free(entrada.usuario);
-    free(entrada.operacion);
-    free(entrada.fecha);
-    clnt_destroy(clnt);
-    return (result != NULL) ? *result : -1;
+// Contadores de la cola para las métricas del servidor, en el orden de
+// log_rpc_print_stats: queued, sent, pending, capacity, dropped, spilled, retries
+void log_rpc_counters(unsigned long long counters[7]) {
+    pthread_mutex_lock(&queue_mutex);
+    counters[0] = count_queued;
+    counters[1] = count_sent;
+    counters[2] = queue_count;
+    counters[3] = queue_capacity;
+    counters[4] = count_dropped;
+    counters[5] = count_spilled;
+    counters[6] = count_retries;
+    pthread_mutex_unlock(&queue_mutex);
 }
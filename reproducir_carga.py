@@ -0,0 +1,426 @@
+"""Reproduce contra un servidor local la secuencia de operaciones de un registro,
+para repetir en un portátil la forma de la carga real. Lee tres formatos:
+
+  --capture FICHERO  captura de server -c: todos los campos de cada petición y
+                     su instante de llegada en microsegundos
+  --segments DIR     registro estructurado de servidor_rpc: instante de llegada
+                     en microsegundos y solo el primer parámetro
+  --logs FICHERO     logs.txt: fecha del cliente en segundos y solo el nombre
+                     del fichero de PUBLISH y DELETE
+
+Con --segments y --logs los parámetros que faltan se completan: la descripción
+de PUBLISH es fija, LIST_CONTENT sin destino lista al propio usuario y
+LOOKUP_FILE y DELETE sin nombre usan el último fichero que el dueño ha publicado
+en la reproducción.
+Las operaciones que no se pueden completar (SET_HASH sin raíz) se omiten y se
+cuentan. PUBLISH_DIR y SUBSCRIBE se omiten siempre. CONNECT anuncia el puerto de
+un socket de escucha de la herramienta. Los cursores y versiones de los
+listados paginados e incrementales se sustituyen por los que ha devuelto el
+servidor en la reproducción.
+
+Las operaciones de cada usuario se envían en su orden original. Los usuarios se
+reparten entre --threads hilos que avanzan a la vez, así que las operaciones de
+usuarios distintos pueden cruzarse de otra forma que en el registro. El ritmo es
+el original (--speed 1), acelerado (--speed N) o tan rápido como sea posible
+(--fast). --max-gap acorta los periodos sin actividad.
+
+Ejemplos:
+    python3 reproducir_carga.py --capture captura.bin -p 8080 --speed 10
+    python3 reproducir_carga.py --logs logs.txt -p 8080 --fast --prefix r1_
+    python3 reproducir_carga.py --segments logs_estructurados -p 8080 --max-gap 1 --output r.json
+"""
+import argparse
+import json
+import re
+import socket
+import sys
+import threading
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime
+
+from client import client
+
+# ts: segundos desde epoch; params incluye el usuario
+Operation = namedtuple("Operation", "ts command fecha params")
+
+LOG_LINE_RE = re.compile(r"^\[(\d\d/\d\d/\d{4} \d\d:\d\d:\d\d)\] (.*) -> (\S+)(?: (.*))?$")
+DEFAULT_DESCRIPTION = "replay"
+DEFAULT_SEARCH_LIMIT = "20"
+DEFAULT_PAGE_SIZE = "1000"
+FIRST_CURSOR = "0:"
+UNKNOWN = None      # Parámetro que se completa durante la reproducción
+SKIPPED = ("PUBLISH_DIR", "SUBSCRIBE")
+
+# Parámetros (además del primero) que son nombres de usuario, para --prefix
+USER_PARAMS = {"LIST_CONTENT": (1,), "LOOKUP_FILE": (1,), "LIST_CONTENT_PAGE": (1,),
+               "LIST_CONTENT_CHANGES": (1,)}
+
+# Campos de una respuesta con éxito: (campos fijos, campos por entrada) o None
+# si solo tiene el código. Con 0 campos por entrada no hay lista ni número de entradas
+REPLY_SHAPES = {
+    "LIST_USERS": (0, 3),
+    "LIST_CONTENT": (0, 1),
+    "LOOKUP_FILE": (3, 4),
+    "SEARCH": (0, 3),
+    "LIST_USERS_PAGE": (2, 3),          # versión, cursor
+    "LIST_CONTENT_PAGE": (2, 1),
+    "LIST_USERS_CHANGES": (1, 4),       # versión
+    "LIST_CONTENT_CHANGES": (1, 2),
+    "STATS": (1, 0),                    # métricas en texto
+}
+
+
+def complete_params(command, user, param):
+    """Parámetros de una operación de la que solo se conoce el primero (o
+    ninguno). Devuelve None si no se puede reproducir"""
+    if command in ("REGISTER", "UNREGISTER", "DISCONNECT", "LIST_USERS"):
+        return [user]
+    if command == "CONNECT":
+        return [user, UNKNOWN]
+    if command == "PUBLISH":
+        return [user, param or user + "-fichero", DEFAULT_DESCRIPTION]
+    if command == "DELETE":
+        return [user, param or UNKNOWN]
+    if command == "LIST_CONTENT":
+        return [user, param or user]
+    if command == "LOOKUP_FILE":
+        return [user, param, UNKNOWN] if param else None
+    if command == "SEARCH":
+        return [user, param, DEFAULT_SEARCH_LIMIT] if param else None
+    if command == "LIST_USERS_PAGE":
+        return [user, FIRST_CURSOR, DEFAULT_PAGE_SIZE]
+    if command == "LIST_CONTENT_PAGE":
+        return [user, param or user, FIRST_CURSOR, DEFAULT_PAGE_SIZE]
+    if command == "LIST_USERS_CHANGES":
+        return [user, UNKNOWN]
+    if command == "LIST_CONTENT_CHANGES":
+        return [user, param or user, UNKNOWN]
+    return None
+
+
+def read_capture(path, skipped):
+    """Operaciones de una captura de server -c. Un registro incompleto al final
+    (el servidor murió mientras escribía) se ignora"""
+    with open(path, "rb") as f:
+        fields = f.read().split(b"\0")
+    pos = 0
+    while pos + 4 <= len(fields) - 1:
+        try:
+            ts, command, fecha, n = (fields[pos].decode(), fields[pos + 1].decode(),
+                                     fields[pos + 2].decode(), int(fields[pos + 3]))
+        except ValueError:
+            break
+        if pos + 4 + n > len(fields) - 1:
+            break
+        params = [p.decode("utf-8", "replace") for p in fields[pos + 4:pos + 4 + n]]
+        pos += 4 + n
+        if command in SKIPPED:
+            skipped[command] = skipped.get(command, 0) + 1
+            continue
+        if command == "CONNECT":
+            params[1] = UNKNOWN
+        elif command in ("LIST_USERS_CHANGES", "LIST_CONTENT_CHANGES"):
+            params[-1] = UNKNOWN
+        elif command in ("LIST_USERS_PAGE", "LIST_CONTENT_PAGE") and params[-2] != FIRST_CURSOR:
+            params[-2] = UNKNOWN
+        yield Operation(int(ts) / 1e6, command, fecha, params)
+
+
+def _from_log(ts, fecha, user, command, param, skipped):
+    params = None if command in SKIPPED else complete_params(command, user, param)
+    if params is None:
+        skipped[command] = skipped.get(command, 0) + 1
+        return None
+    return Operation(ts, command, fecha, params)
+
+
+def read_text_log(path, skipped):
+    """Operaciones de logs.txt, en el orden del fichero"""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            m = LOG_LINE_RE.match(line.rstrip("\n"))
+            if m is None:
+                continue
+            fecha, user, command, param = m.groups()
+            try:
+                ts = datetime.strptime(fecha, "%d/%m/%Y %H:%M:%S").timestamp()
+            except ValueError:
+                continue
+            op = _from_log(ts, fecha, user, command, param, skipped)
+            if op is not None:
+                yield op
+
+
+def read_segments(directory, skipped):
+    """Operaciones del registro estructurado, en orden de llegada"""
+    import consulta_logs
+    for ts, fecha, user, command, param in consulta_logs.query(directory):
+        fecha = consulta_logs.format_time(fecha if fecha >= 0 else ts / 1e6)
+        op = _from_log(ts / 1e6, fecha, user, command, param or None, skipped)
+        if op is not None:
+            yield op
+
+
+def schedule(operations, speed, max_gap):
+    """Instante de envío de cada operación, en segundos desde el inicio"""
+    offsets = []
+    elapsed = 0.0
+    previous = None
+    for op in operations:
+        if previous is not None:
+            gap = max(0.0, op.ts - previous)
+            elapsed += min(gap, max_gap) if max_gap is not None else gap
+        previous = op.ts
+        offsets.append(elapsed / speed if speed else 0.0)
+    return offsets
+
+
+def percentile(values, p):
+    """Percentil por rango más cercano de una lista ordenada"""
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+class Replayer:
+    """Envía las operaciones de un conjunto de usuarios en su orden y guarda la
+    latencia y el código de cada una"""
+
+    def __init__(self, args, listen_port, published, published_lock):
+        self.args = args
+        self.listen_port = str(listen_port)
+        self.published = published          # Usuario -> ficheros publicados en la reproducción
+        self.published_lock = published_lock
+        self.listings = {}                  # (comando, usuario, destino) -> (versión, cursor)
+        self.sock = None
+        self.reader = None
+        self.latencies = {}
+        self.codes = {}
+        self.lags = []
+        self.skipped = {}
+
+    def _open(self):
+        if self.sock is not None:
+            return self.sock, self.reader
+        s = socket.create_connection((self.args.s, self.args.p))
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        r = client.SocketReader(s)
+        if self.args.session:
+            self.sock, self.reader = s, r
+        return s, r
+
+    def _drop_session(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = self.reader = None
+
+    def _resolve(self, op):
+        """Completa los parámetros que dependen de la reproducción. Devuelve None
+        si la operación no se puede enviar"""
+        params = list(op.params)
+        command = op.command
+        if command == "CONNECT":
+            params[1] = self.listen_port
+        elif command in ("LOOKUP_FILE", "DELETE") and params[-1] is UNKNOWN:
+            owner = params[1] if command == "LOOKUP_FILE" else params[0]
+            with self.published_lock:
+                names = self.published.get(owner)
+                if not names:
+                    return None
+                params[-1] = next(reversed(names))
+        elif command.endswith("_CHANGES"):
+            family = command.replace("_CHANGES", "")
+            state = self.listings.get((family, params[0], params[1] if len(params) > 2 else None))
+            if state is None:
+                return None
+            params[-1] = state[0]
+        elif command.endswith("_PAGE") and params[-2] is UNKNOWN:
+            family = command.replace("_PAGE", "")
+            state = self.listings.get((family, params[0], params[1] if len(params) > 3 else None))
+            params[-2] = state[1] if state is not None and state[1] else FIRST_CURSOR
+        return params
+
+    def _track(self, command, params, code, fields):
+        """Recuerda lo que necesitan las operaciones siguientes"""
+        if code != 0:
+            return
+        if command in ("PUBLISH", "DELETE"):
+            with self.published_lock:
+                names = self.published.setdefault(params[0], {})
+                if command == "PUBLISH":
+                    names[params[1]] = None
+                else:
+                    names.pop(params[1], None)
+        elif command == "UNREGISTER":
+            with self.published_lock:
+                self.published.pop(params[0], None)
+        elif command.endswith("_PAGE") or command.endswith("_CHANGES"):
+            family = command.rsplit("_", 1)[0]
+            target = params[1] if family == "LIST_CONTENT" else None
+            key = (family, params[0], target)
+            cursor = fields[1] if command.endswith("_PAGE") else self.listings.get(key, (None, ""))[1]
+            self.listings[key] = (fields[0], cursor)
+
+    def request(self, command, fecha, params):
+        """Envía una operación y devuelve su código y los campos fijos de la respuesta"""
+        s, r = self._open()
+        try:
+            s.sendall(client._encode_fields([command, fecha] + params))
+            code = r.read_byte()
+            if code is None:
+                raise ConnectionError(command)
+            fields = []
+            shape = REPLY_SHAPES.get(command)
+            if code == 0 and shape is not None:
+                fields = [r.read_string() for _ in range(shape[0])]
+                if shape[1]:
+                    for _ in range(int(r.read_string()) * shape[1]):
+                        r.read_string()
+            return code, fields
+        except Exception:
+            self._drop_session()
+            raise
+        finally:
+            if s is not self.sock:
+                s.close()
+
+    def run(self, items, start):
+        for offset, op in items:
+            delay = start + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            params = self._resolve(op)
+            if params is None:
+                self.skipped[op.command] = self.skipped.get(op.command, 0) + 1
+                continue
+            sent = time.monotonic()
+            self.lags.append(max(0.0, sent - start - offset))
+            try:
+                code, fields = self.request(op.command, op.fecha, params)
+            except Exception:
+                code, fields = "exc", []
+            self.latencies.setdefault(op.command, []).append(time.monotonic() - sent)
+            codes = self.codes.setdefault(op.command, {})
+            codes[str(code)] = codes.get(str(code), 0) + 1
+            self._track(op.command, params, code, fields)
+        self._drop_session()
+
+
+def prefixed(op, prefix):
+    params = list(op.params)
+    params[0] = prefix + params[0]
+    for i in USER_PARAMS.get(op.command, ()):
+        if params[i] is not UNKNOWN:
+            params[i] = prefix + params[i]
+    return op._replace(params=params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded workload against a server")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--capture", help="capture file written by server -c")
+    source.add_argument("--segments", help="structured log directory of servidor_rpc")
+    source.add_argument("--logs", help="logs.txt written by servidor_rpc")
+    parser.add_argument("-s", default="localhost", help="server IP")
+    parser.add_argument("-p", type=int, required=True, help="server port")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay N times faster than recorded")
+    parser.add_argument("--fast", action="store_true", help="send as fast as possible")
+    parser.add_argument("--max-gap", type=float, help="shorten idle periods to at most this many seconds")
+    parser.add_argument("--threads", type=int, default=32, help="users are spread over this many threads")
+    parser.add_argument("--session", action="store_true", help="one persistent connection per thread")
+    parser.add_argument("--prefix", default="", help="prefix added to every user name")
+    parser.add_argument("--limit", type=int, help="replay only the first N operations")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+    if args.speed <= 0 or args.threads < 1:
+        parser.error("--speed and --threads must be positive")
+
+    skipped = {}
+    if args.capture:
+        operations = read_capture(args.capture, skipped)
+    elif args.segments:
+        operations = read_segments(args.segments, skipped)
+    else:
+        operations = read_text_log(args.logs, skipped)
+    operations = list(operations)[:args.limit]
+    if args.prefix:
+        operations = [prefixed(op, args.prefix) for op in operations]
+    if not operations:
+        print("No operations to replay")
+        return 1
+    offsets = schedule(operations, 0 if args.fast else args.speed, args.max_gap)
+
+    # Cada usuario va siempre al mismo hilo, que envía sus operaciones en orden
+    shards = [[] for _ in range(args.threads)]
+    for offset, op in zip(offsets, operations):
+        shards[zlib.crc32(op.params[0].encode()) % args.threads].append((offset, op))
+
+    # Puerto que anuncian los CONNECT: un socket que escucha pero no atiende
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("", 0))
+    listener.listen(1)
+
+    published, published_lock = {}, threading.Lock()
+    replayers = [Replayer(args, listener.getsockname()[1], published, published_lock) for _ in shards]
+    start = time.monotonic() + 0.1
+    threads = [threading.Thread(target=rep.run, args=(shard, start))
+               for rep, shard in zip(replayers, shards) if shard]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+    listener.close()
+
+    latencies, codes, lags = {}, {}, []
+    for rep in replayers:
+        lags.extend(rep.lags)
+        for command, values in rep.latencies.items():
+            latencies.setdefault(command, []).extend(values)
+        for command, by_code in rep.codes.items():
+            merged = codes.setdefault(command, {})
+            for code, n in by_code.items():
+                merged[code] = merged.get(code, 0) + n
+        for command, n in rep.skipped.items():
+            skipped[command] = skipped.get(command, 0) + n
+
+    summary = {}
+    for command in sorted(latencies):
+        values = sorted(latencies[command])
+        summary[command] = {"count": len(values), "codes": codes[command],
+                            "p50_ms": percentile(values, 50) * 1000,
+                            "p95_ms": percentile(values, 95) * 1000,
+                            "p99_ms": percentile(values, 99) * 1000}
+    sent = sum(len(v) for v in latencies.values())
+    lags.sort()
+    recorded_span = operations[-1].ts - operations[0].ts
+
+    print("%-22s %8s %9s %9s %9s  %s" % ("OPERATION", "COUNT", "P50_MS", "P95_MS", "P99_MS", "CODES"))
+    for command, s in summary.items():
+        print("%-22s %8d %9.2f %9.2f %9.2f  %s" % (
+            command, s["count"], s["p50_ms"], s["p95_ms"], s["p99_ms"],
+            " ".join("%s:%d" % item for item in sorted(s["codes"].items()))))
+    print("sent %d operations in %.2f s (%.0f ops/s), recorded span %.2f s" % (
+        sent, elapsed, sent / elapsed if elapsed > 0 else 0, recorded_span))
+    if lags and not args.fast:
+        print("schedule lag p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+            percentile(lags, 50) * 1000, percentile(lags, 99) * 1000, lags[-1] * 1000))
+    if skipped:
+        print("skipped: " + " ".join("%s:%d" % item for item in sorted(skipped.items())))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"config": vars(args), "elapsed_s": elapsed, "recorded_span_s": recorded_span,
+                       "sent": sent, "operations": summary, "skipped": skipped,
+                       "lag_ms": {"p50": percentile(lags, 50) * 1000 if lags else None,
+                                  "p99": percentile(lags, 99) * 1000 if lags else None,
+                                  "max": lags[-1] * 1000 if lags else None}},
+                      f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,12 @@
+#define _GNU_SOURCE             // Cerrojos lectores/escritor que dan preferencia al escritor
 #include <sys/types.h>
 #include <sys/socket.h>
+#include <sys/uio.h>
+#include <sys/epoll.h>
+#include <sys/eventfd.h>
+#include <sys/stat.h>
+#include <poll.h>
+#include <fnmatch.h>
 #include <netinet/in.h>
 #include <arpa/inet.h>
 #include <errno.h>
@@ -9,59 +16,204 @@
 #include <stdio.h>
 #include <pthread.h>
 #include <signal.h>
+#include <fcntl.h>
 #include <stdbool.h>
-
+#include <stdint.h>
+#include <stddef.h>
+#include <stdatomic.h>
+#include <stdarg.h>
+#include <time.h>
+#include <dirent.h>
+
+// Registro de operaciones en el servidor RPC (proxy_rpc.c). registrar_log_rpc
+// solo encola la entrada; un hilo del proxy la envía en segundo plano.
 int registrar_log_rpc(const char *usuario, const char *operacion, const char *param1, const char *fecha);
+int log_rpc_start(int capacity, const char *policy_name, const char *path);
+void log_rpc_stop(void);
+void log_rpc_print_stats(void);
+void log_rpc_counters(unsigned long long counters[7]);
 
-#define MAX_USERS 100
-#define MAX_FILES 1000
 #define MAX_STRING 256
+#define CONN_BUFFER_SIZE 4096
+
+// Las cadenas del directorio (nombres, IPs, descripciones, raíces) son
+// cadenas internadas: cada valor distinto se guarda una sola vez con un
+// contador de referencias, y el nombre de un usuario y el owner de sus
+// ficheros comparten la misma copia. Se reservan con intern() y se liberan
+// con release().
 
 // Estructura para usuarios
 typedef struct {
-    char username[MAX_STRING];
-    char ip[MAX_STRING];
+    const char *username;
+    const char *ip;                 // "" hasta el primer CONNECT
     int port;
     bool connected;
+    int hnext;                      // Siguiente usuario en la cadena de su cubo
+    int files_head;                 // Primer y último fichero que publica
+    int files_tail;
+    int nfiles;
+    uint64_t conn_version;          // Versión del catálogo en su último CONNECT
+    int conn_prev;                  // Usuarios conectados, en orden de conexión
+    int conn_next;
+    int changes_tail;               // Posición en file_changes de su último cambio
+    uint64_t changes_last;          // Versión de ese cambio (0 si no hay)
+    uint64_t changes_floor;         // Sus cambios de versiones <= changes_floor pueden faltar
 } User;
 
 // Estructura para archivos publicados
 typedef struct {
-    char filename[MAX_STRING];
-    char description[MAX_STRING];
-    char owner[MAX_STRING];
+    const char *filename;
+    const char *description;
+    const char *owner;
+    const char *hash;               // Raíz Merkle del contenido ("" si aún no se conoce)
+    int hnext;                      // Siguiente en la cadena de (owner, filename)
+    int name_next;                  // Siguiente en la cadena de filename
+    int owner_prev;                 // Ficheros del mismo owner, en orden de publicación
+    int owner_next;
+    int terms;                      // Primera entrada de sus términos en el índice de SEARCH
+    uint64_t version;               // Versión del catálogo en que se publicó
 } FileEntry;
 
-// Variables globales del servidor
-User users[MAX_USERS];
-FileEntry files[MAX_FILES];
+// Variables globales del servidor. users[] y files[] crecen al doble cuando se
+// llenan; las bajas mueven el último elemento al hueco.
+User *users = NULL;
+FileEntry *files = NULL;
 int user_count = 0;
 int file_count = 0;
+int user_capacity = 0;
+int file_capacity = 0;
+
+// Usuarios conectados, enlazados por conn_prev/conn_next en orden de conexión
+int connected_head = -1;
+int connected_tail = -1;
+int connected_count = 0;
+
+// Límites configurables al arrancar (-u / -f); 0 significa sin límite
+int max_users = 0;
+int max_files = 0;
+
+#define INITIAL_CAPACITY 64
+
+// Cadena internada: el texto va a continuación de la cabecera
+typedef struct InternString {
+    struct InternString *next;      // Siguiente en la cadena de su cubo
+    uint64_t hash;
+    unsigned int refs;
+    char str[];
+} InternString;
+
+InternString **strings = NULL;
+size_t strings_nbuckets = 0;
+size_t strings_count = 0;
+pthread_mutex_t strings_mutex = PTHREAD_MUTEX_INITIALIZER;  // Se toma el último
+
+// Índices hash del directorio. Cada cubo guarda la posición en users[] o
+// files[] del primer elemento de su cadena (-1 si está vacío) y la cadena sigue
+// por los campos hnext/name_next de las propias entradas, así que un índice
+// sigue siendo válido mientras se actualicen las posiciones al mover entradas.
+typedef struct {
+    int *heads;
+    size_t nbuckets;                // Potencia de dos (0 hasta el primer uso)
+} HashIndex;
+
+#define INDEX_MIN_BUCKETS 64
+
+HashIndex users_by_name = {NULL, 0};   // username
+HashIndex files_by_key = {NULL, 0};    // (owner, filename)
+HashIndex files_by_name = {NULL, 0};   // filename, para buscar otros seeders
+
+// Cerrojos del directorio. Son de lectores/escritor y se toman siempre en este
+// orden: users_lock, files_lock y strings_mutex. Las consultas toman el cerrojo
+// en lectura y copian la respuesta a un Reply antes de soltarlo; el envío se
+// hace después, así que un cliente lento no bloquea a los demás. La lista de
+// ficheros de cada usuario (files_head, files_tail, nfiles) está protegida por
+// files_lock aunque se guarde en users[].
+typedef enum { DIR_READ, DIR_WRITE } LockMode;
 
-pthread_mutex_t users_mutex = PTHREAD_MUTEX_INITIALIZER;
-pthread_mutex_t files_mutex = PTHREAD_MUTEX_INITIALIZER;
+// Contadores de un cerrojo en un modo (tiempos en nanosegundos)
+typedef struct {
+    atomic_ullong acquisitions;
+    atomic_ullong wait_ns;          // Esperando a obtenerlo
+    atomic_ullong wait_max_ns;
+    atomic_ullong hold_ns;          // Desde que se obtiene hasta que se suelta
+    atomic_ullong hold_max_ns;
+} LockStats;
+
+typedef struct {
+    const char *name;
+    int id;                         // Posición en lock_held
+    pthread_rwlock_t lock;
+    LockStats stats[2];             // Por LockMode
+} DirLock;
+
+#define NUM_DIR_LOCKS 2
+
+DirLock users_lock = {.name = "users", .id = 0, .lock = PTHREAD_RWLOCK_WRITER_NONRECURSIVE_INITIALIZER_NP};
+DirLock files_lock = {.name = "files", .id = 1, .lock = PTHREAD_RWLOCK_WRITER_NONRECURSIVE_INITIALIZER_NP};
+
+// Momento y modo en que el hilo actual obtuvo cada cerrojo
+__thread struct {
+    uint64_t since;
+    LockMode mode;
+} lock_held[NUM_DIR_LOCKS];
 
 bool server_running = true;
 int sd; // Socket del servidor
+int wake_fd = -1; // eventfd con el que SIGINT despierta al bucle de epoll
+
+// Buffer de entrada de cada conexión: readLine recorre los bytes ya recibidos
+// y solo llama a read() cuando se han consumido todos
+typedef struct {
+    int fd;
+    size_t start;                 // Primer byte sin consumir
+    size_t end;                   // Fin de los bytes recibidos
+    char buf[CONN_BUFFER_SIZE];
+} Connection;
+
+void conn_init(Connection *conn, int fd) {
+    conn->fd = fd;
+    conn->start = 0;
+    conn->end = 0;
+}
 
-// Función readLine proporcionada
-ssize_t readLine(int fd, void *buffer, size_t n) {
+// Lee un campo terminado en '\0' o '\n' desde el buffer de la conexión.
+// Devuelve la longitud del campo, 0 si la conexión se cerró sin datos y -1 en
+// caso de error. Un campo que no cabe en n bytes se rechaza con EMSGSIZE.
+ssize_t readLine(Connection *conn, void *buffer, size_t n) {
     ssize_t numRead;
     size_t totRead;
     char *buf;
     char ch;
 
-    if (n <= 0 || buffer == NULL) {
+    if (conn == NULL || n <= 0 || buffer == NULL) {
         errno = EINVAL;
         return -1;
     }
 
     buf = buffer;
     totRead = 0;
-    
+
     for (;;) {
-        numRead = read(fd, &ch, 1);
-        
+        // Consumir los bytes que ya están en el buffer
+        while (conn->start < conn->end) {
+            ch = conn->buf[conn->start++];
+            if (ch == '\n' || ch == '\0') {
+                *buf = '\0';
+                return totRead;
+            }
+            if (totRead >= n - 1) {
+                errno = EMSGSIZE; // Campo demasiado largo
+                return -1;
+            }
+            totRead++;
+            *buf++ = ch;
+        }
+
+        // Buffer vacío: pedir un nuevo bloque al socket
+        conn->start = 0;
+        conn->end = 0;
+        numRead = read(conn->fd, conn->buf, CONN_BUFFER_SIZE);
+
         if (numRead == -1) {
             if (errno == EINTR)
                 continue;
@@ -72,16 +224,10 @@ ssize_t readLine(int fd, void *buffer, size_t n) {
                 return 0;
             else
                 break;
-        } else {
-            if (ch == '\n' || ch == '\0')
-                break;
-            if (totRead < n - 1) {
-                totRead++;
-                *buf++ = ch;
-            }
         }
+        conn->end = numRead;
     }
-    
+
     *buf = '\0';
     return totRead;
 }
@@ -94,12 +240,423 @@ void handle_signal(int sig) {
         server_running = false;
         shutdown(sd, SHUT_RDWR); // fuerza a que accept salga
         close(sd);
+        if (wake_fd >= 0) {
+            uint64_t one = 1;
+            write(wake_fd, &one, sizeof(one)); // y a que epoll_wait salga
+        }
+    }
+}
+
+uint64_t now_ns(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+}
+
+void atomic_max(atomic_ullong *max, uint64_t value) {
+    unsigned long long current = atomic_load(max);
+    while (value > current && !atomic_compare_exchange_weak(max, &current, value)) {
+    }
+}
+
+void dir_lock(DirLock *l, LockMode mode) {
+    uint64_t start = now_ns();
+    if (mode == DIR_READ) {
+        pthread_rwlock_rdlock(&l->lock);
+    } else {
+        pthread_rwlock_wrlock(&l->lock);
+    }
+    uint64_t acquired = now_ns();
+
+    LockStats *st = &l->stats[mode];
+    atomic_fetch_add(&st->acquisitions, 1);
+    atomic_fetch_add(&st->wait_ns, acquired - start);
+    atomic_max(&st->wait_max_ns, acquired - start);
+    lock_held[l->id].since = acquired;
+    lock_held[l->id].mode = mode;
+}
+
+void dir_unlock(DirLock *l) {
+    uint64_t held = now_ns() - lock_held[l->id].since;
+    LockStats *st = &l->stats[lock_held[l->id].mode];
+    pthread_rwlock_unlock(&l->lock);
+
+    atomic_fetch_add(&st->hold_ns, held);
+    atomic_max(&st->hold_max_ns, held);
+}
+
+// Imprime los tiempos de espera y retención de los cerrojos del directorio.
+// Se llama al recibir SIGUSR1 y al cerrar el servidor, junto con el estado de
+// la cola de registro RPC.
+void print_lock_stats(void) {
+    DirLock *locks[NUM_DIR_LOCKS] = {&users_lock, &files_lock};
+    const char *modes[2] = {"read", "write"};
+
+    for (int i = 0; i < NUM_DIR_LOCKS; i++) {
+        for (int m = 0; m < 2; m++) {
+            LockStats *st = &locks[i]->stats[m];
+            unsigned long long n = atomic_load(&st->acquisitions);
+            double div = n ? (double)n * 1000.0 : 1.0;
+            printf("s> LOCK %s %s: acquisitions=%llu wait_avg=%.2fus wait_max=%.2fus "
+                   "hold_avg=%.2fus hold_max=%.2fus\n",
+                   locks[i]->name, modes[m], n,
+                   atomic_load(&st->wait_ns) / div, atomic_load(&st->wait_max_ns) / 1000.0,
+                   atomic_load(&st->hold_ns) / div, atomic_load(&st->hold_max_ns) / 1000.0);
+        }
+    }
+    fflush(stdout);
+}
+
+// Hilo que atiende SIGUSR1 (bloqueada en el resto de hilos)
+void *lock_stats_thread(void *arg) {
+    sigset_t set;
+    sigemptyset(&set);
+    sigaddset(&set, SIGUSR1);
+
+    int sig;
+    while (sigwait(&set, &sig) == 0) {
+        print_lock_stats();
+        log_rpc_print_stats();
+    }
+    return NULL;
+}
+
+// Escribe len bytes completos en el socket
+int send_all(int fd, const void *data, size_t len) {
+    const char *p = data;
+    while (len > 0) {
+        ssize_t w = write(fd, p, len);
+        if (w < 0) {
+            if (errno == EINTR) continue;
+            return -1;
+        }
+        p += w;
+        len -= w;
+    }
+    return 0;
+}
+
+// Código de resultado que ha enviado la petición en curso de este hilo (-1 si
+// aún no ha enviado ninguno), para las métricas
+__thread int request_result = -1;
+
+// Respuesta construida en memoria mientras se tiene el cerrojo y enviada
+// después de soltarlo con un único send_all
+typedef struct {
+    char *data;
+    size_t len;
+    size_t cap;
+    bool failed;                    // Sin memoria: el contenido está incompleto
+} Reply;
+
+void reply_init(Reply *r) {
+    r->data = NULL;
+    r->len = 0;
+    r->cap = 0;
+    r->failed = false;
+}
+
+void reply_put(Reply *r, const void *data, size_t n) {
+    if (r->failed) {
+        return;
+    }
+    if (r->len + n > r->cap) {
+        size_t cap = r->cap ? r->cap : 256;
+        while (cap < r->len + n) {
+            cap *= 2;
+        }
+        char *grown = realloc(r->data, cap);
+        if (grown == NULL) {
+            r->failed = true;
+            return;
+        }
+        r->data = grown;
+        r->cap = cap;
+    }
+    memcpy(r->data + r->len, data, n);
+    r->len += n;
+}
+
+// Cadena con su '\0', como todos los campos del protocolo
+void reply_put_str(Reply *r, const char *s) {
+    reply_put(r, s, strlen(s) + 1);
+}
+
+// Texto con formato, sin '\0' final
+void reply_printf(Reply *r, const char *fmt, ...) {
+    char line[512];
+    va_list ap;
+    va_start(ap, fmt);
+    int n = vsnprintf(line, sizeof(line), fmt, ap);
+    va_end(ap);
+    if (n > 0) {
+        reply_put(r, line, (size_t)n < sizeof(line) ? (size_t)n : sizeof(line) - 1);
+    }
+}
+
+void reply_put_int(Reply *r, int value) {
+    char str[16];
+    int n = snprintf(str, sizeof(str), "%d", value);
+    reply_put(r, str, n + 1);
+}
+
+// Envía el código de resultado seguido de la respuesta en una sola escritura.
+// Si no hubo memoria para construirla se envía solo error_code.
+void reply_send(Reply *r, int client_fd, int result, int error_code) {
+    unsigned char code = (unsigned char)(r->failed ? error_code : result);
+    request_result = code;
+    size_t len = r->failed ? 0 : r->len;
+    struct iovec iov[2] = {{&code, 1}, {r->data, len}};
+
+    ssize_t w;
+    do {
+        w = writev(client_fd, iov, 2);
+    } while (w < 0 && errno == EINTR);
+    if (w > 0 && (size_t)w < len + 1) {
+        send_all(client_fd, r->data + (w - 1), len + 1 - w);
+    }
+    free(r->data);
+    reply_init(r);
+}
+
+// Enviar el código de resultado de una operación (un byte)
+void send_code(int client_fd, int result) {
+    request_result = result;
+    unsigned char response_code = (unsigned char)result;
+    write(client_fd, &response_code, 1);
+}
+
+// Hash FNV-1a de 64 bits; hash_str continúa a partir de un hash previo
+#define HASH_SEED 1469598103934665603ULL
+#define HASH_PRIME 1099511628211ULL
+
+uint64_t hash_str(uint64_t h, const char *s) {
+    while (*s) {
+        h ^= (unsigned char)*s++;
+        h *= HASH_PRIME;
+    }
+    return h;
+}
+
+// Asegura sitio para count elementos en un array dinámico, doblando su tamaño
+int array_reserve(void **array, int *capacity, size_t elem_size, int count) {
+    if (count <= *capacity) {
+        return 0;
+    }
+    int cap = *capacity ? *capacity : INITIAL_CAPACITY;
+    while (cap < count) {
+        if (cap > INT32_MAX / 2) {
+            return -1;
+        }
+        cap *= 2;
+    }
+    void *grown = realloc(*array, (size_t)cap * elem_size);
+    if (grown == NULL) {
+        return -1;
+    }
+    *array = grown;
+    *capacity = cap;
+    return 0;
+}
+
+// Devuelve la copia compartida de s (sumando una referencia) o NULL si no hay memoria
+const char *intern(const char *s) {
+    uint64_t h = hash_str(HASH_SEED, s);
+
+    pthread_mutex_lock(&strings_mutex);
+    if (strings_count >= strings_nbuckets) {
+        // Rehacer la tabla con el doble de cubos
+        size_t n = strings_nbuckets ? strings_nbuckets * 2 : INDEX_MIN_BUCKETS;
+        InternString **table = calloc(n, sizeof(InternString *));
+        if (table != NULL) {
+            for (size_t b = 0; b < strings_nbuckets; b++) {
+                InternString *e = strings[b];
+                while (e != NULL) {
+                    InternString *next = e->next;
+                    e->next = table[e->hash & (n - 1)];
+                    table[e->hash & (n - 1)] = e;
+                    e = next;
+                }
+            }
+            free(strings);
+            strings = table;
+            strings_nbuckets = n;
+        } else if (strings_nbuckets == 0) {
+            pthread_mutex_unlock(&strings_mutex);
+            return NULL;
+        }
+    }
+
+    InternString **bucket = &strings[h & (strings_nbuckets - 1)];
+    for (InternString *e = *bucket; e != NULL; e = e->next) {
+        if (e->hash == h && strcmp(e->str, s) == 0) {
+            e->refs++;
+            pthread_mutex_unlock(&strings_mutex);
+            return e->str;
+        }
+    }
+
+    size_t len = strlen(s);
+    InternString *e = malloc(sizeof(InternString) + len + 1);
+    if (e != NULL) {
+        memcpy(e->str, s, len + 1);
+        e->hash = h;
+        e->refs = 1;
+        e->next = *bucket;
+        *bucket = e;
+        strings_count++;
+    }
+    pthread_mutex_unlock(&strings_mutex);
+    return e ? e->str : NULL;
+}
+
+// Quita una referencia a una cadena de intern() y la libera con la última
+void release(const char *s) {
+    if (s == NULL) {
+        return;
+    }
+    InternString *e = (InternString *)(s - offsetof(InternString, str));
+
+    pthread_mutex_lock(&strings_mutex);
+    if (--e->refs == 0) {
+        InternString **ref = &strings[e->hash & (strings_nbuckets - 1)];
+        while (*ref != e) {
+            ref = &(*ref)->next;
+        }
+        *ref = e->next;
+        strings_count--;
+        free(e);
+    }
+    pthread_mutex_unlock(&strings_mutex);
+}
+
+// Suma una referencia a una cadena que ya es de intern()
+const char *retain(const char *s) {
+    InternString *e = (InternString *)(s - offsetof(InternString, str));
+    pthread_mutex_lock(&strings_mutex);
+    e->refs++;
+    pthread_mutex_unlock(&strings_mutex);
+    return s;
+}
+
+size_t user_bucket(const char *username) {
+    return hash_str(HASH_SEED, username) & (users_by_name.nbuckets - 1);
+}
+
+size_t file_key_bucket(const char *owner, const char *filename) {
+    // El separador evita que ("ab", "c") y ("a", "bc") coincidan siempre
+    uint64_t h = hash_str(HASH_SEED, owner) * HASH_PRIME;
+    return hash_str(h, filename) & (files_by_key.nbuckets - 1);
+}
+
+size_t file_name_bucket(const char *filename) {
+    return hash_str(HASH_SEED, filename) & (files_by_name.nbuckets - 1);
+}
+
+// Sustituye la tabla de cubos por otra vacía de nbuckets cubos
+int index_reset(HashIndex *index, size_t nbuckets) {
+    int *heads = malloc(nbuckets * sizeof(int));
+    if (heads == NULL) {
+        return -1;
+    }
+    for (size_t i = 0; i < nbuckets; i++) {
+        heads[i] = -1;
+    }
+    free(index->heads);
+    index->heads = heads;
+    index->nbuckets = nbuckets;
+    return 0;
+}
+
+// Tamaño de tabla para count entradas (factor de carga máximo 1), o 0 si la
+// tabla actual ya es suficiente
+size_t index_target(const HashIndex *index, int count) {
+    if ((size_t)count <= index->nbuckets) {
+        return 0;
+    }
+    size_t n = index->nbuckets ? index->nbuckets : INDEX_MIN_BUCKETS;
+    while (n < (size_t)count) {
+        n *= 2;
+    }
+    return n;
+}
+
+void user_index_link(int idx) {
+    size_t b = user_bucket(users[idx].username);
+    users[idx].hnext = users_by_name.heads[b];
+    users_by_name.heads[b] = idx;
+}
+
+void file_index_link(int idx) {
+    size_t b = file_key_bucket(files[idx].owner, files[idx].filename);
+    files[idx].hnext = files_by_key.heads[b];
+    files_by_key.heads[b] = idx;
+
+    b = file_name_bucket(files[idx].filename);
+    files[idx].name_next = files_by_name.heads[b];
+    files_by_name.heads[b] = idx;
+}
+
+// Asegura sitio en el índice para count usuarios, rehaciéndolo si crece
+int users_index_reserve(int count) {
+    size_t n = index_target(&users_by_name, count);
+    if (n == 0) {
+        return 0;
+    }
+    if (index_reset(&users_by_name, n) < 0) {
+        return -1;
+    }
+    for (int i = 0; i < user_count; i++) {
+        user_index_link(i);
+    }
+    return 0;
+}
+
+int files_index_reserve(int count) {
+    size_t n = index_target(&files_by_key, count);
+    if (n == 0) {
+        return 0;
+    }
+    if (index_reset(&files_by_key, n) < 0 || index_reset(&files_by_name, n) < 0) {
+        return -1;
+    }
+    for (int i = 0; i < file_count; i++) {
+        file_index_link(i);
+    }
+    return 0;
+}
+
+// Enlace (cabeza del cubo o campo next de otra entrada) que apunta a idx
+int *user_chain_ref(int idx) {
+    int *ref = &users_by_name.heads[user_bucket(users[idx].username)];
+    while (*ref != idx) {
+        ref = &users[*ref].hnext;
+    }
+    return ref;
+}
+
+int *file_key_ref(int idx) {
+    int *ref = &files_by_key.heads[file_key_bucket(files[idx].owner, files[idx].filename)];
+    while (*ref != idx) {
+        ref = &files[*ref].hnext;
+    }
+    return ref;
+}
+
+int *file_name_ref(int idx) {
+    int *ref = &files_by_name.heads[file_name_bucket(files[idx].filename)];
+    while (*ref != idx) {
+        ref = &files[*ref].name_next;
     }
+    return ref;
 }
 
 // Buscar usuario por nombre
 int find_user(const char *username) {
-    for (int i = 0; i < user_count; i++) {
+    if (users_by_name.nbuckets == 0) {
+        return -1;
+    }
+    for (int i = users_by_name.heads[user_bucket(username)]; i != -1; i = users[i].hnext) {
         if (strcmp(users[i].username, username) == 0) {
             return i;
         }
@@ -109,8 +666,11 @@ int find_user(const char *username) {
 
 // Buscar archivo por nombre y dueño
 int find_file(const char *filename, const char *owner) {
-    for (int i = 0; i < file_count; i++) {
-        if (strcmp(files[i].filename, filename) == 0 && 
+    if (files_by_key.nbuckets == 0) {
+        return -1;
+    }
+    for (int i = files_by_key.heads[file_key_bucket(owner, filename)]; i != -1; i = files[i].hnext) {
+        if (strcmp(files[i].filename, filename) == 0 &&
             strcmp(files[i].owner, owner) == 0) {
             return i;
         }
@@ -118,490 +678,3163 @@ int find_file(const char *filename, const char *owner) {
     return -1;
 }
 
-// Operación REGISTER
-int handle_register(int client_fd, const char *username) {
-    pthread_mutex_lock(&users_mutex);
-    
-    int result;
-    if (find_user(username) != -1) {
-        result = 1; // Usuario ya existe
-    } else if (user_count >= MAX_USERS) {
-        result = 2; // Error del sistema
-    } else {
-        strcpy(users[user_count].username, username);
-        users[user_count].connected = false;
-        user_count++;
-        result = 0; // Éxito
-    }
-    
-    pthread_mutex_unlock(&users_mutex);
-    write(client_fd, &result, sizeof(result));
-    return result; // Retorna el resultado de la operación, aunque no se use
+// Índice invertido para SEARCH. Los términos son las palabras (letras y
+// dígitos, en minúsculas) del nombre y la descripción de cada fichero. Se
+// guardan en un trie cuyos hijos están ordenados, así que un prefijo lleva a
+// un nodo y su subárbol contiene, en orden alfabético, todos los términos que
+// empiezan por él. Cada nodo donde acaba un término tiene la lista de los
+// ficheros que lo contienen, y cada fichero la lista de sus entradas, para
+// quitarlas o moverlas sin buscar. Los nodos y las entradas viven en arrays
+// con lista de huecos libres, enlazados por posición como el resto del
+// directorio; lo protege files_lock.
+typedef struct {
+    int parent;
+    int child;                      // Primer hijo; los hermanos van en orden de c
+    int sibling;
+    int postings;                   // Entradas de los ficheros cuyo término acaba aquí
+    int count;                      // Entradas en todo el subárbol
+    unsigned char c;
+} TermNode;
+
+typedef struct {
+    int file;                       // Posición en files[]
+    int node;                       // Nodo donde acaba el término
+    int prev;                       // Entradas del mismo término
+    int next;
+    int file_next;                  // Siguiente término del mismo fichero
+} Posting;
+
+TermNode *term_nodes = NULL;
+int term_node_count = 0;
+int term_node_capacity = 0;
+int term_node_free = -1;            // Huecos libres, encadenados por sibling
+Posting *postings = NULL;
+int posting_count = 0;
+int posting_capacity = 0;
+int posting_free = -1;              // Huecos libres, encadenados por next
+
+#define MAX_TERMS MAX_STRING
+
+// Términos distintos de uno o dos textos, copiados en minúsculas a text
+typedef struct {
+    char text[2 * MAX_STRING];
+    const char *terms[MAX_TERMS];
+    int count;
+} TermList;
+
+bool term_char(unsigned char c) {
+    return (c >= 'a' && c <= 'z') || (c >= 'A' && c <= 'Z') || (c >= '0' && c <= '9') || c >= 0x80;
 }
 
-// Operación UNREGISTER
-int handle_unregister(int client_fd, const char *username) {
-    pthread_mutex_lock(&users_mutex);
-    
-    int result;
-    int user_idx = find_user(username);
-    if (user_idx == -1) {
-        result = 1; // Usuario no existe
-    } else {
-        // Eliminar usuario (mover último elemento a esta posición)
-        users[user_idx] = users[user_count - 1];
-        user_count--;
-        
-        // Eliminar sus archivos
-        pthread_mutex_lock(&files_mutex);
-        for (int i = 0; i < file_count; ) {
-            if (strcmp(files[i].owner, username) == 0) {
-                files[i] = files[file_count - 1];
-                file_count--;
-            } else {
-                i++;
+void terms_split(TermList *tl, const char *a, const char *b) {
+    const char *sources[2] = {a, b};
+    size_t pos = 0;
+    tl->count = 0;
+
+    for (int s = 0; s < 2 && sources[s] != NULL; s++) {
+        const unsigned char *p = (const unsigned char *)sources[s];
+        while (*p) {
+            while (*p && !term_char(*p)) p++;
+            if (!*p || pos >= sizeof(tl->text) - 1) break;
+
+            char *term = &tl->text[pos];
+            while (*p && term_char(*p) && pos < sizeof(tl->text) - 1) {
+                tl->text[pos++] = (*p >= 'A' && *p <= 'Z') ? *p - 'A' + 'a' : *p;
+                p++;
+            }
+            tl->text[pos++] = '\0';
+            while (*p && term_char(*p)) p++;    // Sin sitio: se corta el término
+
+            bool seen = false;
+            for (int i = 0; i < tl->count && !seen; i++) {
+                seen = strcmp(tl->terms[i], term) == 0;
+            }
+            if (seen) {
+                pos = term - tl->text;
+            } else if (tl->count < MAX_TERMS) {
+                tl->terms[tl->count++] = term;
             }
         }
-        pthread_mutex_unlock(&files_mutex);
-        
-        result = 0; // Éxito
     }
-    
-    pthread_mutex_unlock(&users_mutex);
-    write(client_fd, &result, sizeof(result));
-    return result;
 }
 
-// Operación CONNECT
-int handle_connect(int client_fd, const char *username, const char *port_str) {
-    pthread_mutex_lock(&users_mutex);
-    
-    int result;
-    int user_idx = find_user(username);
-    if (user_idx == -1) {
-        result = 1; // Usuario no existe
-    } else if (users[user_idx].connected) {
-        result = 2; // Ya conectado
-    } else {
-        // Obtener IP del cliente
-        struct sockaddr_in addr;
-        socklen_t addr_size = sizeof(struct sockaddr_in);
-        getpeername(client_fd, (struct sockaddr *)&addr, &addr_size);
-        
-        strcpy(users[user_idx].ip, inet_ntoa(addr.sin_addr));
-        users[user_idx].port = atoi(port_str);
-        users[user_idx].connected = true;
-        result = 0; // Éxito
+// Hijo de node con el carácter c, o -1
+int term_child(int node, unsigned char c) {
+    for (int n = term_nodes[node].child; n != -1 && term_nodes[n].c <= c; n = term_nodes[n].sibling) {
+        if (term_nodes[n].c == c) {
+            return n;
+        }
     }
-    
-    pthread_mutex_unlock(&users_mutex);
-    write(client_fd, &result, sizeof(result));
-    return result;
+    return -1;
 }
 
-// Operación DISCONNECT
-int handle_disconnect(int client_fd, const char *username) {
-    pthread_mutex_lock(&users_mutex);
-    
-    int result;
-    int user_idx = find_user(username);
-    if (user_idx == -1) {
-        result = 1; // Usuario no existe
-    } else if (!users[user_idx].connected) {
-        result = 2; // No conectado
-    } else {
-        users[user_idx].connected = false;
-        result = 0; // Éxito
+// Nodo al que lleva prefix desde la raíz, o -1
+int term_find(const char *prefix) {
+    if (term_node_count == 0) {
+        return -1;
     }
-    
-    pthread_mutex_unlock(&users_mutex);
-    write(client_fd, &result, sizeof(result));
-    return result;
+    int node = 0;
+    for (const unsigned char *p = (const unsigned char *)prefix; *p && node != -1; p++) {
+        node = term_child(node, *p);
+    }
+    return node;
 }
 
-// Operación PUBLISH
-int handle_publish(int client_fd, const char *username, const char *filename, const char *description) {
-    pthread_mutex_lock(&users_mutex);
-    int user_idx = find_user(username);
-    pthread_mutex_unlock(&users_mutex);
-    
-    int result;
-    if (user_idx == -1) {
-        result = 1; // Usuario no existe
-    } else if (!users[user_idx].connected) {
-        result = 2; // Usuario no conectado
+int term_node_alloc(int parent, unsigned char c) {
+    int n = term_node_free;
+    if (n != -1) {
+        term_node_free = term_nodes[n].sibling;
     } else {
-        pthread_mutex_lock(&files_mutex);
-        if (find_file(filename, username) != -1) {
-            result = 3; // Archivo ya publicado
-        } else if (file_count >= MAX_FILES) {
-            result = 4; // Error del sistema
-        } else {
-            strcpy(files[file_count].filename, filename);
-            strcpy(files[file_count].description, description);
-            strcpy(files[file_count].owner, username);
-            file_count++;
-            result = 0; // Éxito
+        if (array_reserve((void **)&term_nodes, &term_node_capacity, sizeof(TermNode), term_node_count + 1) < 0) {
+            return -1;
         }
-        pthread_mutex_unlock(&files_mutex);
+        n = term_node_count++;
     }
-    
-    write(client_fd, &result, sizeof(result));
-    return result;
+    TermNode *t = &term_nodes[n];
+    t->parent = parent;
+    t->child = t->sibling = t->postings = -1;
+    t->count = 0;
+    t->c = c;
+    return n;
 }
 
-// Operación DELETE
-int handle_delete(int client_fd, const char *username, const char *filename) {
-    pthread_mutex_lock(&users_mutex);
-    int user_idx = find_user(username);
-    pthread_mutex_unlock(&users_mutex);
-    
-    int result;
-    if (user_idx == -1) {
-        result = 1; // Usuario no existe
-    } else if (!users[user_idx].connected) {
+// Libera los nodos vacíos (sin entradas ni hijos) desde node hacia la raíz
+void term_prune(int node) {
+    while (node > 0 && term_nodes[node].count == 0 && term_nodes[node].child == -1) {
+        int parent = term_nodes[node].parent;
+        int *ref = &term_nodes[parent].child;
+        while (*ref != node) {
+            ref = &term_nodes[*ref].sibling;
+        }
+        *ref = term_nodes[node].sibling;
+        term_nodes[node].sibling = term_node_free;
+        term_node_free = node;
+        node = parent;
+    }
+}
+
+// Nodo donde acaba term, creando los que falten
+int term_insert(const char *term) {
+    if (term_node_count == 0 && term_node_alloc(-1, 0) < 0) {
+        return -1;
+    }
+    int node = 0;
+    for (const unsigned char *p = (const unsigned char *)term; *p; p++) {
+        int next = term_child(node, *p);
+        if (next == -1) {
+            if ((next = term_node_alloc(node, *p)) < 0) {
+                term_prune(node);
+                return -1;
+            }
+            // Enlazar en orden entre los hermanos
+            int *ref = &term_nodes[node].child;
+            while (*ref != -1 && term_nodes[*ref].c < *p) {
+                ref = &term_nodes[*ref].sibling;
+            }
+            term_nodes[next].sibling = *ref;
+            *ref = next;
+        }
+        node = next;
+    }
+    return node;
+}
+
+// Resta una entrada a la rama que acaba en node
+void term_release(int node) {
+    for (int n = node; n != -1; n = term_nodes[n].parent) {
+        term_nodes[n].count--;
+    }
+    term_prune(node);
+}
+
+// Quita del índice todos los términos del fichero idx
+void search_index_remove(int idx) {
+    int p = files[idx].terms;
+    while (p != -1) {
+        Posting *e = &postings[p];
+        if (e->prev != -1) postings[e->prev].next = e->next;
+        else term_nodes[e->node].postings = e->next;
+        if (e->next != -1) postings[e->next].prev = e->prev;
+        term_release(e->node);
+
+        int next = e->file_next;
+        e->next = posting_free;
+        posting_free = p;
+        p = next;
+    }
+    files[idx].terms = -1;
+}
+
+// Añade al índice los términos del nombre y la descripción del fichero idx.
+// Si no hay memoria no deja nada a medias y devuelve -1
+int search_index_add(int idx) {
+    TermList tl;
+    terms_split(&tl, files[idx].filename, files[idx].description);
+    files[idx].terms = -1;
+
+    for (int i = 0; i < tl.count; i++) {
+        int node = -1;
+        if (posting_free != -1 ||
+            array_reserve((void **)&postings, &posting_capacity, sizeof(Posting), posting_count + 1) == 0) {
+            node = term_insert(tl.terms[i]);
+        }
+        if (node == -1) {
+            search_index_remove(idx);
+            return -1;
+        }
+        int p = posting_free;
+        if (p != -1) {
+            posting_free = postings[p].next;
+        } else {
+            p = posting_count++;
+        }
+
+        Posting *e = &postings[p];
+        e->file = idx;
+        e->node = node;
+        e->prev = -1;
+        e->next = term_nodes[node].postings;
+        if (e->next != -1) postings[e->next].prev = p;
+        term_nodes[node].postings = p;
+        e->file_next = files[idx].terms;
+        files[idx].terms = p;
+        for (int n = node; n != -1; n = term_nodes[n].parent) {
+            term_nodes[n].count++;
+        }
+    }
+    return 0;
+}
+
+// Versión del catálogo: crece con cada cambio de los listados (usuarios que
+// se conectan o desconectan y ficheros que se publican o se borran). Cada
+// cambio se apunta con su versión en uno de dos registros acotados, el de
+// usuarios (protegido por users_lock) y el de ficheros (por files_lock), y
+// los clientes piden los cambios posteriores a la versión que ya tienen. Los
+// cambios de los dos registros nunca ocurren a la vez, porque el de usuarios
+// exige users_lock en escritura y el de ficheros lo tiene en lectura, pero
+// catalog_version es atómica porque un listado de usuarios la lee mientras se
+// publica un fichero. catalog_epoch distingue cada arranque del servidor.
+typedef struct {
+    uint64_t version;
+    bool added;
+    const char *name;               // Usuario o fichero
+    const char *owner;              // Dueño del fichero (NULL en los de usuarios)
+    const char *ip;                 // Usuarios conectados (NULL si se quita)
+    int port;
+    int owner_prev;                 // Cambio anterior del mismo dueño: posición y
+    uint64_t prev_version;          // versión (0 si no hay)
+} Change;
+
+typedef struct {
+    Change *entries;                // Buffer circular
+    int start;                      // Cambio más antiguo
+    int count;
+    uint64_t floor;                 // Los cambios de versiones <= floor ya no están
+} ChangeLog;
+
+#define CHANGELOG_CAPACITY 65536
+
+atomic_ullong catalog_version = 0;
+uint64_t catalog_epoch = 0;
+ChangeLog user_changes = {NULL, 0, 0, 0};
+ChangeLog file_changes = {NULL, 0, 0, 0};
+
+// Aviso al hilo de SUBSCRIBE: solo se escribe en notify_fd si hay suscriptores
+// y no hay ya un aviso pendiente, para no hacer una llamada al sistema por
+// cada cambio durante una ráfaga
+atomic_int subscriber_total = 0;
+atomic_bool notify_pending = false;
+int notify_fd = -1;
+
+void notify_subscribers(void) {
+    if (atomic_load(&subscriber_total) > 0 && !atomic_exchange(&notify_pending, true)) {
+        uint64_t one = 1;
+        write(notify_fd, &one, sizeof(one));
+    }
+}
+
+// Apunta un cambio y devuelve su versión. Si no hay memoria para el registro,
+// los clientes tendrán que volver a pedir el listado completo
+uint64_t change_record(ChangeLog *log, bool added, const char *name, const char *owner,
+                       const char *ip, int port) {
+    uint64_t version = atomic_fetch_add(&catalog_version, 1) + 1;
+    if (log->entries == NULL && (log->entries = malloc(CHANGELOG_CAPACITY * sizeof(Change))) == NULL) {
+        log->floor = version;
+        return version;
+    }
+    if (log->count == CHANGELOG_CAPACITY) {
+        Change *old = &log->entries[log->start];
+        log->floor = old->version;
+        release(old->name);
+        release(old->owner);
+        release(old->ip);
+        log->start = (log->start + 1) % CHANGELOG_CAPACITY;
+        log->count--;
+    }
+
+    Change *c = &log->entries[(log->start + log->count++) % CHANGELOG_CAPACITY];
+    c->version = version;
+    c->added = added;
+    c->name = retain(name);
+    c->owner = owner ? retain(owner) : NULL;
+    c->ip = ip ? retain(ip) : NULL;
+    c->port = port;
+    c->owner_prev = -1;
+    c->prev_version = 0;
+    notify_subscribers();
+    return version;
+}
+
+// Apunta un cambio de los ficheros de owner y lo encadena con los anteriores
+// del mismo dueño, para que LIST_CONTENT_CHANGES no recorra todo el registro.
+// Cada enlace guarda también la versión del cambio al que apunta: si el
+// registro ya lo descartó, esa posición tiene otra versión y se sabe que
+// faltan cambios del dueño
+uint64_t file_change_record(User *owner, bool added, const char *name) {
+    uint64_t version = change_record(&file_changes, added, name, owner->username, NULL, 0);
+    if (file_changes.entries == NULL) {
+        owner->changes_tail = -1;
+        owner->changes_last = 0;
+        owner->changes_floor = version;
+        return version;
+    }
+    int slot = (file_changes.start + file_changes.count - 1) % CHANGELOG_CAPACITY;
+    file_changes.entries[slot].owner_prev = owner->changes_tail;
+    file_changes.entries[slot].prev_version = owner->changes_last;
+    owner->changes_tail = slot;
+    owner->changes_last = version;
+    return version;
+}
+
+// Posición en el registro del primer cambio posterior a since, o -1 si se han
+// descartado cambios posteriores a since y hay que pedir el listado completo
+int change_first_after(const ChangeLog *log, uint64_t since) {
+    if (since < log->floor) {
+        return -1;
+    }
+    int lo = 0, hi = log->count;
+    while (lo < hi) {
+        int mid = (lo + hi) / 2;
+        if (log->entries[(log->start + mid) % CHANGELOG_CAPACITY].version <= since) {
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+// La versión viaja como "<epoch>.<versión>" y el cursor de las páginas como
+// "<versión>:<nombre>" del último elemento enviado
+void reply_put_version(Reply *r, uint64_t version) {
+    char str[48];
+    int n = snprintf(str, sizeof(str), "%016llx.%llu",
+                     (unsigned long long)catalog_epoch, (unsigned long long)version);
+    reply_put(r, str, n + 1);
+}
+
+// Devuelve la versión de un token de este arranque del servidor o -1
+int parse_version(const char *token, uint64_t *version) {
+    char *end;
+    if (strtoull(token, &end, 16) != catalog_epoch || *end != '.') {
+        return -1;
+    }
+    *version = strtoull(end + 1, &end, 10);
+    if (*end != '\0' || *version > atomic_load(&catalog_version)) {
+        return -1;
+    }
+    return 0;
+}
+
+void reply_put_cursor(Reply *r, uint64_t version, const char *name) {
+    char str[MAX_STRING + 32];
+    int n = snprintf(str, sizeof(str), "%llu:%s", (unsigned long long)version, name);
+    reply_put(r, str, n + 1);
+}
+
+// Separa un cursor en versión y nombre. La primera página se pide con "0:"
+int parse_cursor(const char *cursor, uint64_t *version, const char **name) {
+    char *end;
+    *version = strtoull(cursor, &end, 10);
+    if (*end != ':') {
+        return -1;
+    }
+    *name = end + 1;
+    return 0;
+}
+
+// Tamaño de página pedido, acotado
+#define LIST_DEFAULT_PAGE 1000
+#define LIST_MAX_PAGE 10000
+
+int page_size(const char *str) {
+    int n = atoi(str);
+    if (n <= 0) {
+        return LIST_DEFAULT_PAGE;
+    }
+    return n > LIST_MAX_PAGE ? LIST_MAX_PAGE : n;
+}
+
+// Añade y quita un usuario de la lista de conectados (users_lock en escritura)
+void connected_link(int idx) {
+    users[idx].conn_prev = connected_tail;
+    users[idx].conn_next = -1;
+    if (connected_tail != -1) users[connected_tail].conn_next = idx;
+    else connected_head = idx;
+    connected_tail = idx;
+    connected_count++;
+}
+
+void connected_unlink(int idx) {
+    if (users[idx].conn_prev != -1) users[users[idx].conn_prev].conn_next = users[idx].conn_next;
+    else connected_head = users[idx].conn_next;
+    if (users[idx].conn_next != -1) users[users[idx].conn_next].conn_prev = users[idx].conn_prev;
+    else connected_tail = users[idx].conn_prev;
+    connected_count--;
+}
+
+// Marca un usuario como conectado desde ip:port o como desconectado,
+// apuntando el cambio
+void user_set_connected(int idx, bool connected, const char *ip, int port) {
+    User *u = &users[idx];
+    if (u->connected) {
+        connected_unlink(idx);
+        change_record(&user_changes, false, u->username, NULL, NULL, 0);
+    }
+    u->connected = connected;
+    if (connected) {
+        release(u->ip);
+        u->ip = retain(ip);
+        u->port = port;
+        u->conn_version = change_record(&user_changes, true, u->username, NULL, u->ip, port);
+        connected_link(idx);
+    }
+}
+
+// Las funciones siguientes modifican el directorio. user_add y user_remove
+// necesitan users_lock en escritura (y user_remove también files_lock);
+// file_add y file_remove necesitan files_lock en escritura y users_lock al
+// menos en lectura, porque la lista de ficheros cuelga de la entrada del
+// usuario y mover un fichero necesita find_user.
+
+// Añade un usuario. Devuelve su posición o -1 si no hay sitio
+int user_add(const char *username) {
+    if ((max_users > 0 && user_count >= max_users) ||
+        array_reserve((void **)&users, &user_capacity, sizeof(User), user_count + 1) < 0 ||
+        users_index_reserve(user_count + 1) < 0) {
+        return -1;
+    }
+    const char *name = intern(username);
+    const char *ip = intern("");
+    if (name == NULL || ip == NULL) {
+        release(name);
+        release(ip);
+        return -1;
+    }
+    int idx = user_count++;
+    User *u = &users[idx];
+    u->username = name;
+    u->ip = ip;
+    u->port = 0;
+    u->connected = false;
+    u->files_head = u->files_tail = -1;
+    u->nfiles = 0;
+    u->conn_version = 0;
+    u->conn_prev = u->conn_next = -1;
+    // Los cambios anteriores son de otro usuario con el mismo nombre
+    u->changes_tail = -1;
+    u->changes_last = 0;
+    u->changes_floor = atomic_load(&catalog_version);
+    user_index_link(idx);
+    return idx;
+}
+
+void file_remove(int idx);
+
+// Añade un fichero al final de la lista de su dueño. Devuelve su posición o -1
+int file_add(int owner_idx, const char *filename, const char *description) {
+    if ((max_files > 0 && file_count >= max_files) ||
+        array_reserve((void **)&files, &file_capacity, sizeof(FileEntry), file_count + 1) < 0 ||
+        files_index_reserve(file_count + 1) < 0) {
+        return -1;
+    }
+    User *owner = &users[owner_idx];
+    const char *name = intern(filename);
+    const char *desc = intern(description);
+    const char *owner_name = intern(owner->username);
+    const char *hash = intern("");
+    if (name == NULL || desc == NULL || owner_name == NULL || hash == NULL) {
+        release(name);
+        release(desc);
+        release(owner_name);
+        release(hash);
+        return -1;
+    }
+    int idx = file_count++;
+    FileEntry *f = &files[idx];
+    f->filename = name;
+    f->description = desc;
+    f->owner = owner_name;
+    f->hash = hash;
+    f->version = file_change_record(owner, true, name);
+    file_index_link(idx);
+
+    f->owner_prev = owner->files_tail;
+    f->owner_next = -1;
+    if (owner->files_tail != -1) {
+        files[owner->files_tail].owner_next = idx;
+    } else {
+        owner->files_head = idx;
+    }
+    owner->files_tail = idx;
+    owner->nfiles++;
+
+    if (search_index_add(idx) < 0) {
+        file_remove(idx);
+        return -1;
+    }
+    return idx;
+}
+
+// Quita un fichero y ocupa su hueco con el último, corrigiendo los enlaces que
+// apuntaban a la posición del que se mueve
+void file_remove(int idx) {
+    FileEntry *f = &files[idx];
+    User *owner = &users[find_user(f->owner)];
+
+    *file_key_ref(idx) = f->hnext;
+    *file_name_ref(idx) = f->name_next;
+    if (f->owner_prev != -1) files[f->owner_prev].owner_next = f->owner_next;
+    else owner->files_head = f->owner_next;
+    if (f->owner_next != -1) files[f->owner_next].owner_prev = f->owner_prev;
+    else owner->files_tail = f->owner_prev;
+    owner->nfiles--;
+    search_index_remove(idx);
+    file_change_record(owner, false, f->filename);
+
+    release(f->filename);
+    release(f->description);
+    release(f->owner);
+    release(f->hash);
+
+    int last = --file_count;
+    if (idx == last) {
+        return;
+    }
+    FileEntry *moved = &files[last];
+    User *moved_owner = &users[find_user(moved->owner)];
+    *file_key_ref(last) = idx;
+    *file_name_ref(last) = idx;
+    if (moved->owner_prev != -1) files[moved->owner_prev].owner_next = idx;
+    else moved_owner->files_head = idx;
+    if (moved->owner_next != -1) files[moved->owner_next].owner_prev = idx;
+    else moved_owner->files_tail = idx;
+    for (int p = moved->terms; p != -1; p = postings[p].file_next) {
+        postings[p].file = idx;
+    }
+    files[idx] = *moved;
+}
+
+// Quita un usuario junto con todos sus ficheros
+void user_remove(int idx) {
+    while (users[idx].files_head != -1) {
+        file_remove(users[idx].files_head);
+    }
+
+    if (users[idx].connected) {
+        user_set_connected(idx, false, NULL, 0);
+    }
+
+    *user_chain_ref(idx) = users[idx].hnext;
+    release(users[idx].username);
+    release(users[idx].ip);
+    int last = --user_count;
+    if (idx != last) {
+        User *moved = &users[last];
+        *user_chain_ref(last) = idx;
+        if (moved->connected) {
+            if (moved->conn_prev != -1) users[moved->conn_prev].conn_next = idx;
+            else connected_head = idx;
+            if (moved->conn_next != -1) users[moved->conn_next].conn_prev = idx;
+            else connected_tail = idx;
+        }
+        users[idx] = *moved;
+    }
+}
+
+// Persistencia del directorio (opción -d). Cada REGISTER, UNREGISTER,
+// PUBLISH, DELETE y SET_HASH se apunta en un registro de escritura anticipada
+// (wal-<generación>.log) mientras se tiene el cerrojo del directorio, así que
+// los registros siguen el orden en que se aplicaron los cambios. Un hilo los
+// escribe por grupos y, con -y fsync (por defecto), termina cada grupo con
+// fdatasync; el handler responde al cliente cuando su registro ya está escrito.
+// Cuando el WAL pasa de WAL_SNAPSHOT_BYTES se guarda una instantánea compacta
+// del directorio (snapshot.dat) y se empieza otro WAL. Al arrancar se carga la
+// instantánea y se aplican los WAL posteriores; si el último acaba en un
+// registro a medias (caída durante una escritura) se trunca ahí. El estado de
+// conexión no se guarda: tras recuperar, todos los usuarios están
+// desconectados hasta su próximo CONNECT.
+//
+// Registro: longitud (u32) y CRC32 (u32) de los datos, tipo (u8) y campos
+// (u16 de longitud y bytes). Instantánea: "P2PSNAP1", generación del primer
+// WAL que no incluye (u64), número de usuarios y de ficheros (u32, para
+// reservar sitio antes de cargarlos) y, por usuario, su nombre,
+// su número de ficheros (u32) y nombre, descripción y raíz de cada uno, en
+// orden de publicación; al final el CRC32 de todo lo anterior.
+#define WAL_SNAPSHOT_BYTES (64 * 1024 * 1024)
+#define PATH_MAX_LEN 1024
+#define WAL_REGISTER 'R'
+#define WAL_UNREGISTER 'U'
+#define WAL_PUBLISH 'P'
+#define WAL_DELETE 'D'
+#define WAL_SET_HASH 'H'
+
+const char *data_dir = NULL;
+bool wal_fsync = true;
+int wal_fd = -1;
+uint64_t wal_gen = 0;                // Generación del WAL abierto
+uint64_t wal_file_bytes = 0;         // Tamaño del WAL abierto
+Reply wal_buf;                       // Registros apuntados y aún sin escribir
+uint64_t wal_appended = 0;           // Bytes apuntados desde el arranque
+uint64_t wal_written = 0;            // Bytes ya escritos (y sincronizados)
+bool wal_failed = false;             // El WAL no se pudo escribir: no se confirman más cambios
+pthread_mutex_t wal_mutex = PTHREAD_MUTEX_INITIALIZER;
+pthread_cond_t wal_pending_cond = PTHREAD_COND_INITIALIZER;
+pthread_cond_t wal_written_cond = PTHREAD_COND_INITIALIZER;
+
+uint32_t crc_table[256];
+
+void crc_init(void) {
+    for (uint32_t i = 0; i < 256; i++) {
+        uint32_t c = i;
+        for (int k = 0; k < 8; k++) {
+            c = (c & 1) ? 0xEDB88320u ^ (c >> 1) : c >> 1;
+        }
+        crc_table[i] = c;
+    }
+}
+
+uint32_t crc32_update(uint32_t crc, const void *data, size_t n) {
+    const unsigned char *p = data;
+    crc = ~crc;
+    while (n--) {
+        crc = crc_table[(crc ^ *p++) & 0xFF] ^ (crc >> 8);
+    }
+    return ~crc;
+}
+
+void put_u16(Reply *r, uint16_t v) { reply_put(r, &v, sizeof(v)); }
+void put_u32(Reply *r, uint32_t v) { reply_put(r, &v, sizeof(v)); }
+
+void put_field(Reply *r, const char *s) {
+    size_t n = strlen(s);
+    put_u16(r, (uint16_t)n);
+    reply_put(r, s, n);
+}
+
+// Apunta un cambio con hasta cuatro campos (los que sobran, NULL). Se llama
+// con el cerrojo del directorio que protege el cambio. Devuelve la posición
+// que hay que pasar a wal_wait, o 0 si no hay persistencia. Si el registro no
+// cabe en memoria el WAL queda fallido: sin él, recuperar saltaría este cambio
+uint64_t wal_log(char type, const char *a, const char *b, const char *c, const char *d) {
+    if (wal_fd < 0) {
+        return 0;
+    }
+    const char *fields[4] = {a, b, c, d};
+
+    pthread_mutex_lock(&wal_mutex);
+    size_t start = wal_buf.len;
+    put_u32(&wal_buf, 0);
+    put_u32(&wal_buf, 0);
+    reply_put(&wal_buf, &type, 1);
+    for (int i = 0; i < 4 && fields[i] != NULL; i++) {
+        put_field(&wal_buf, fields[i]);
+    }
+    if (wal_buf.failed) {
+        fprintf(stderr, "s> Error: sin memoria para el WAL, no se confirmarán más cambios\n");
+        wal_buf.failed = false;
+        wal_buf.len = start;
+        wal_failed = true;
+        pthread_cond_broadcast(&wal_written_cond);
+    } else {
+        uint32_t len = wal_buf.len - start - 8;
+        uint32_t crc = crc32_update(0, wal_buf.data + start + 8, len);
+        memcpy(wal_buf.data + start, &len, 4);
+        memcpy(wal_buf.data + start + 4, &crc, 4);
+        wal_appended += wal_buf.len - start;
+        pthread_cond_signal(&wal_pending_cond);
+    }
+    // Con el WAL fallido el cambio no llegará a disco: su espera debe fallar
+    uint64_t lsn = wal_failed ? UINT64_MAX : wal_appended;
+    pthread_mutex_unlock(&wal_mutex);
+    return lsn;
+}
+
+// Espera a que estén escritos los registros hasta lsn. Se llama sin cerrojos
+// del directorio, para que los cambios de otros clientes entren en el mismo grupo.
+// Devuelve 0 si están en disco o -1 si el WAL falló antes de escribirlos, en
+// cuyo caso el cambio no se debe confirmar al cliente
+int wal_wait(uint64_t lsn) {
+    if (lsn == 0) {
+        return 0;
+    }
+    pthread_mutex_lock(&wal_mutex);
+    while (wal_written < lsn && !wal_failed) {
+        pthread_cond_wait(&wal_written_cond, &wal_mutex);
+    }
+    int result = (wal_written < lsn) ? -1 : 0;
+    pthread_mutex_unlock(&wal_mutex);
+    return result;
+}
+
+int write_all(int fd, const char *data, size_t len) {
+    while (len > 0) {
+        ssize_t w = write(fd, data, len);
+        if (w < 0) {
+            if (errno == EINTR) continue;
+            return -1;
+        }
+        data += w;
+        len -= w;
+    }
+    return 0;
+}
+
+// Hilo que escribe los registros apuntados, todos los pendientes de una vez.
+// Si una escritura falla no se sabe qué parte del grupo llegó al disco, así que
+// el WAL queda fallido: se despierta a los que esperan para que respondan con
+// error y el hilo termina. El servidor sigue atendiendo consultas, pero ya no
+// confirma cambios; hay que reiniciarlo para recuperar el estado del disco
+void *wal_writer_thread(void *arg) {
+    pthread_mutex_lock(&wal_mutex);
+    for (;;) {
+        while (wal_buf.len == 0 && !wal_failed) {
+            pthread_cond_wait(&wal_pending_cond, &wal_mutex);
+        }
+        if (wal_failed) {
+            break;
+        }
+        Reply batch = wal_buf;
+        reply_init(&wal_buf);
+        uint64_t upto = wal_appended;
+        int fd = wal_fd;
+        pthread_mutex_unlock(&wal_mutex);
+
+        bool ok = write_all(fd, batch.data, batch.len) == 0 && (!wal_fsync || fdatasync(fd) == 0);
+        if (!ok) {
+            perror("s> Error escribiendo el WAL, no se confirmarán más cambios");
+        }
+        free(batch.data);
+
+        pthread_mutex_lock(&wal_mutex);
+        if (ok) {
+            wal_written = upto;
+            wal_file_bytes += batch.len;
+        } else {
+            wal_failed = true;
+        }
+        pthread_cond_broadcast(&wal_written_cond);
+    }
+    pthread_mutex_unlock(&wal_mutex);
+    return NULL;
+}
+
+void persist_path(char *path, size_t n, const char *name) {
+    snprintf(path, n, "%s/%s", data_dir, name);
+}
+
+void wal_path(char *path, size_t n, uint64_t gen) {
+    snprintf(path, n, "%s/wal-%08llu.log", data_dir, (unsigned long long)gen);
+}
+
+int sync_data_dir(void) {
+    int fd = open(data_dir, O_RDONLY | O_DIRECTORY);
+    if (fd < 0) {
+        return -1;
+    }
+    int r = fsync(fd);
+    close(fd);
+    return r;
+}
+
+// Generaciones de los WAL del directorio de datos, ordenadas
+int wal_list(uint64_t **gens) {
+    DIR *dir = opendir(data_dir);
+    if (dir == NULL) {
+        return -1;
+    }
+    int count = 0, capacity = 0;
+    *gens = NULL;
+    struct dirent *de;
+    while ((de = readdir(dir)) != NULL) {
+        unsigned long long gen;
+        char tail;
+        if (sscanf(de->d_name, "wal-%llu.lo%c", &gen, &tail) == 2 && tail == 'g') {
+            if (array_reserve((void **)gens, &capacity, sizeof(uint64_t), count + 1) < 0) {
+                break;
+            }
+            (*gens)[count++] = gen;
+        }
+    }
+    closedir(dir);
+    for (int i = 1; i < count; i++) {
+        for (int j = i; j > 0 && (*gens)[j - 1] > (*gens)[j]; j--) {
+            uint64_t t = (*gens)[j];
+            (*gens)[j] = (*gens)[j - 1];
+            (*gens)[j - 1] = t;
+        }
+    }
+    return count;
+}
+
+// Lector de un fichero cargado en memoria
+typedef struct {
+    const char *data;
+    size_t len;
+    size_t pos;
+} Cursor;
+
+int get_bytes(Cursor *c, void *out, size_t n) {
+    if (c->len - c->pos < n) {
+        return -1;
+    }
+    memcpy(out, c->data + c->pos, n);
+    c->pos += n;
+    return 0;
+}
+
+int get_field(Cursor *c, char out[MAX_STRING]) {
+    uint16_t n;
+    if (get_bytes(c, &n, sizeof(n)) < 0 || n >= MAX_STRING || get_bytes(c, out, n) < 0) {
+        return -1;
+    }
+    out[n] = '\0';
+    return 0;
+}
+
+char *read_file(const char *path, size_t *len) {
+    int fd = open(path, O_RDONLY);
+    if (fd < 0) {
+        return NULL;
+    }
+    struct stat st;
+    char *data = NULL;
+    if (fstat(fd, &st) == 0 && (data = malloc(st.st_size ? st.st_size : 1)) != NULL) {
+        size_t done = 0;
+        while (done < (size_t)st.st_size) {
+            ssize_t r = read(fd, data + done, st.st_size - done);
+            if (r <= 0) {
+                if (r < 0 && errno == EINTR) continue;
+                break;
+            }
+            done += r;
+        }
+        *len = done;
+    }
+    close(fd);
+    return data;
+}
+
+void file_set_hash(int idx, const char *hash) {
+    const char *root = intern(hash);
+    if (root != NULL) {
+        release(files[idx].hash);
+        files[idx].hash = root;
+    }
+}
+
+// Aplica un registro del WAL al directorio
+void persist_apply(char type, char fields[4][MAX_STRING]) {
+    int user_idx = find_user(fields[0]);
+    int file_idx;
+    switch (type) {
+    case WAL_REGISTER:
+        if (user_idx == -1) user_add(fields[0]);
+        break;
+    case WAL_UNREGISTER:
+        if (user_idx != -1) user_remove(user_idx);
+        break;
+    case WAL_PUBLISH:
+        if (user_idx != -1 && find_file(fields[1], fields[0]) == -1 &&
+            (file_idx = file_add(user_idx, fields[1], fields[2])) != -1 && fields[3][0] != '\0') {
+            file_set_hash(file_idx, fields[3]);
+        }
+        break;
+    case WAL_DELETE:
+        if ((file_idx = find_file(fields[1], fields[0])) != -1) file_remove(file_idx);
+        break;
+    case WAL_SET_HASH:
+        if ((file_idx = find_file(fields[1], fields[0])) != -1) file_set_hash(file_idx, fields[2]);
+        break;
+    }
+}
+
+int wal_fields(char type) {
+    switch (type) {
+    case WAL_REGISTER: case WAL_UNREGISTER: return 1;
+    case WAL_DELETE: return 2;
+    case WAL_SET_HASH: return 3;
+    case WAL_PUBLISH: return 4;
+    default: return -1;
+    }
+}
+
+// Aplica los registros de un WAL. Devuelve los bytes válidos del principio
+size_t wal_replay(const char *data, size_t len, long *records) {
+    Cursor c = {data, len, 0};
+    char fields[4][MAX_STRING];
+    for (;;) {
+        size_t start = c.pos;
+        uint32_t rec_len, crc;
+        char type;
+        if (get_bytes(&c, &rec_len, 4) < 0 || get_bytes(&c, &crc, 4) < 0 ||
+            c.len - c.pos < rec_len || crc32_update(0, c.data + c.pos, rec_len) != crc) {
+            return start;
+        }
+        Cursor rec = {c.data + c.pos, rec_len, 0};
+        c.pos += rec_len;
+        int n = (get_bytes(&rec, &type, 1) < 0) ? -1 : wal_fields(type);
+        for (int i = 0; i < 4; i++) {
+            fields[i][0] = '\0';
+        }
+        for (int i = 0; i < n; i++) {
+            if (get_field(&rec, fields[i]) < 0) {
+                n = -1;
+            }
+        }
+        if (n < 0) {
+            return start;
+        }
+        persist_apply(type, fields);
+        (*records)++;
+    }
+}
+
+// Carga snapshot.dat. Devuelve la generación del primer WAL que hay que
+// aplicar, 0 si no hay instantánea o -1 si está dañada
+long long snapshot_load(void) {
+    char path[PATH_MAX_LEN];
+    persist_path(path, sizeof(path), "snapshot.dat");
+    size_t len;
+    char *data = read_file(path, &len);
+    if (data == NULL) {
+        return errno == ENOENT ? 0 : -1;
+    }
+
+    uint32_t crc = 0;
+    uint64_t gen;
+    uint32_t nusers, nfiles_total;
+    Cursor c = {data, len >= 4 ? len - 4 : 0, 0};
+    char magic[8];
+    if (len >= 4) {
+        memcpy(&crc, data + len - 4, 4);
+    }
+    if (len < 4 || crc32_update(0, data, len - 4) != crc ||
+        get_bytes(&c, magic, 8) < 0 || memcmp(magic, "P2PSNAP1", 8) != 0 ||
+        get_bytes(&c, &gen, 8) < 0 || get_bytes(&c, &nusers, 4) < 0 || get_bytes(&c, &nfiles_total, 4) < 0) {
+        free(data);
+        return -1;
+    }
+    // Con todo reservado los índices no se rehacen mientras se carga
+    if (array_reserve((void **)&users, &user_capacity, sizeof(User), nusers) < 0 ||
+        users_index_reserve(nusers) < 0 ||
+        array_reserve((void **)&files, &file_capacity, sizeof(FileEntry), nfiles_total) < 0 ||
+        files_index_reserve(nfiles_total) < 0) {
+        free(data);
+        return -1;
+    }
+
+    char name[MAX_STRING], filename[MAX_STRING], description[MAX_STRING], hash[MAX_STRING];
+    for (uint32_t u = 0; u < nusers; u++) {
+        uint32_t nfiles;
+        if (get_field(&c, name) < 0 || get_bytes(&c, &nfiles, 4) < 0) {
+            free(data);
+            return -1;
+        }
+        int user_idx = user_add(name);
+        for (uint32_t f = 0; f < nfiles; f++) {
+            if (get_field(&c, filename) < 0 || get_field(&c, description) < 0 || get_field(&c, hash) < 0) {
+                free(data);
+                return -1;
+            }
+            int file_idx = (user_idx == -1) ? -1 : file_add(user_idx, filename, description);
+            if (file_idx != -1 && hash[0] != '\0') {
+                file_set_hash(file_idx, hash);
+            }
+        }
+    }
+    free(data);
+    return (long long)gen;
+}
+
+// Guarda una instantánea y empieza un WAL nuevo. Los cambios se detienen
+// mientras se copia el directorio a memoria, no mientras se escribe a disco
+int snapshot_write(void) {
+    Reply snap;
+    reply_init(&snap);
+
+    dir_lock(&users_lock, DIR_READ);
+    dir_lock(&files_lock, DIR_READ);
+
+    // Sin cambios posibles: se espera a que el WAL abierto esté escrito y se
+    // pasa al siguiente, que solo tendrá cambios posteriores a la instantánea
+    char path[PATH_MAX_LEN];
+    pthread_mutex_lock(&wal_mutex);
+    while (wal_written < wal_appended && !wal_failed) {
+        pthread_cond_wait(&wal_written_cond, &wal_mutex);
+    }
+    // Con el WAL fallido la memoria tiene cambios no confirmados: no se guardan
+    if (wal_failed) {
+        pthread_mutex_unlock(&wal_mutex);
+        dir_unlock(&files_lock);
+        dir_unlock(&users_lock);
+        free(snap.data);
+        return -1;
+    }
+    wal_path(path, sizeof(path), wal_gen + 1);
+    int fd = open(path, O_WRONLY | O_CREAT | O_APPEND, 0644);
+    int old_fd = wal_fd;
+    if (fd >= 0) {
+        wal_fd = fd;
+        wal_gen++;
+        wal_file_bytes = 0;
+    }
+    uint64_t gen = wal_gen;
+    pthread_mutex_unlock(&wal_mutex);
+
+    if (fd >= 0) {
+        reply_put(&snap, "P2PSNAP1", 8);
+        reply_put(&snap, &gen, sizeof(gen));
+        put_u32(&snap, user_count);
+        put_u32(&snap, file_count);
+        for (int u = 0; u < user_count; u++) {
+            put_field(&snap, users[u].username);
+            put_u32(&snap, users[u].nfiles);
+            for (int f = users[u].files_head; f != -1; f = files[f].owner_next) {
+                put_field(&snap, files[f].filename);
+                put_field(&snap, files[f].description);
+                put_field(&snap, files[f].hash);
+            }
+        }
+    }
+    dir_unlock(&files_lock);
+    dir_unlock(&users_lock);
+
+    if (fd < 0) {
+        perror("s> Error creando el WAL");
+        return -1;
+    }
+    close(old_fd);
+    if (snap.failed) {
+        fprintf(stderr, "s> Error: sin memoria para la instantánea\n");
+        return -1;
+    }
+    put_u32(&snap, crc32_update(0, snap.data, snap.len));
+
+    char tmp[PATH_MAX_LEN];
+    persist_path(tmp, sizeof(tmp), "snapshot.tmp");
+    persist_path(path, sizeof(path), "snapshot.dat");
+    int sfd = open(tmp, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+    int result = -1;
+    if (sfd >= 0 && write_all(sfd, snap.data, snap.len) == 0 && fsync(sfd) == 0 &&
+        rename(tmp, path) == 0 && sync_data_dir() == 0) {
+        result = 0;
+    } else {
+        perror("s> Error guardando la instantánea");
+    }
+    if (sfd >= 0) close(sfd);
+    free(snap.data);
+
+    // Los WAL anteriores ya están en la instantánea
+    uint64_t *gens;
+    int n = (result == 0) ? wal_list(&gens) : -1;
+    for (int i = 0; i < n && gens[i] < gen; i++) {
+        wal_path(path, sizeof(path), gens[i]);
+        unlink(path);
+    }
+    if (n >= 0) free(gens);
+    return result;
+}
+
+void *snapshot_thread(void *arg) {
+    for (;;) {
+        sleep(1);
+        pthread_mutex_lock(&wal_mutex);
+        bool due = wal_file_bytes >= WAL_SNAPSHOT_BYTES && !wal_failed;
+        pthread_mutex_unlock(&wal_mutex);
+        if (due) {
+            struct timespec t0, t1;
+            clock_gettime(CLOCK_MONOTONIC, &t0);
+            if (snapshot_write() == 0) {
+                clock_gettime(CLOCK_MONOTONIC, &t1);
+                printf("s> Instantánea del directorio guardada en %.3f s\n",
+                       (t1.tv_sec - t0.tv_sec) + (t1.tv_nsec - t0.tv_nsec) / 1e9);
+            }
+        }
+    }
+    return NULL;
+}
+
+// Recupera el directorio de data_dir y abre el WAL. Se llama antes de
+// atender clientes
+int persist_open(const char *dir, bool fsync_each) {
+    data_dir = dir;
+    wal_fsync = fsync_each;
+    crc_init();
+    reply_init(&wal_buf);
+    if (mkdir(dir, 0755) < 0 && errno != EEXIST) {
+        perror("s> Error creando el directorio de datos");
+        return -1;
+    }
+
+    struct timespec t0, t1;
+    clock_gettime(CLOCK_MONOTONIC, &t0);
+    long long first = snapshot_load();
+    if (first < 0) {
+        fprintf(stderr, "s> Error: %s/snapshot.dat está dañado\n", dir);
+        return -1;
+    }
+
+    uint64_t *gens;
+    int n = wal_list(&gens);
+    if (n < 0) {
+        perror("s> Error leyendo el directorio de datos");
+        return -1;
+    }
+    long records = 0;
+    char path[PATH_MAX_LEN];
+    wal_gen = first;
+    for (int i = 0; i < n; i++) {
+        if (gens[i] < (uint64_t)first) {
+            continue;
+        }
+        wal_path(path, sizeof(path), gens[i]);
+        size_t len = 0;
+        char *data = read_file(path, &len);
+        if (data == NULL) {
+            perror("s> Error leyendo el WAL");
+            free(gens);
+            return -1;
+        }
+        size_t valid = wal_replay(data, len, &records);
+        free(data);
+        if (valid < len) {
+            if (i != n - 1) {
+                fprintf(stderr, "s> Error: %s está dañado\n", path);
+                free(gens);
+                return -1;
+            }
+            // Registro a medias al final del último WAL: se descarta
+            printf("s> Descartados %zu bytes incompletos al final de %s\n", len - valid, path);
+            if (truncate(path, valid) < 0) {
+                perror("s> Error truncando el WAL");
+                free(gens);
+                return -1;
+            }
+        }
+        wal_gen = gens[i];
+        wal_file_bytes += valid;
+    }
+    free(gens);
+
+    wal_path(path, sizeof(path), wal_gen);
+    wal_fd = open(path, O_WRONLY | O_CREAT | O_APPEND, 0644);
+    if (wal_fd < 0) {
+        perror("s> Error abriendo el WAL");
+        return -1;
+    }
+    clock_gettime(CLOCK_MONOTONIC, &t1);
+    printf("s> Recuperados %d usuarios y %d ficheros (%ld registros del WAL) en %.3f s\n",
+           user_count, file_count, records, (t1.tv_sec - t0.tv_sec) + (t1.tv_nsec - t0.tv_nsec) / 1e9);
+
+    pthread_t thread;
+    if (pthread_create(&thread, NULL, wal_writer_thread, NULL) != 0 ||
+        pthread_create(&thread, NULL, snapshot_thread, NULL) != 0) {
+        perror("s> Error creando los hilos de persistencia");
+        return -1;
+    }
+    return 0;
+}
+
+// Operación REGISTER
+int handle_register(int client_fd, const char *username) {
+    dir_lock(&users_lock, DIR_WRITE);
+    
+    int result;
+    uint64_t lsn = 0;
+    if (find_user(username) != -1) {
+        result = 1; // Usuario ya existe
+    } else if (user_add(username) == -1) {
+        result = 2; // Error del sistema
+    } else {
+        lsn = wal_log(WAL_REGISTER, username, NULL, NULL, NULL);
+        result = 0; // Éxito
+    }
+    
+    dir_unlock(&users_lock);
+    if (wal_wait(lsn) < 0) {
+        result = 2; // Error del sistema: el cambio no llegó al WAL
+    }
+    send_code(client_fd, result);
+    return result; // Retorna el resultado de la operación, aunque no se use
+}
+
+// Operación UNREGISTER
+int handle_unregister(int client_fd, const char *username) {
+    dir_lock(&users_lock, DIR_WRITE);
+    
+    int result;
+    uint64_t lsn = 0;
+    int user_idx = find_user(username);
+    if (user_idx == -1) {
+        result = 1; // Usuario no existe
+    } else {
+        // Eliminar el usuario y sus archivos
+        dir_lock(&files_lock, DIR_WRITE);
+        user_remove(user_idx);
+        lsn = wal_log(WAL_UNREGISTER, username, NULL, NULL, NULL);
+        dir_unlock(&files_lock);
+        
+        result = 0; // Éxito
+    }
+    
+    dir_unlock(&users_lock);
+    if (wal_wait(lsn) < 0) {
+        result = 2; // Error del sistema: el cambio no llegó al WAL
+    }
+    send_code(client_fd, result);
+    return result;
+}
+
+// Operación CONNECT
+int handle_connect(int client_fd, const char *username, const char *port_str) {
+    // Obtener IP del cliente
+    struct sockaddr_in addr;
+    socklen_t addr_size = sizeof(struct sockaddr_in);
+    getpeername(client_fd, (struct sockaddr *)&addr, &addr_size);
+
+    dir_lock(&users_lock, DIR_WRITE);
+    
+    int result;
+    int user_idx = find_user(username);
+    if (user_idx == -1) {
+        result = 1; // Usuario no existe
+    } else if (users[user_idx].connected) {
+        result = 2; // Ya conectado
+    } else {
+        const char *ip = intern(inet_ntoa(addr.sin_addr));
+        if (ip == NULL) {
+            result = 3; // Error del sistema
+        } else {
+            user_set_connected(user_idx, true, ip, atoi(port_str));
+            release(ip);
+            result = 0; // Éxito
+        }
+    }
+    
+    dir_unlock(&users_lock);
+    send_code(client_fd, result);
+    return result;
+}
+
+// Operación DISCONNECT
+int handle_disconnect(int client_fd, const char *username) {
+    dir_lock(&users_lock, DIR_WRITE);
+    
+    int result;
+    int user_idx = find_user(username);
+    if (user_idx == -1) {
+        result = 1; // Usuario no existe
+    } else if (!users[user_idx].connected) {
+        result = 2; // No conectado
+    } else {
+        user_set_connected(user_idx, false, NULL, 0);
+        result = 0; // Éxito
+    }
+    
+    dir_unlock(&users_lock);
+    send_code(client_fd, result);
+    return result;
+}
+
+// Operación PUBLISH
+int handle_publish(int client_fd, const char *username, const char *filename, const char *description) {
+    // users[] solo se lee: la lista de ficheros del usuario la protege files_lock
+    dir_lock(&users_lock, DIR_READ);
+    int user_idx = find_user(username);
+    
+    int result;
+    uint64_t lsn = 0;
+    if (user_idx == -1) {
+        result = 1; // Usuario no existe
+    } else if (!users[user_idx].connected) {
+        result = 2; // Usuario no conectado
+    } else {
+        dir_lock(&files_lock, DIR_WRITE);
+        if (find_file(filename, username) != -1) {
+            result = 3; // Archivo ya publicado
+        } else if (file_add(user_idx, filename, description) == -1) {
+            result = 4; // Error del sistema
+        } else {
+            lsn = wal_log(WAL_PUBLISH, username, filename, description, "");
+            result = 0; // Éxito
+        }
+        dir_unlock(&files_lock);
+    }
+    dir_unlock(&users_lock);
+    
+    if (wal_wait(lsn) < 0) {
+        result = 4; // Error del sistema: el cambio no llegó al WAL
+    }
+    send_code(client_fd, result);
+    return result;
+}
+
+// Operación PUBLISH_DIR: publica count ficheros en una sola petición. Tras la
+// cabecera llegan count registros de tres campos (fichero, descripción y raíz
+// Merkle, o "-" si aún no se conoce) que se leen de la conexión y se insertan
+// por lotes de PUBLISH_DIR_BATCH, tomando los cerrojos una vez por lote.
+// Responde 0 y una cadena con un dígito por fichero con el resultado de su
+// PUBLISH (0 a 4), 4 si no hay memoria, o 5 si la cabecera o algún registro no
+// son válidos o no llegan a tiempo; en ese caso la conexión queda
+// desincronizada y el servidor la cierra al leer la siguiente petición. En
+// modo epoll el worker queda ocupado mientras llegan los registros, así que
+// cada lectura espera como mucho PUBLISH_DIR_TIMEOUT_S y la operación entera
+// PUBLISH_DIR_TIMEOUT_S más un segundo por cada PUBLISH_DIR_MIN_RATE registros.
+#define PUBLISH_DIR_BATCH 1024
+#define PUBLISH_DIR_MAX 1000000
+#define PUBLISH_DIR_TIMEOUT_S 10
+#define PUBLISH_DIR_MIN_RATE 1000
+
+typedef struct {
+    char filename[MAX_STRING];
+    char description[MAX_STRING];
+    char hash[MAX_STRING];
+} PublishRecord;
+
+// Inserta un lote con los cerrojos tomados una sola vez. Devuelve la posición
+// del WAL que hay que esperar
+uint64_t publish_batch(const char *username, const PublishRecord *batch, int n, char *results) {
+    uint64_t lsn = 0;
+    dir_lock(&users_lock, DIR_READ);
+    int user_idx = find_user(username);
+    if (user_idx == -1 || !users[user_idx].connected) {
+        memset(results, user_idx == -1 ? '1' : '2', n);
+        dir_unlock(&users_lock);
+        return lsn;
+    }
+
+    dir_lock(&files_lock, DIR_WRITE);
+    for (int i = 0; i < n; i++) {
+        const PublishRecord *rec = &batch[i];
+        int idx;
+        if (find_file(rec->filename, username) != -1) {
+            results[i] = '3'; // Archivo ya publicado
+        } else if ((idx = file_add(user_idx, rec->filename, rec->description)) == -1) {
+            results[i] = '4'; // Error del sistema
+        } else {
+            results[i] = '0';
+            bool has_hash = strcmp(rec->hash, "-") != 0;
+            if (has_hash) {
+                file_set_hash(idx, rec->hash);
+            }
+            lsn = wal_log(WAL_PUBLISH, username, rec->filename, rec->description, has_hash ? rec->hash : "");
+        }
+    }
+    dir_unlock(&files_lock);
+    dir_unlock(&users_lock);
+    return lsn;
+}
+
+void handle_publish_dir(Connection *conn, const char *username, const char *count_str) {
+    char *end;
+    long count = strtol(count_str, &end, 10);
+    if (*end != '\0' || count < 0 || count > PUBLISH_DIR_MAX) {
+        send_code(conn->fd, 5);
+        return;
+    }
+
+    PublishRecord *batch = malloc(PUBLISH_DIR_BATCH * sizeof(PublishRecord));
+    char *results = malloc(count + 1);
+    bool valid = batch != NULL && results != NULL;
+
+    // Plazo para recibir los registros; el de lectura de la conexión se
+    // restaura al terminar
+    struct timeval saved_timeout;
+    socklen_t saved_len = sizeof(saved_timeout);
+    bool timeout_set = getsockopt(conn->fd, SOL_SOCKET, SO_RCVTIMEO, &saved_timeout, &saved_len) == 0;
+    if (timeout_set) {
+        struct timeval timeout = {PUBLISH_DIR_TIMEOUT_S, 0};
+        timeout_set = setsockopt(conn->fd, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof(timeout)) == 0;
+    }
+    uint64_t deadline = now_ns() + (PUBLISH_DIR_TIMEOUT_S + count / PUBLISH_DIR_MIN_RATE) * 1000000000ULL;
+
+    // Los registros se leen aunque falte memoria, para no dejar la conexión a medias
+    long done = 0;
+    uint64_t lsn = 0;
+    bool received = true;
+    while (received && done < count) {
+        int n = 0;
+        while (n < PUBLISH_DIR_BATCH && done + n < count) {
+            PublishRecord discard;
+            PublishRecord *rec = valid ? &batch[n] : &discard;
+            if (now_ns() > deadline ||
+                readLine(conn, rec->filename, MAX_STRING) <= 0 ||
+                readLine(conn, rec->description, MAX_STRING) <= 0 ||
+                readLine(conn, rec->hash, MAX_STRING) <= 0) {
+                received = false;
+                break;
+            }
+            n++;
+        }
+        if (!received) {
+            break;
+        }
+        if (valid) {
+            uint64_t batch_lsn = publish_batch(username, batch, n, results + done);
+            if (batch_lsn != 0) lsn = batch_lsn;
+        }
+        done += n;
+    }
+    if (timeout_set) {
+        setsockopt(conn->fd, SOL_SOCKET, SO_RCVTIMEO, &saved_timeout, sizeof(saved_timeout));
+    }
+
+    if (!received) {
+        free(batch);
+        free(results);
+        send_code(conn->fd, 5);
+        return;
+    }
+
+    // Si el lote no llegó al WAL no se confirma ninguno de sus archivos
+    if (wal_wait(lsn) < 0) {
+        valid = false;
+    }
+    Reply reply;
+    reply_init(&reply);
+    if (valid) {
+        results[count] = '\0';
+        reply_put(&reply, results, count + 1);
+    }
+    reply_send(&reply, conn->fd, valid ? 0 : 4, 4);
+    free(batch);
+    free(results);
+}
+
+// Operación DELETE
+int handle_delete(int client_fd, const char *username, const char *filename) {
+    dir_lock(&users_lock, DIR_READ);
+    int user_idx = find_user(username);
+    
+    int result;
+    uint64_t lsn = 0;
+    if (user_idx == -1) {
+        result = 1; // Usuario no existe
+    } else if (!users[user_idx].connected) {
+        result = 2; // Usuario no conectado
+    } else {
+        dir_lock(&files_lock, DIR_WRITE);
+        int file_idx = find_file(filename, username);
+        if (file_idx == -1) {
+            result = 3; // Archivo no publicado
+        } else {
+            // Eliminar archivo (el último ocupa su posición)
+            file_remove(file_idx);
+            lsn = wal_log(WAL_DELETE, username, filename, NULL, NULL);
+            result = 0; // Éxito
+        }
+        dir_unlock(&files_lock);
+    }
+    dir_unlock(&users_lock);
+    
+    if (wal_wait(lsn) < 0) {
+        result = 4; // Error del sistema: el cambio no llegó al WAL
+    }
+    send_code(client_fd, result);
+    return result;
+}
+
+// Operación SET_HASH: el cliente registra la raíz Merkle de un fichero que ya
+// publicó, calculada en segundo plano después del PUBLISH
+int handle_set_hash(int client_fd, const char *username, const char *filename, const char *hash) {
+    dir_lock(&users_lock, DIR_READ);
+    int user_idx = find_user(username);
+
+    int result;
+    uint64_t lsn = 0;
+    if (user_idx == -1) {
+        result = 1; // Usuario no existe
+    } else if (!users[user_idx].connected) {
+        result = 2; // Usuario no conectado
+    } else {
+        dir_lock(&files_lock, DIR_WRITE);
+        int file_idx = find_file(filename, username);
+        if (file_idx == -1) {
+            result = 3; // Archivo no publicado
+        } else {
+            const char *root = intern(hash);
+            if (root == NULL) {
+                result = 4; // Error del sistema
+            } else {
+                release(files[file_idx].hash);
+                files[file_idx].hash = root;
+                lsn = wal_log(WAL_SET_HASH, username, filename, hash, NULL);
+                result = 0; // Éxito
+            }
+        }
+        dir_unlock(&files_lock);
+    }
+    dir_unlock(&users_lock);
+
+    if (wal_wait(lsn) < 0) {
+        result = 4; // Error del sistema: el cambio no llegó al WAL
+    }
+    send_code(client_fd, result);
+    return result;
+}
+
+// Operación LIST_USERS
+int handle_list_users(int client_fd, const char *username) {
+    Reply reply;
+    reply_init(&reply);
+
+    dir_lock(&users_lock, DIR_READ);
+    int user_idx = find_user(username);
+    
+    int result;
+    if (user_idx == -1) {
+        result = 1; // Usuario no existe
+    } else if (!users[user_idx].connected) {
         result = 2; // Usuario no conectado
     } else {
-        pthread_mutex_lock(&files_mutex);
-        int file_idx = find_file(filename, username);
-        if (file_idx == -1) {
-            result = 3; // Archivo no publicado
+        result = 0; // Éxito
+
+        // Usuario, IP y puerto de cada usuario conectado
+        reply_put_int(&reply, connected_count);
+        for (int i = connected_head; i != -1; i = users[i].conn_next) {
+            reply_put_str(&reply, users[i].username);
+            reply_put_str(&reply, users[i].ip);
+            reply_put_int(&reply, users[i].port);
+        }
+    }
+    dir_unlock(&users_lock);
+
+    reply_send(&reply, client_fd, result, 3);
+    return result;
+}
+
+void handle_list_content(int client_fd, char *username, char *target_user) {
+    printf("s> OPERATION LIST_CONTENT FROM %s\n", username);
+
+    Reply reply;
+    reply_init(&reply);
+
+    dir_lock(&users_lock, DIR_READ);
+    int requester_idx = find_user(username);
+    int target_idx = find_user(target_user);
+
+    int result;
+    if (requester_idx == -1) {
+        result = 1; // USER DOES NOT EXIST
+    } else if (!users[requester_idx].connected) {
+        result = 2; // USER NOT CONNECTED
+    } else if (target_idx == -1) {
+        result = 3; // REMOTE USER DOES NOT EXIST
+    } else {
+        // Los archivos de target_user están encadenados desde su entrada
+        dir_lock(&files_lock, DIR_READ);
+        int count = users[target_idx].nfiles;
+        if (count == 0) {
+            result = 4; // USER HAS NO FILES
         } else {
-            // Eliminar archivo (mover último elemento a esta posición)
-            for (int i = file_idx; i < file_count - 1; i++) {
-                files[i] = files[i + 1];
+            result = 0;
+            reply_put_int(&reply, count);
+            for (int i = users[target_idx].files_head; i != -1; i = files[i].owner_next) {
+                reply_put_str(&reply, files[i].filename);
             }
-            memset(&files[file_count - 1], 0, sizeof(FileEntry));  // Limpieza
-            file_count--;
-            
-            result = 0; // Éxito
         }
-        pthread_mutex_unlock(&files_mutex);
+        dir_unlock(&files_lock);
     }
-    
-    write(client_fd, &result, sizeof(result));
+    dir_unlock(&users_lock);
+
+    reply_send(&reply, client_fd, result, 5);
+}
+
+// Operación LIST_USERS_PAGE: una página de usuarios conectados en orden de
+// conexión a partir del cursor ("0:" para empezar). Responde la versión del
+// catálogo, el cursor de la página siguiente (vacío si es la última), el
+// número de usuarios y usuario, IP y puerto de cada uno. Si el usuario del
+// cursor se ha desconectado, sigue por el primero que se conectó después.
+int handle_list_users_page(int client_fd, const char *username, const char *cursor, const char *size_str) {
+    Reply reply;
+    reply_init(&reply);
+
+    uint64_t after;
+    const char *name;
+    int size = page_size(size_str);
+
+    dir_lock(&users_lock, DIR_READ);
+    int user_idx = find_user(username);
+
+    int result;
+    if (user_idx == -1) {
+        result = 1; // Usuario no existe
+    } else if (!users[user_idx].connected) {
+        result = 2; // Usuario no conectado
+    } else if (parse_cursor(cursor, &after, &name) < 0) {
+        result = 3; // Cursor no válido
+    } else {
+        result = 0; // Éxito
+        int i = find_user(name);
+        if (i != -1 && users[i].connected && users[i].conn_version == after) {
+            i = users[i].conn_next;
+        } else {
+            for (i = connected_head; i != -1 && users[i].conn_version <= after; i = users[i].conn_next);
+        }
+
+        int last = i;
+        int count = 0;
+        for (int j = i; j != -1 && count < size; j = users[j].conn_next, count++) {
+            last = j;
+        }
+
+        reply_put_version(&reply, atomic_load(&catalog_version));
+        if (count == size && users[last].conn_next != -1) {
+            reply_put_cursor(&reply, users[last].conn_version, users[last].username);
+        } else {
+            reply_put_str(&reply, "");
+        }
+        reply_put_int(&reply, count);
+        for (; count > 0; i = users[i].conn_next, count--) {
+            reply_put_str(&reply, users[i].username);
+            reply_put_str(&reply, users[i].ip);
+            reply_put_int(&reply, users[i].port);
+        }
+    }
+    dir_unlock(&users_lock);
+
+    reply_send(&reply, client_fd, result, 3);
     return result;
 }
 
-// Operación LIST_USERS
-int handle_list_users(int client_fd, const char *username) {
-    pthread_mutex_lock(&users_mutex);
+// Operación LIST_USERS_CHANGES: usuarios que se han conectado ("+", con IP y
+// puerto) o desconectado ("-") desde la versión since, en orden. Si los
+// cambios ya no están en el registro o since es de otro arranque del
+// servidor, responde 4 y el cliente tiene que pedir el listado completo.
+int handle_list_users_changes(int client_fd, const char *username, const char *since_str) {
+    Reply reply;
+    reply_init(&reply);
+
+    dir_lock(&users_lock, DIR_READ);
     int user_idx = find_user(username);
-    pthread_mutex_unlock(&users_mutex);
-    
+
+    uint64_t since;
+    int first;
     int result;
     if (user_idx == -1) {
         result = 1; // Usuario no existe
     } else if (!users[user_idx].connected) {
         result = 2; // Usuario no conectado
+    } else if (parse_version(since_str, &since) < 0 || (first = change_first_after(&user_changes, since)) < 0) {
+        result = 4; // Hay que pedir el listado completo
+    } else {
+        result = 0; // Éxito
+        reply_put_version(&reply, atomic_load(&catalog_version));
+        reply_put_int(&reply, user_changes.count - first);
+        for (int k = first; k < user_changes.count; k++) {
+            const Change *c = &user_changes.entries[(user_changes.start + k) % CHANGELOG_CAPACITY];
+            reply_put_str(&reply, c->added ? "+" : "-");
+            reply_put_str(&reply, c->name);
+            reply_put_str(&reply, c->added ? c->ip : "");
+            reply_put_int(&reply, c->port);
+        }
+    }
+    dir_unlock(&users_lock);
+
+    reply_send(&reply, client_fd, result, 3);
+    return result;
+}
+
+// Operación LIST_CONTENT_PAGE: una página de los ficheros de target_user en
+// orden de publicación, con la misma respuesta que LIST_USERS_PAGE pero solo
+// con el nombre de cada fichero. Un usuario sin ficheros no es un error aquí.
+void handle_list_content_page(int client_fd, const char *username, const char *target_user,
+                              const char *cursor, const char *size_str) {
+    Reply reply;
+    reply_init(&reply);
+
+    uint64_t after;
+    const char *name;
+    int size = page_size(size_str);
+
+    dir_lock(&users_lock, DIR_READ);
+    int requester_idx = find_user(username);
+    int target_idx = find_user(target_user);
+
+    int result;
+    if (requester_idx == -1) {
+        result = 1; // USER DOES NOT EXIST
+    } else if (!users[requester_idx].connected) {
+        result = 2; // USER NOT CONNECTED
+    } else if (target_idx == -1) {
+        result = 3; // REMOTE USER DOES NOT EXIST
+    } else if (parse_cursor(cursor, &after, &name) < 0) {
+        result = 5; // Cursor no válido
+    } else {
+        result = 0;
+        dir_lock(&files_lock, DIR_READ);
+        int i = find_file(name, target_user);
+        if (i != -1 && files[i].version == after) {
+            i = files[i].owner_next;
+        } else {
+            for (i = users[target_idx].files_head; i != -1 && files[i].version <= after; i = files[i].owner_next);
+        }
+
+        int last = i;
+        int count = 0;
+        for (int j = i; j != -1 && count < size; j = files[j].owner_next, count++) {
+            last = j;
+        }
+
+        reply_put_version(&reply, atomic_load(&catalog_version));
+        if (count == size && files[last].owner_next != -1) {
+            reply_put_cursor(&reply, files[last].version, files[last].filename);
+        } else {
+            reply_put_str(&reply, "");
+        }
+        reply_put_int(&reply, count);
+        for (; count > 0; i = files[i].owner_next, count--) {
+            reply_put_str(&reply, files[i].filename);
+        }
+        dir_unlock(&files_lock);
+    }
+    dir_unlock(&users_lock);
+
+    reply_send(&reply, client_fd, result, 5);
+}
+
+// Operación LIST_CONTENT_CHANGES: ficheros de target_user publicados ("+") o
+// borrados ("-") desde la versión since. Responde 6 si hay que pedir el
+// listado completo, es decir, si faltan cambios de target_user posteriores a
+// since; los cambios de otros usuarios no cuentan.
+void handle_list_content_changes(int client_fd, const char *username, const char *target_user,
+                                 const char *since_str) {
+    Reply reply;
+    reply_init(&reply);
+
+    dir_lock(&users_lock, DIR_READ);
+    int requester_idx = find_user(username);
+    int target_idx = find_user(target_user);
+
+    uint64_t since;
+    int result;
+    if (requester_idx == -1) {
+        result = 1; // USER DOES NOT EXIST
+    } else if (!users[requester_idx].connected) {
+        result = 2; // USER NOT CONNECTED
+    } else if (target_idx == -1) {
+        result = 3; // REMOTE USER DOES NOT EXIST
+    } else {
+        const User *target = &users[target_idx];
+        dir_lock(&files_lock, DIR_READ);
+        // La cadena de target_user va del cambio más reciente al más antiguo:
+        // se cuentan los posteriores a since y se envían en el orden contrario
+        result = 0;
+        if (parse_version(since_str, &since) < 0 || since < target->changes_floor) {
+            result = 6; // Hay que pedir el listado completo
+        }
+        int count = 0;
+        uint64_t expected = target->changes_last;
+        for (int slot = target->changes_tail; result == 0 && expected > since; ) {
+            const Change *c = &file_changes.entries[slot];
+            if (c->version != expected || c->owner != target->username) {
+                result = 6; // El registro ya descartó cambios de target_user
+                break;
+            }
+            count++;
+            expected = c->prev_version;
+            slot = c->owner_prev;
+        }
+        int *slots = (result == 0 && count > 0) ? malloc(count * sizeof(int)) : NULL;
+        if (slots == NULL && result == 0 && count > 0) {
+            result = 5;
+        }
+        if (result == 0) {
+            for (int k = count, slot = target->changes_tail; k > 0; slot = file_changes.entries[slot].owner_prev) {
+                slots[--k] = slot;
+            }
+            reply_put_version(&reply, atomic_load(&catalog_version));
+            reply_put_int(&reply, count);
+            for (int k = 0; k < count; k++) {
+                const Change *c = &file_changes.entries[slots[k]];
+                reply_put_str(&reply, c->added ? "+" : "-");
+                reply_put_str(&reply, c->name);
+            }
+        }
+        free(slots);
+        dir_unlock(&files_lock);
+    }
+    dir_unlock(&users_lock);
+
+    reply_send(&reply, client_fd, result, 5);
+}
+
+// Operación SUBSCRIBE: la conexión deja de atender peticiones y el servidor
+// envía por ella los cambios del catálogo. Primero un estado completo
+// (SNAPSHOT) y después lotes de cambios (EVENTS), cada uno con la versión del
+// catálogo, el número de eventos y los eventos:
+//   U+ usuario ip puerto     usuario conectado
+//   U- usuario               usuario desconectado
+//   F+ dueño fichero         fichero publicado
+//   F- dueño fichero         fichero borrado
+// Solo se envían los usuarios que cumplen el patrón de usuario (fnmatch) y los
+// ficheros cuyo dueño cumple el patrón de usuario y cuyo nombre cumple el de
+// fichero. Un único hilo atiende a todos los suscriptores: envía como mucho un
+// lote cada SUBSCRIBE_COALESCE_MS y, mientras un suscriptor no ha recibido el
+// lote anterior, no le prepara otro. Un lote lleva el efecto neto de los
+// cambios desde el anterior (un fichero publicado y borrado en medio no
+// aparece). Si un suscriptor se queda tan atrás que los cambios ya no están en
+// los registros, recibe otro SNAPSHOT.
+#define SUBSCRIBE_COALESCE_MS 50
+#define SUBSCRIBE_MAX 1024
+
+typedef struct {
+    int fd;
+    char user_pattern[MAX_STRING];
+    char file_pattern[MAX_STRING];
+    uint64_t version;               // Versión del último lote preparado
+    bool snapshot;                  // Necesita el estado completo
+    Reply out;                      // Lote pendiente de enviar
+    size_t sent;
+} Subscriber;
+
+// Suscriptores, protegidos por subscribers_mutex. Los nuevos los añade
+// handle_subscribe; el hilo de notificaciones los atiende y los quita
+Subscriber *subscribers[SUBSCRIBE_MAX];
+int subscriber_count = 0;
+pthread_mutex_t subscribers_mutex = PTHREAD_MUTEX_INITIALIZER;
+pthread_once_t notifier_once = PTHREAD_ONCE_INIT;
+bool notifier_started = false;
+
+bool subscriber_wants(const Subscriber *sub, const char *user, const char *filename) {
+    return fnmatch(sub->user_pattern, user, 0) == 0 &&
+           (filename == NULL || fnmatch(sub->file_pattern, filename, 0) == 0);
+}
+
+void event_put(Reply *r, const Change *c) {
+    if (c->owner == NULL) {
+        reply_put_str(r, c->added ? "U+" : "U-");
+        reply_put_str(r, c->name);
+        if (c->added) {
+            reply_put_str(r, c->ip);
+            reply_put_int(r, c->port);
+        }
+    } else {
+        reply_put_str(r, c->added ? "F+" : "F-");
+        reply_put_str(r, c->owner);
+        reply_put_str(r, c->name);
+    }
+}
+
+// Prepara el estado completo que ve el suscriptor. Se llama con users_lock y
+// files_lock en lectura
+void subscriber_snapshot(Subscriber *sub, uint64_t version) {
+    Reply events;
+    reply_init(&events);
+    int count = 0;
+    for (int i = connected_head; i != -1; i = users[i].conn_next) {
+        if (subscriber_wants(sub, users[i].username, NULL)) {
+            Change c = {0, true, users[i].username, NULL, users[i].ip, users[i].port, -1, 0};
+            event_put(&events, &c);
+            count++;
+        }
+    }
+    for (int i = 0; i < user_count; i++) {
+        if (!subscriber_wants(sub, users[i].username, NULL)) {
+            continue;
+        }
+        for (int f = users[i].files_head; f != -1; f = files[f].owner_next) {
+            if (fnmatch(sub->file_pattern, files[f].filename, 0) == 0) {
+                Change c = {0, true, files[f].filename, users[i].username, NULL, 0, -1, 0};
+                event_put(&events, &c);
+                count++;
+            }
+        }
+    }
+
+    reply_put_str(&sub->out, "SNAPSHOT");
+    reply_put_version(&sub->out, version);
+    reply_put_int(&sub->out, count);
+    if (events.failed) {
+        sub->out.failed = true;
+    } else if (events.len > 0) {
+        reply_put(&sub->out, events.data, events.len);
+    }
+    free(events.data);
+    sub->snapshot = false;
+    sub->version = version;
+}
+
+// Efecto neto de varios cambios sobre el mismo usuario o fichero. Las cadenas
+// de los registros son de intern(), así que se comparan por puntero
+typedef struct {
+    const char *name;
+    const char *owner;
+    int last;                       // Último cambio de la clave en el lote
+    bool first_added;               // El primero fue un alta: antes no existía
+} Coalesced;
+
+// Prepara los cambios posteriores a la versión del suscriptor. Se llama con
+// users_lock y files_lock en lectura. Devuelve -1 si no hay memoria
+int subscriber_events(Subscriber *sub, int user_first, int file_first, uint64_t version) {
+    // Cambios de los dos registros que le interesan, en orden de versión
+    int total = (user_changes.count - user_first) + (file_changes.count - file_first);
+    const Change **pending = malloc((total ? total : 1) * sizeof(*pending));
+    if (pending == NULL) {
+        return -1;
+    }
+    int n = 0;
+    int u = user_first, f = file_first;
+    while (u < user_changes.count || f < file_changes.count) {
+        const Change *cu = (u < user_changes.count) ? &user_changes.entries[(user_changes.start + u) % CHANGELOG_CAPACITY] : NULL;
+        const Change *cf = (f < file_changes.count) ? &file_changes.entries[(file_changes.start + f) % CHANGELOG_CAPACITY] : NULL;
+        const Change *c;
+        if (cf == NULL || (cu != NULL && cu->version < cf->version)) {
+            c = cu;
+            u++;
+        } else {
+            c = cf;
+            f++;
+        }
+        if (c->owner == NULL ? subscriber_wants(sub, c->name, NULL) : subscriber_wants(sub, c->owner, c->name)) {
+            pending[n++] = c;
+        }
+    }
+
+    size_t nslots = 16;
+    while (nslots < (size_t)n * 2) {
+        nslots *= 2;
+    }
+    Coalesced *slots = calloc(nslots, sizeof(Coalesced));
+    int *slot_of = malloc((n ? n : 1) * sizeof(int));
+    if (slots == NULL || slot_of == NULL) {
+        free(pending);
+        free(slots);
+        free(slot_of);
+        return -1;
+    }
+    for (int i = 0; i < n; i++) {
+        size_t h = ((uintptr_t)pending[i]->name * 31 + (uintptr_t)pending[i]->owner) * 0x9E3779B97F4A7C15ULL;
+        size_t k = (h >> 16) & (nslots - 1);
+        while (slots[k].name != NULL && (slots[k].name != pending[i]->name || slots[k].owner != pending[i]->owner)) {
+            k = (k + 1) & (nslots - 1);
+        }
+        if (slots[k].name == NULL) {
+            slots[k].name = pending[i]->name;
+            slots[k].owner = pending[i]->owner;
+            slots[k].first_added = pending[i]->added;
+        }
+        slots[k].last = i;
+        slot_of[i] = k;
+    }
+
+    int count = 0;
+    for (int pass = 0; pass < 2; pass++) {
+        for (int i = 0; i < n; i++) {
+            const Coalesced *slot = &slots[slot_of[i]];
+            if (slot->last != i || (slot->first_added && !pending[i]->added)) {
+                continue;
+            }
+            if (pass == 0) {
+                count++;
+            } else {
+                event_put(&sub->out, pending[i]);
+            }
+        }
+        if (pass == 0) {
+            reply_put_str(&sub->out, "EVENTS");
+            reply_put_version(&sub->out, version);
+            reply_put_int(&sub->out, count);
+        }
+    }
+    if (count == 0) {
+        free(sub->out.data); // Nada que enviar: se descarta la cabecera
+        reply_init(&sub->out);
+    }
+    free(pending);
+    free(slots);
+    free(slot_of);
+    sub->version = version;
+    return 0;
+}
+
+void subscriber_close(int i) {
+    Subscriber *sub = subscribers[i];
+    close(sub->fd);
+    free(sub->out.data);
+    free(sub);
+    subscribers[i] = subscribers[--subscriber_count];
+    atomic_fetch_sub(&subscriber_total, 1);
+}
+
+long monotonic_ms(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1000 + ts.tv_nsec / 1000000;
+}
+
+// Hilo que atiende a todos los suscriptores
+void *notifier_thread(void *arg) {
+    struct pollfd fds[SUBSCRIBE_MAX + 1];
+    long last_batch = 0;
+
+    for (;;) {
+        // Hay trabajo si algún suscriptor sin lote pendiente va por detrás
+        pthread_mutex_lock(&subscribers_mutex);
+        uint64_t current = atomic_load(&catalog_version);
+        bool work = false;
+        int n = subscriber_count;
+        fds[0].fd = notify_fd;
+        fds[0].events = POLLIN;
+        for (int i = 0; i < n; i++) {
+            Subscriber *sub = subscribers[i];
+            bool idle = sub->sent == sub->out.len;
+            work |= idle && (sub->snapshot || sub->version < current);
+            fds[i + 1].fd = sub->fd;
+            fds[i + 1].events = POLLIN | (idle ? 0 : POLLOUT);
+        }
+        pthread_mutex_unlock(&subscribers_mutex);
+
+        long wait = -1;
+        if (work) {
+            wait = last_batch + SUBSCRIBE_COALESCE_MS - monotonic_ms();
+            if (wait < 0) wait = 0;
+        }
+        if (poll(fds, n + 1, wait) < 0 && errno != EINTR) {
+            perror("Error en poll");
+            continue;
+        }
+        if (fds[0].revents & POLLIN) {
+            uint64_t value;
+            read(notify_fd, &value, sizeof(value));
+        }
+
+        pthread_mutex_lock(&subscribers_mutex);
+
+        // Los suscriptores no envían nada: lo que llegue se descarta y el
+        // cierre de la conexión termina la suscripción. Los nuevos
+        // suscriptores están al final y aún no tienen resultado de poll
+        for (int i = n - 1; i >= 0; i--) {
+            if (fds[i + 1].revents & (POLLIN | POLLHUP | POLLERR)) {
+                char discard[256];
+                ssize_t r = recv(subscribers[i]->fd, discard, sizeof(discard), MSG_DONTWAIT);
+                if (r == 0 || (r < 0 && errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR)) {
+                    subscriber_close(i);
+                }
+            }
+        }
+
+        // Preparar lotes para los suscriptores que ya enviaron el anterior
+        long now = monotonic_ms();
+        if (now - last_batch >= SUBSCRIBE_COALESCE_MS) {
+            atomic_store(&notify_pending, false);
+            dir_lock(&users_lock, DIR_READ);
+            dir_lock(&files_lock, DIR_READ);
+            uint64_t version = atomic_load(&catalog_version);
+            for (int i = 0; i < subscriber_count; i++) {
+                Subscriber *sub = subscribers[i];
+                if (sub->sent != sub->out.len || (!sub->snapshot && sub->version == version)) {
+                    continue;
+                }
+                free(sub->out.data);
+                reply_init(&sub->out);
+                sub->sent = 0;
+
+                int user_first = change_first_after(&user_changes, sub->version);
+                int file_first = change_first_after(&file_changes, sub->version);
+                if (sub->snapshot || user_first < 0 || file_first < 0) {
+                    subscriber_snapshot(sub, version);
+                } else if (subscriber_events(sub, user_first, file_first, version) < 0) {
+                    sub->out.failed = true;
+                }
+            }
+            dir_unlock(&files_lock);
+            dir_unlock(&users_lock);
+            last_batch = now;
+        }
+
+        // Enviar sin bloquearse lo que se pueda de cada lote
+        for (int i = subscriber_count - 1; i >= 0; i--) {
+            Subscriber *sub = subscribers[i];
+            if (sub->out.failed) {
+                subscriber_close(i); // Sin memoria para su lote
+                continue;
+            }
+            while (sub->sent < sub->out.len) {
+                ssize_t w = send(sub->fd, sub->out.data + sub->sent, sub->out.len - sub->sent,
+                                 MSG_DONTWAIT | MSG_NOSIGNAL);
+                if (w > 0) {
+                    sub->sent += w;
+                } else if (w < 0 && errno == EINTR) {
+                    continue;
+                } else {
+                    if (w < 0 && errno != EAGAIN && errno != EWOULDBLOCK) {
+                        subscriber_close(i);
+                    }
+                    break;
+                }
+            }
+        }
+        pthread_mutex_unlock(&subscribers_mutex);
+    }
+    return NULL;
+}
+
+void notifier_start(void) {
+    notify_fd = eventfd(0, EFD_NONBLOCK);
+    pthread_t thread;
+    if (notify_fd >= 0 && pthread_create(&thread, NULL, notifier_thread, NULL) == 0) {
+        pthread_detach(thread);
+        notifier_started = true;
+    }
+}
+
+// Devuelve 0 si la conexión ha pasado al hilo de notificaciones, que la
+// cerrará cuando termine la suscripción
+int handle_subscribe(int client_fd, const char *username, const char *user_pattern, const char *file_pattern) {
+    pthread_once(&notifier_once, notifier_start);
+
+    dir_lock(&users_lock, DIR_READ);
+    int user_idx = find_user(username);
+    int result;
+    if (user_idx == -1) {
+        result = 1; // Usuario no existe
+    } else if (!users[user_idx].connected) {
+        result = 2; // Usuario no conectado
+    } else {
+        result = 0;
+    }
+    dir_unlock(&users_lock);
+
+    Subscriber *sub = NULL;
+    if (result == 0 && (!notifier_started || (sub = malloc(sizeof(Subscriber))) == NULL)) {
+        result = 3; // Error del sistema
+    }
+    if (result != 0) {
+        send_code(client_fd, result);
+        return result;
+    }
+
+    sub->fd = client_fd;
+    strcpy(sub->user_pattern, user_pattern);
+    strcpy(sub->file_pattern, file_pattern);
+    sub->version = 0;
+    sub->snapshot = true;
+    reply_init(&sub->out);
+    sub->sent = 0;
+
+    // El código se envía antes de que el hilo de notificaciones pueda
+    // escribir en la conexión
+    pthread_mutex_lock(&subscribers_mutex);
+    if (subscriber_count == SUBSCRIBE_MAX) {
+        pthread_mutex_unlock(&subscribers_mutex);
+        free(sub);
+        send_code(client_fd, 3); // Demasiados suscriptores
+        return 3;
+    }
+    send_code(client_fd, 0);
+    subscribers[subscriber_count++] = sub;
+    atomic_fetch_add(&subscriber_total, 1);
+    pthread_mutex_unlock(&subscribers_mutex);
+
+    uint64_t one = 1;
+    write(notify_fd, &one, sizeof(one));
+    return 0;
+}
+
+// Operación LOOKUP_FILE: comprueba en una sola petición que owner publica el
+// fichero y está conectado, y devuelve su IP, puerto y raíz Merkle. Después
+// envía los demás usuarios conectados que publican un fichero con el mismo
+// nombre (usuario, IP, puerto y raíz), para descargar bloques de varios a la vez.
+int handle_lookup_file(int client_fd, const char *username, const char *owner, const char *filename) {
+    Reply reply;
+    reply_init(&reply);
+
+    dir_lock(&users_lock, DIR_READ);
+    dir_lock(&files_lock, DIR_READ);
+    int user_idx = find_user(username);
+    int owner_idx = find_user(owner);
+
+    int result;
+    int file_idx = -1;
+    if (user_idx == -1) {
+        result = 1; // Usuario no existe
+    } else if (!users[user_idx].connected) {
+        result = 2; // Usuario no conectado
+    } else if (owner_idx == -1) {
+        result = 3; // Usuario remoto no existe
+    } else if ((file_idx = find_file(filename, owner)) == -1) {
+        result = 4; // Archivo no publicado
+    } else if (!users[owner_idx].connected) {
+        result = 5; // Usuario remoto no conectado
     } else {
         result = 0; // Éxito
     }
-    unsigned char response_code = (unsigned char)result;
-    write(client_fd, &response_code, 1);
 
-    
     if (result == 0) {
-        // Solo enviar datos si el resultado fue exitoso
-        pthread_mutex_lock(&users_mutex);
-        
-        // Contar usuarios conectados
-        int connected_count = 0;
-        for (int i = 0; i < user_count; i++) {
-            if (users[i].connected) connected_count++;
+        // Dirección del propietario y raíz de su copia
+        reply_put_str(&reply, users[owner_idx].ip);
+        reply_put_int(&reply, users[owner_idx].port);
+        reply_put_str(&reply, files[file_idx].hash);
+
+        // Contar los demás propietarios conectados del fichero, recorriendo
+        // solo la cadena de su nombre
+        int first = files_by_name.heads[file_name_bucket(filename)];
+        int count = 0;
+        for (int i = first; i != -1; i = files[i].name_next) {
+            if (i == file_idx || strcmp(files[i].filename, filename) != 0) continue;
+            int seeder_idx = find_user(files[i].owner);
+            if (seeder_idx != -1 && users[seeder_idx].connected) count++;
         }
-        
-        // Enviar número de usuarios
-        char count_str[MAX_STRING];
-        snprintf(count_str, MAX_STRING, "%d", connected_count);
-        write(client_fd, count_str, strlen(count_str) + 1); // +1 para el null
-        
-        // Enviar información de cada usuario
-        for (int i = 0; i < user_count; i++) {
-            if (users[i].connected) {
-                write(client_fd, users[i].username, strlen(users[i].username) + 1);
-                write(client_fd, users[i].ip, strlen(users[i].ip) + 1);
-                
-                char port_str[MAX_STRING];
-                snprintf(port_str, MAX_STRING, "%d", users[i].port);
-                write(client_fd, port_str, strlen(port_str) + 1);
+        reply_put_int(&reply, count);
+
+        // Usuario, IP, puerto y raíz de cada uno
+        for (int i = first; i != -1; i = files[i].name_next) {
+            if (i == file_idx || strcmp(files[i].filename, filename) != 0) continue;
+            int seeder_idx = find_user(files[i].owner);
+            if (seeder_idx == -1 || !users[seeder_idx].connected) continue;
+
+            reply_put_str(&reply, users[seeder_idx].username);
+            reply_put_str(&reply, users[seeder_idx].ip);
+            reply_put_int(&reply, users[seeder_idx].port);
+            reply_put_str(&reply, files[i].hash);
+        }
+    }
+
+    dir_unlock(&files_lock);
+    dir_unlock(&users_lock);
+
+    reply_send(&reply, client_fd, result, 6);
+    return result;
+}
+
+#define SEARCH_MAX_RESULTS 1000
+
+// Comprueba si el fichero con términos ft es un resultado de la consulta q y
+// si es la primera vez que aparece al recorrer, en orden alfabético, los
+// términos que empiezan por prefix: solo se acepta desde word si ningún
+// término suyo anterior a word empieza también por prefix
+bool search_match(const TermList *ft, const TermList *q, const char *prefix, const char *word) {
+    size_t prefix_len = strlen(prefix);
+    for (int i = 0; i < ft->count; i++) {
+        if (strncmp(ft->terms[i], prefix, prefix_len) == 0 && strcmp(ft->terms[i], word) < 0) {
+            return false;
+        }
+    }
+    for (int j = 0; j < q->count; j++) {
+        size_t len = strlen(q->terms[j]);
+        bool matched = false;
+        for (int i = 0; i < ft->count && !matched; i++) {
+            matched = strncmp(ft->terms[i], q->terms[j], len) == 0;
+        }
+        if (!matched) {
+            return false;
+        }
+    }
+    return true;
+}
+
+// Operación SEARCH: ficheros cuyo nombre o descripción tiene, para cada
+// palabra de la consulta, alguna palabra que empieza por ella. Devuelve como
+// mucho limit resultados (dueño, fichero y descripción). Solo se recorre el
+// subárbol de la palabra con menos entradas y cada candidato se comprueba
+// con sus propios términos, así que el coste depende de los candidatos y no
+// del tamaño del catálogo.
+int handle_search(int client_fd, const char *username, const char *query, const char *limit_str) {
+    Reply reply;
+    reply_init(&reply);
+
+    TermList q, ft;
+    terms_split(&q, query, NULL);
+    int limit = atoi(limit_str);
+    if (limit <= 0 || limit > SEARCH_MAX_RESULTS) {
+        limit = SEARCH_MAX_RESULTS;
+    }
+
+    dir_lock(&users_lock, DIR_READ);
+    dir_lock(&files_lock, DIR_READ);
+    int user_idx = find_user(username);
+
+    int result;
+    int *found = NULL;
+    int nfound = 0;
+    if (user_idx == -1) {
+        result = 1; // Usuario no existe
+    } else if (!users[user_idx].connected) {
+        result = 2; // Usuario no conectado
+    } else if ((found = malloc(limit * sizeof(int))) == NULL) {
+        result = 3; // Error del sistema
+    } else {
+        result = 0; // Éxito
+
+        // Palabra de la consulta con menos entradas; si alguna no está en el
+        // índice no hay resultados
+        int start = -1, best = -1;
+        for (int j = 0; j < q.count; j++) {
+            int node = term_find(q.terms[j]);
+            if (node == -1) {
+                start = -1;
+                break;
+            }
+            if (start == -1 || term_nodes[node].count < term_nodes[start].count) {
+                start = node;
+                best = j;
+            }
+        }
+
+        // Recorrido en preorden del subárbol, llevando en word el término
+        // del nodo actual
+        char word[sizeof(q.text)];
+        size_t depth = 0;
+        if (start != -1) {
+            depth = strlen(q.terms[best]);
+            memcpy(word, q.terms[best], depth + 1);
+        }
+        int n = start;
+        while (n != -1 && nfound < limit) {
+            for (int p = term_nodes[n].postings; p != -1 && nfound < limit; p = postings[p].next) {
+                int f = postings[p].file;
+                terms_split(&ft, files[f].filename, files[f].description);
+                if (search_match(&ft, &q, q.terms[best], word)) {
+                    found[nfound++] = f;
+                }
+            }
+
+            if (term_nodes[n].child != -1) {
+                n = term_nodes[n].child;
+                word[depth++] = term_nodes[n].c;
+                word[depth] = '\0';
+                continue;
+            }
+            while (n != start && term_nodes[n].sibling == -1) {
+                n = term_nodes[n].parent;
+                word[--depth] = '\0';
+            }
+            if (n == start) {
+                break;
             }
+            n = term_nodes[n].sibling;
+            word[depth - 1] = term_nodes[n].c;
         }
-        pthread_mutex_unlock(&users_mutex);
-    }
-    
-    return result;
-}
 
-void handle_list_content(int client_fd, char *username, char *target_user) {
-    printf("s> OPERATION LIST_CONTENT FROM %s\n", username);
+        reply_put_int(&reply, nfound);
+        for (int i = 0; i < nfound; i++) {
+            reply_put_str(&reply, files[found[i]].owner);
+            reply_put_str(&reply, files[found[i]].filename);
+            reply_put_str(&reply, files[found[i]].description);
+        }
+    }
 
-    pthread_mutex_lock(&users_mutex);
-    int requester_idx = find_user(username);
-    int target_idx = find_user(target_user);
-    pthread_mutex_unlock(&users_mutex);
+    dir_unlock(&files_lock);
+    dir_unlock(&users_lock);
+    free(found);
 
-    unsigned char response_code = 0;
+    reply_send(&reply, client_fd, result, 3);
+    return result;
+}
 
-    if (requester_idx == -1) {
-        response_code = 1; // USER DOES NOT EXIST
-        write(client_fd, &response_code, 1);
-        return;
+// Número de parámetros (después del comando y la fecha) de cada operación
+typedef struct {
+    const char *name;
+    int nparams;
+} CommandSpec;
+
+const CommandSpec commands[] = {
+    {"REGISTER", 1},
+    {"UNREGISTER", 1},
+    {"CONNECT", 2},       // username, port
+    {"DISCONNECT", 1},
+    {"PUBLISH", 3},       // username, filename, description
+    {"DELETE", 2},        // username, filename
+    {"LIST_USERS", 1},
+    {"LIST_CONTENT", 2},  // username, target_user
+    {"LOOKUP_FILE", 3},   // username, owner, filename
+    {"SET_HASH", 3},      // username, filename, hash
+    {"SEARCH", 3},        // username, query, limit
+    {"LIST_USERS_PAGE", 3},       // username, cursor, page_size
+    {"LIST_USERS_CHANGES", 2},    // username, since
+    {"LIST_CONTENT_PAGE", 4},     // username, target_user, cursor, page_size
+    {"LIST_CONTENT_CHANGES", 3},  // username, target_user, since
+    {"SUBSCRIBE", 3},             // username, user_pattern, file_pattern
+    {"PUBLISH_DIR", 2},           // username, count (y count registros)
+    {"STATS", 1},                 // username
+};
+
+#define NUM_COMMANDS (int)(sizeof(commands) / sizeof(commands[0]))
+#define MAX_PARAMS 4
+
+// Petición completa leída de una conexión
+typedef struct {
+    char command[MAX_STRING];
+    char fecha[MAX_STRING];
+    char params[MAX_PARAMS][MAX_STRING];
+    int nparams;
+    const CommandSpec *spec;
+} Request;
+
+const CommandSpec *find_command(const char *name) {
+    for (int i = 0; i < NUM_COMMANDS; i++) {
+        if (strcmp(commands[i].name, name) == 0) {
+            return &commands[i];
+        }
     }
+    return NULL;
+}
 
-    if (!users[requester_idx].connected) {
-        response_code = 2; // USER NOT CONNECTED
-        write(client_fd, &response_code, 1);
-        return;
+// Lee una petición completa. Devuelve 1 si se leyó, 0 si el cliente cerró la
+// conexión antes de empezar otra petición y -1 si la petición no es válida.
+int read_request(Connection *conn, Request *req) {
+    ssize_t r = readLine(conn, req->command, MAX_STRING);
+    if (r == 0) {
+        return 0;
+    } else if (r < 0) {
+        return -1;
     }
 
-    if (target_idx == -1) {
-        response_code = 3; // REMOTE USER DOES NOT EXIST
-        write(client_fd, &response_code, 1);
-        return;
+    const CommandSpec *spec = find_command(req->command);
+    if (spec == NULL) {
+        printf("s> Error: Comando no reconocido\n");
+        return -1;
     }
 
-    // Buscar archivos publicados por target_user
-    pthread_mutex_lock(&files_mutex);
-    int count = 0;
-    for (int i = 0; i < file_count; i++) {
-        if (strcmp(files[i].owner, target_user) == 0) {
-            count++;
-        }
-    }
+    req->spec = spec;
 
-    if (count == 0) {
-        response_code = 4; // USER HAS NO FILES
-        write(client_fd, &response_code, 1);
-        pthread_mutex_unlock(&files_mutex);
-        return;
+    // Leer fecha
+    if (readLine(conn, req->fecha, MAX_STRING) <= 0) {
+        return -1;
     }
 
-    // Enviar código de éxito
-    response_code = 0;
-    write(client_fd, &response_code, 1);
-
-    // Enviar número de archivos
-    char count_str[MAX_STRING];
-    snprintf(count_str, MAX_STRING, "%d", count);
-    write(client_fd, count_str, strlen(count_str) + 1);
-
-    // Enviar nombres de archivos
-    for (int i = 0; i < file_count; i++) {
-        if (strcmp(files[i].owner, target_user) == 0) {
-            write(client_fd, files[i].filename, strlen(files[i].filename) + 1);
+    // Leer parámetros según el comando
+    for (req->nparams = 0; req->nparams < spec->nparams; req->nparams++) {
+        if (readLine(conn, req->params[req->nparams], MAX_STRING) <= 0) {
+            return -1;
         }
     }
-    pthread_mutex_unlock(&files_mutex);
+    return 1;
 }
 
+// Métricas del servidor, para la operación STATS y el endpoint de -e. Cada
+// petición actualiza al terminar los contadores atómicos de su comando: número
+// de peticiones por código de resultado e histograma de latencia (desde que se
+// ha leído hasta que se ha respondido). El histograma tiene cubos de potencias
+// de 2 en microsegundos: el cubo b cuenta las latencias menores que 2^b us y
+// mayores o iguales que 2^(b-1). Se mide aparte el tiempo de registrar_log_rpc.
+// Los tiempos de espera de los cerrojos son los de LockStats.
+#define LATENCY_BUCKETS 25              // Hasta 2^24 us (16,8 s); el último acumula el resto
+#define RESULT_CODES 8                  // Códigos 0..6; el último agrupa cualquier otro
 
+typedef struct {
+    atomic_ullong results[RESULT_CODES];
+    atomic_ullong latency[LATENCY_BUCKETS];
+    atomic_ullong latency_us;           // Suma de las latencias
+} CommandStats;
 
+typedef struct {
+    atomic_ullong latency[LATENCY_BUCKETS];
+    atomic_ullong latency_us;
+    atomic_ullong errors;
+} TimerStats;
+
+CommandStats command_stats[NUM_COMMANDS];
+TimerStats rpc_stats;                   // Llamadas a registrar_log_rpc
+atomic_ullong requests_rejected = 0;    // Comando desconocido o petición mal formada
+atomic_int requests_active = 0;         // Peticiones en curso (hilos ocupados)
+atomic_int connections_open = 0;
+atomic_ullong connections_total = 0;
+uint64_t started_ns = 0;
+
+int latency_bucket(uint64_t us) {
+    int b = (us == 0) ? 0 : 64 - __builtin_clzll(us);
+    return (b < LATENCY_BUCKETS) ? b : LATENCY_BUCKETS - 1;
+}
 
+void timer_record(TimerStats *t, uint64_t us) {
+    atomic_fetch_add_explicit(&t->latency[latency_bucket(us)], 1, memory_order_relaxed);
+    atomic_fetch_add_explicit(&t->latency_us, us, memory_order_relaxed);
+}
 
+void metrics_request_done(const CommandSpec *spec, int result, uint64_t us) {
+    CommandStats *st = &command_stats[spec - commands];
+    int code = (result >= 0 && result < RESULT_CODES - 1) ? result : RESULT_CODES - 1;
+    atomic_fetch_add_explicit(&st->results[code], 1, memory_order_relaxed);
+    atomic_fetch_add_explicit(&st->latency[latency_bucket(us)], 1, memory_order_relaxed);
+    atomic_fetch_add_explicit(&st->latency_us, us, memory_order_relaxed);
+}
 
-// Función principal para manejar cada cliente
-void *handle_client(void *arg) {
-    int client_fd = *(int *)arg;
-    free(arg); // Liberar memoria asignada para el descriptor del cliente
+void metrics_connection_opened(void) {
+    atomic_fetch_add_explicit(&connections_open, 1, memory_order_relaxed);
+    atomic_fetch_add_explicit(&connections_total, 1, memory_order_relaxed);
+}
 
-    char buffer[MAX_STRING];
-    char *command, *username, *param1 = NULL, *param2;
+void metrics_connection_closed(void) {
+    atomic_fetch_sub_explicit(&connections_open, 1, memory_order_relaxed);
+}
 
-    // Leer comando
-    if (readLine(client_fd, buffer, MAX_STRING) <= 0) {
-        close(client_fd);
-        return NULL;
+// Límite superior (en us) del cubo donde cae el percentil p de un histograma
+uint64_t histogram_quantile(const unsigned long long *counts, unsigned long long total, double p) {
+    unsigned long long rank = (unsigned long long)(p * total + 0.999999);
+    unsigned long long seen = 0;
+    for (int b = 0; b < LATENCY_BUCKETS; b++) {
+        seen += counts[b];
+        if (seen >= rank && seen > 0) {
+            return 1ULL << b;
+        }
     }
-    command = strdup(buffer);
+    return 1ULL << (LATENCY_BUCKETS - 1);
+}
 
-    // Leer fecha
-    char fecha[MAX_STRING];
-    if (readLine(client_fd, fecha, MAX_STRING) <= 0) {
-        free(command);
-        close(client_fd);
-        return NULL;
+unsigned long long histogram_load(atomic_ullong *latency, unsigned long long *counts) {
+    unsigned long long total = 0;
+    for (int b = 0; b < LATENCY_BUCKETS; b++) {
+        counts[b] = atomic_load_explicit(&latency[b], memory_order_relaxed);
+        total += counts[b];
     }
+    return total;
+}
 
-    // Imprimir la fecha recibida
-    printf("s> [FECHA] %s\n", fecha);
-
-    // Leer parámetros según el comando
-    if (strcmp(command, "REGISTER") == 0 || strcmp(command, "UNREGISTER") == 0 || 
-        strcmp(command, "DISCONNECT") == 0 || strcmp(command, "LIST_USERS") == 0) {
-        
-        // Comandos con 1 parámetro (username)
-        if (readLine(client_fd, buffer, MAX_STRING) <= 0) {
-            free(command);
-            close(client_fd);
-            return NULL;
-        }
-        username = strdup(buffer);
-        
-
-    } else if (strcmp(command, "DELETE") == 0) {
-        // DELETE necesita username y filename
-        if (readLine(client_fd, buffer, MAX_STRING) <= 0) {
-            free(command);
-            close(client_fd);
-            return NULL;
-        }
-        username = strdup(buffer);
+// Histograma en formato de texto de Prometheus. labels es la lista de
+// etiquetas sin llaves (puede ser "")
+void metrics_put_histogram(Reply *r, const char *name, const char *labels,
+                           atomic_ullong *latency, atomic_ullong *sum) {
+    unsigned long long counts[LATENCY_BUCKETS];
+    unsigned long long total = histogram_load(latency, counts);
+    const char *sep = labels[0] ? "," : "";
+    unsigned long long cumulative = 0;
+    for (int b = 0; b < LATENCY_BUCKETS - 1; b++) {
+        cumulative += counts[b];
+        reply_printf(r, "%s_bucket{%s%sle=\"%llu\"} %llu\n", name, labels, sep,
+                     (1ULL << b) - 1, cumulative);
+    }
+    reply_printf(r, "%s_bucket{%s%sle=\"+Inf\"} %llu\n", name, labels, sep, total);
+    char braces[96] = "";
+    if (labels[0]) {
+        snprintf(braces, sizeof(braces), "{%s}", labels);
+    }
+    reply_printf(r, "%s_sum%s %llu\n", name, braces, atomic_load(sum));
+    reply_printf(r, "%s_count%s %llu\n", name, braces, total);
+}
 
-        if (readLine(client_fd, buffer, MAX_STRING) <= 0) {
-            free(command);
-            free(username);
-            close(client_fd);
-            return NULL;
-        }
-        param1 = strdup(buffer); // filename
+// Percentiles 50, 95 y 99 estimados a partir del histograma (límite superior
+// del cubo), como métrica aparte
+void metrics_put_quantiles(Reply *r, const char *name, const char *labels, atomic_ullong *latency) {
+    unsigned long long counts[LATENCY_BUCKETS];
+    unsigned long long total = histogram_load(latency, counts);
+    if (total == 0) {
+        return;
+    }
+    const double quantiles[] = {0.5, 0.95, 0.99};
+    for (int q = 0; q < 3; q++) {
+        reply_printf(r, "%s{%s%squantile=\"%g\"} %llu\n", name, labels, labels[0] ? "," : "",
+                     quantiles[q], (unsigned long long)histogram_quantile(counts, total, quantiles[q]));
+    }
+}
 
-    } else if (strcmp(command, "LIST_CONTENT") == 0) {
-        // LIST_CONTENT necesita username y param1 (target_user)
-        if (readLine(client_fd, buffer, MAX_STRING) <= 0) {
-            free(command);
-            close(client_fd);
-            return NULL;
+// Todas las métricas en formato de texto de Prometheus
+void metrics_write(Reply *r) {
+    reply_printf(r, "# TYPE p2p_uptime_seconds gauge\np2p_uptime_seconds %.3f\n",
+                 (now_ns() - started_ns) / 1e9);
+    reply_printf(r, "# TYPE p2p_connections_open gauge\np2p_connections_open %d\n",
+                 atomic_load(&connections_open));
+    reply_printf(r, "# TYPE p2p_connections_total counter\np2p_connections_total %llu\n",
+                 atomic_load(&connections_total));
+    reply_printf(r, "# TYPE p2p_requests_active gauge\np2p_requests_active %d\n",
+                 atomic_load(&requests_active));
+    reply_printf(r, "# TYPE p2p_requests_rejected_total counter\np2p_requests_rejected_total %llu\n",
+                 atomic_load(&requests_rejected));
+    reply_printf(r, "# TYPE p2p_subscribers gauge\np2p_subscribers %d\n", atomic_load(&subscriber_total));
+
+    dir_lock(&users_lock, DIR_READ);
+    dir_lock(&files_lock, DIR_READ);
+    int users_registered = user_count, users_connected = connected_count, files_published = file_count;
+    dir_unlock(&files_lock);
+    dir_unlock(&users_lock);
+    reply_printf(r, "# TYPE p2p_users_registered gauge\np2p_users_registered %d\n", users_registered);
+    reply_printf(r, "# TYPE p2p_users_connected gauge\np2p_users_connected %d\n", users_connected);
+    reply_printf(r, "# TYPE p2p_files_published gauge\np2p_files_published %d\n", files_published);
+
+    // Peticiones por comando y código; solo los comandos que se han usado
+    bool used[NUM_COMMANDS];
+    reply_printf(r, "# TYPE p2p_requests_total counter\n");
+    for (int i = 0; i < NUM_COMMANDS; i++) {
+        used[i] = false;
+        for (int c = 0; c < RESULT_CODES; c++) {
+            unsigned long long n = atomic_load_explicit(&command_stats[i].results[c], memory_order_relaxed);
+            if (n == 0) {
+                continue;
+            }
+            used[i] = true;
+            if (c < RESULT_CODES - 1) {
+                reply_printf(r, "p2p_requests_total{command=\"%s\",code=\"%d\"} %llu\n", commands[i].name, c, n);
+            } else {
+                reply_printf(r, "p2p_requests_total{command=\"%s\",code=\"other\"} %llu\n", commands[i].name, n);
+            }
         }
-        username = strdup(buffer);
-        
-        if (readLine(client_fd, buffer, MAX_STRING) <= 0) {
-            free(command);
-            free(username);
-            close(client_fd);
-            return NULL;
+    }
+    reply_printf(r, "# TYPE p2p_request_duration_us histogram\n");
+    for (int i = 0; i < NUM_COMMANDS; i++) {
+        if (used[i]) {
+            char labels[64];
+            snprintf(labels, sizeof(labels), "command=\"%s\"", commands[i].name);
+            metrics_put_histogram(r, "p2p_request_duration_us", labels,
+                                  command_stats[i].latency, &command_stats[i].latency_us);
         }
-        param1 = strdup(buffer);
-        
-    } else if (strcmp(command, "PUBLISH") == 0) {
-        // PUBLISH necesita username, filename y description
-        if (readLine(client_fd, buffer, MAX_STRING) <= 0) {
-            free(command);
-            close(client_fd);
-            return NULL;
+    }
+    reply_printf(r, "# TYPE p2p_request_duration_estimate_us gauge\n");
+    for (int i = 0; i < NUM_COMMANDS; i++) {
+        if (used[i]) {
+            char labels[64];
+            snprintf(labels, sizeof(labels), "command=\"%s\"", commands[i].name);
+            metrics_put_quantiles(r, "p2p_request_duration_estimate_us", labels, command_stats[i].latency);
         }
-        username = strdup(buffer);
-        
-        if (readLine(client_fd, buffer, MAX_STRING) <= 0) {
-            free(command);
-            free(username);
-            close(client_fd);
-            return NULL;
+    }
+
+    // Tiempo dentro de registrar_log_rpc y estado de la cola del proxy
+    reply_printf(r, "# TYPE p2p_rpc_log_duration_us histogram\n");
+    metrics_put_histogram(r, "p2p_rpc_log_duration_us", "", rpc_stats.latency, &rpc_stats.latency_us);
+    reply_printf(r, "# TYPE p2p_rpc_log_duration_estimate_us gauge\n");
+    metrics_put_quantiles(r, "p2p_rpc_log_duration_estimate_us", "", rpc_stats.latency);
+    reply_printf(r, "# TYPE p2p_rpc_log_errors_total counter\np2p_rpc_log_errors_total %llu\n",
+                 atomic_load(&rpc_stats.errors));
+    unsigned long long rpc[7];
+    log_rpc_counters(rpc);
+    reply_printf(r, "# TYPE p2p_rpc_log_entries_total counter\n"
+                 "p2p_rpc_log_entries_total{state=\"queued\"} %llu\n"
+                 "p2p_rpc_log_entries_total{state=\"sent\"} %llu\n"
+                 "p2p_rpc_log_entries_total{state=\"dropped\"} %llu\n"
+                 "p2p_rpc_log_entries_total{state=\"spilled\"} %llu\n",
+                 rpc[0], rpc[1], rpc[4], rpc[5]);
+    reply_printf(r, "# TYPE p2p_rpc_log_queue_pending gauge\np2p_rpc_log_queue_pending %llu\n", rpc[2]);
+    reply_printf(r, "# TYPE p2p_rpc_log_queue_capacity gauge\np2p_rpc_log_queue_capacity %llu\n", rpc[3]);
+    reply_printf(r, "# TYPE p2p_rpc_log_retries_total counter\np2p_rpc_log_retries_total %llu\n", rpc[6]);
+
+    // Cerrojos del directorio
+    DirLock *locks[NUM_DIR_LOCKS] = {&users_lock, &files_lock};
+    const char *modes[2] = {"read", "write"};
+    const char *fields[5] = {"acquisitions_total", "wait_us_total", "wait_max_us", "hold_us_total", "hold_max_us"};
+    for (int f = 0; f < 5; f++) {
+        reply_printf(r, "# TYPE p2p_lock_%s %s\n", fields[f], strstr(fields[f], "max") ? "gauge" : "counter");
+        for (int i = 0; i < NUM_DIR_LOCKS; i++) {
+            for (int m = 0; m < 2; m++) {
+                LockStats *st = &locks[i]->stats[m];
+                atomic_ullong *values[5] = {&st->acquisitions, &st->wait_ns, &st->wait_max_ns,
+                                            &st->hold_ns, &st->hold_max_ns};
+                unsigned long long v = atomic_load(values[f]);
+                reply_printf(r, "p2p_lock_%s{lock=\"%s\",mode=\"%s\"} %llu\n", fields[f],
+                             locks[i]->name, modes[m], f == 0 ? v : v / 1000);
+            }
         }
-        param1 = strdup(buffer); // filename
-        
-        if (readLine(client_fd, buffer, MAX_STRING) <= 0) {
-            free(command);
-            free(username);
-            free(param1);
-            close(client_fd);
-            return NULL;
+    }
+}
+
+// Operación STATS: las métricas como una sola cadena
+void handle_stats(int client_fd) {
+    Reply text;
+    reply_init(&text);
+    metrics_write(&text);
+    reply_put(&text, "", 1);
+
+    Reply reply;
+    reply_init(&reply);
+    reply_put(&reply, text.data, text.len);
+    free(text.data);
+    reply_send(&reply, client_fd, text.failed ? 1 : 0, 1);
+}
+
+// Endpoint de métricas (-e): responde a cualquier petición HTTP con las
+// métricas en texto plano y cierra la conexión. Lo atiende un único hilo.
+int metrics_sd = -1;
+
+void *metrics_thread(void *arg) {
+    while (server_running) {
+        int fd = accept(metrics_sd, NULL, NULL);
+        if (fd < 0) {
+            if (errno == EINTR || errno == ECONNABORTED) continue;
+            break;
         }
-        param2 = strdup(buffer); // description
-        
-    } else if (strcmp(command, "CONNECT") == 0) {
-        // CONNECT necesita username y port
-        if (readLine(client_fd, buffer, MAX_STRING) <= 0) {
-            free(command);
-            close(client_fd);
-            return NULL;
+        // Leer la petición (no se interpreta); un cliente lento no bloquea el hilo más de 1 s
+        struct timeval timeout = {1, 0};
+        setsockopt(fd, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof(timeout));
+        char request[2048];
+        size_t got = 0;
+        ssize_t n;
+        while (got < sizeof(request) - 1 && (n = read(fd, request + got, sizeof(request) - 1 - got)) > 0) {
+            got += n;
+            request[got] = '\0';
+            if (strstr(request, "\r\n\r\n") != NULL || strstr(request, "\n\n") != NULL) {
+                break;
+            }
         }
-        username = strdup(buffer);
-        
-        if (readLine(client_fd, buffer, MAX_STRING) <= 0) {
-            free(command);
-            free(username);
-            close(client_fd);
-            return NULL;
+
+        Reply body;
+        reply_init(&body);
+        metrics_write(&body);
+        char header[160];
+        int len = snprintf(header, sizeof(header),
+                           "HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                           "Content-Length: %zu\r\nConnection: close\r\n\r\n", body.failed ? 0 : body.len);
+        if (send_all(fd, header, len) == 0 && !body.failed) {
+            send_all(fd, body.data, body.len);
         }
-        param1 = strdup(buffer); // port
+        free(body.data);
+        close(fd);
+    }
+    return NULL;
+}
+
+int metrics_start(int port) {
+    metrics_sd = socket(AF_INET, SOCK_STREAM, IPPROTO_TCP);
+    if (metrics_sd < 0) {
+        perror("Error en el socket de métricas");
+        return -1;
     }
+    int val = 1;
+    setsockopt(metrics_sd, SOL_SOCKET, SO_REUSEADDR, &val, sizeof(val));
+    struct sockaddr_in addr;
+    memset(&addr, 0, sizeof(addr));
+    addr.sin_family = AF_INET;
+    addr.sin_addr.s_addr = INADDR_ANY;
+    addr.sin_port = htons(port);
+    if (bind(metrics_sd, (struct sockaddr *)&addr, sizeof(addr)) < 0 || listen(metrics_sd, 16) < 0) {
+        perror("Error en el socket de métricas");
+        close(metrics_sd);
+        return -1;
+    }
+    pthread_t thread;
+    if (pthread_create(&thread, NULL, metrics_thread, NULL) != 0) {
+        close(metrics_sd);
+        return -1;
+    }
+    pthread_detach(thread);
+    return 0;
+}
+
+// Captura de la carga (-c): cada petición se añade al fichero con todos sus
+// campos para reproducirla después con reproducir_carga.py. Un registro son
+// campos terminados en '\0', como en el protocolo: instante de llegada en
+// microsegundos desde epoch, comando, fecha, número de parámetros y parámetros.
+// Los registros de PUBLISH_DIR no se guardan, solo su cabecera. Cada registro se
+// escribe con un solo write en un fichero abierto con O_APPEND, así que los de
+// hilos distintos no se mezclan.
+int capture_fd = -1;
+
+void capture_request(const Request *req) {
+    struct timespec now;
+    clock_gettime(CLOCK_REALTIME, &now);
+    char ts[24];
+    snprintf(ts, sizeof(ts), "%lld", (long long)now.tv_sec * 1000000LL + now.tv_nsec / 1000);
+
+    Reply record;
+    reply_init(&record);
+    reply_put_str(&record, ts);
+    reply_put_str(&record, req->command);
+    reply_put_str(&record, req->fecha);
+    reply_put_int(&record, req->nparams);
+    for (int i = 0; i < req->nparams; i++) {
+        reply_put_str(&record, req->params[i]);
+    }
+    if (!record.failed && write(capture_fd, record.data, record.len) != (ssize_t)record.len) {
+        fprintf(stderr, "s> ERROR al escribir la captura\n");
+    }
+    free(record.data);
+}
+
+// Registra la operación en el servidor RPC y la ejecuta. Devuelve false si la
+// conexión ha dejado de ser del llamador (SUBSCRIBE)
+bool dispatch_request(Connection *conn, Request *req) {
+    int client_fd = conn->fd;
+    const char *command = req->command;
+    char *username = req->params[0];
+    char *param1 = (req->nparams > 1) ? req->params[1] : NULL;
+    char *param2 = (req->nparams > 2) ? req->params[2] : NULL;
+    char *param3 = (req->nparams > 3) ? req->params[3] : NULL;
+    bool owned = true;
+
+    uint64_t start = now_ns();
+    atomic_fetch_add_explicit(&requests_active, 1, memory_order_relaxed);
+    request_result = -1;
+
+    // Imprimir la fecha recibida
+    printf("s> [FECHA] %s\n", req->fecha);
 
     // Registrar operación en el servidor (después de leer username)
-    if (username)
     printf("s> OPERATION %s FROM %s\n", command, username);
-    else
-    printf("s> OPERATION %s\n", command);
 
-    if (username && command && fecha[0] != '\0') {
-        if (param1 && strlen(param1) > 0) {
-            if (registrar_log_rpc(username, command, param1, fecha) != 0) {
-            fprintf(stderr, "s> ERROR al registrar operación RPC\n");
-            }
-        }
-        else{
-            if (registrar_log_rpc(username, command, NULL, fecha) != 0) {
-            fprintf(stderr, "s> ERROR al registrar operación RPC\n");
-            }
-        }    
+    uint64_t rpc_start = now_ns();
+    int rpc_result = registrar_log_rpc(username, command, param1, req->fecha);
+    timer_record(&rpc_stats, (now_ns() - rpc_start) / 1000);
+    if (rpc_result != 0) {
+        atomic_fetch_add_explicit(&rpc_stats.errors, 1, memory_order_relaxed);
+        fprintf(stderr, "s> ERROR al registrar operación RPC\n");
+    }
+    if (capture_fd >= 0) {
+        capture_request(req);
     }
-    
 
     // Procesar operación
     if (strcmp(command, "REGISTER") == 0) {
-        if (username) {
-            handle_register(client_fd, username);
-        } else {
-            printf("s> Error: Falta el nombre de usuario para REGISTER\n");
-        }
+        handle_register(client_fd, username);
     }
     else if (strcmp(command, "UNREGISTER") == 0) {
-        if (username) {
-            handle_unregister(client_fd, username);
-        } else {
-            printf("s> Error: Falta el nombre de usuario para UNREGISTER\n");
-        }
+        handle_unregister(client_fd, username);
     }
     else if (strcmp(command, "CONNECT") == 0) {
-        if (username && param1) { // Se espera el puerto como param1
-            handle_connect(client_fd, username, param1);
-        } else {
-            printf("s> Error: Faltan parámetros para CONNECT\n");
-        }
+        handle_connect(client_fd, username, param1);
     }
     else if (strcmp(command, "DISCONNECT") == 0) {
-        if (username) {
-            handle_disconnect(client_fd, username);
-        } else {
-            printf("s> Error: Falta el nombre de usuario para DISCONNECT\n");
-        }
+        handle_disconnect(client_fd, username);
     }
     else if (strcmp(command, "PUBLISH") == 0) {
-        if (username && param1 && param2) { // Se esperan nombre de archivo y descripción
-            handle_publish(client_fd, username, param1, param2);
-        } else {
-            printf("s> Error: Faltan parámetros para PUBLISH\n");
-        }
+        handle_publish(client_fd, username, param1, param2);
     }
     else if (strcmp(command, "DELETE") == 0) {
-        if (username && param1) { // Se espera el nombre del archivo como param1
-            handle_delete(client_fd, username, param1);
-        } else {
-            printf("s> Error: Faltan parámetros para DELETE\n");
-        }
+        handle_delete(client_fd, username, param1);
     }
     else if (strcmp(command, "LIST_USERS") == 0) {
-        if (username) {
-            handle_list_users(client_fd, username);
-        } else {
-            printf("s> Error: Falta el nombre de usuario para LIST_USERS\n");
-        }
+        handle_list_users(client_fd, username);
     }
     else if (strcmp(command, "LIST_CONTENT") == 0) {
-        if (username && param1) { // Se espera el usuario objetivo como param1
-            handle_list_content(client_fd, username, param1);
-        } else {
-            printf("s> Error: Faltan parámetros para LIST_CONTENT\n");
+        handle_list_content(client_fd, username, param1);
+    }
+    else if (strcmp(command, "LOOKUP_FILE") == 0) {
+        handle_lookup_file(client_fd, username, param1, param2);
+    }
+    else if (strcmp(command, "SET_HASH") == 0) {
+        handle_set_hash(client_fd, username, param1, param2);
+    }
+    else if (strcmp(command, "SEARCH") == 0) {
+        handle_search(client_fd, username, param1, param2);
+    }
+    else if (strcmp(command, "LIST_USERS_PAGE") == 0) {
+        handle_list_users_page(client_fd, username, param1, param2);
+    }
+    else if (strcmp(command, "LIST_USERS_CHANGES") == 0) {
+        handle_list_users_changes(client_fd, username, param1);
+    }
+    else if (strcmp(command, "LIST_CONTENT_PAGE") == 0) {
+        handle_list_content_page(client_fd, username, param1, param2, param3);
+    }
+    else if (strcmp(command, "LIST_CONTENT_CHANGES") == 0) {
+        handle_list_content_changes(client_fd, username, param1, param2);
+    }
+    else if (strcmp(command, "PUBLISH_DIR") == 0) {
+        handle_publish_dir(conn, username, param1);
+    }
+    else if (strcmp(command, "SUBSCRIBE") == 0) {
+        owned = handle_subscribe(client_fd, username, param1, param2) != 0;
+    }
+    else if (strcmp(command, "STATS") == 0) {
+        handle_stats(client_fd);
+    }
+
+    metrics_request_done(req->spec, request_result, (now_ns() - start) / 1000);
+    atomic_fetch_sub_explicit(&requests_active, 1, memory_order_relaxed);
+    return owned;
+}
+
+// Función principal para manejar cada cliente. Atiende peticiones hasta que el
+// cliente cierra la conexión: los clientes en modo sesión envían varias
+// operaciones (incluso seguidas, sin esperar respuesta) por la misma conexión.
+void *handle_client(void *arg) {
+    int client_fd = *(int *)arg;
+    free(arg); // Liberar memoria asignada para el descriptor del cliente
+
+    Connection conn;
+    conn_init(&conn, client_fd);
+    Request req;
+    metrics_connection_opened();
+
+    int r;
+    while ((r = read_request(&conn, &req)) > 0) {
+        if (!dispatch_request(&conn, &req)) {
+            metrics_connection_closed();
+            return NULL; // Ahora es de un suscriptor
         }
     }
-    else {
-        printf("s> Error: Comando no reconocido\n");
+    if (r < 0) {
+        atomic_fetch_add_explicit(&requests_rejected, 1, memory_order_relaxed);
     }
 
+    metrics_connection_closed();
     close(client_fd);
     return NULL;
 }
 
+// Modo epoll: un único hilo acepta conexiones y lee de todas ellas sin
+// bloquearse; cuando una conexión tiene una petición completa en su buffer, la
+// pasa a un pool fijo de workers que la ejecutan con dispatch_request. Cada
+// conexión se registra con EPOLLONESHOT, de modo que en cada momento la usa
+// solo el hilo de epoll o un único worker, y las peticiones de una misma sesión
+// se atienden en orden. Los sockets siguen siendo bloqueantes para que los
+// handlers escriban igual que en el modo con un hilo por conexión; las lecturas
+// usan MSG_DONTWAIT.
+typedef struct EpollConn {
+    Connection conn;
+    bool eof;                       // El cliente cerró su extremo
+    struct EpollConn *next;         // Siguiente en la cola de trabajo
+} EpollConn;
+
+int epoll_fd = -1;
+
+// Cola de conexiones con peticiones listas para los workers
+EpollConn *work_head = NULL;
+EpollConn *work_tail = NULL;
+pthread_mutex_t work_mutex = PTHREAD_MUTEX_INITIALIZER;
+pthread_cond_t work_cond = PTHREAD_COND_INITIALIZER;
+
+// Indica si read_request puede terminar con los bytes que ya hay en el buffer,
+// ya sea porque hay una petición completa o porque se sabe que no es válida.
+// Nunca consume datos.
+bool request_ready(const Connection *conn) {
+    size_t pos = conn->start;
+    int fields = 0;
+    int needed = 1;
+
+    while (fields < needed) {
+        size_t begin = pos;
+        while (pos < conn->end && conn->buf[pos] != '\0' && conn->buf[pos] != '\n') {
+            pos++;
+        }
+        if (pos - begin >= MAX_STRING) {
+            return true; // Campo demasiado largo: read_request lo rechaza
+        }
+        if (pos == conn->end) {
+            return false;
+        }
+        if (fields == 0) {
+            char command[MAX_STRING];
+            memcpy(command, conn->buf + begin, pos - begin);
+            command[pos - begin] = '\0';
+            const CommandSpec *spec = find_command(command);
+            if (spec == NULL) {
+                return true; // Comando no reconocido
+            }
+            needed = 2 + spec->nparams;
+        }
+        pos++;
+        fields++;
+    }
+    return true;
+}
+
+void epoll_close(EpollConn *ec) {
+    metrics_connection_closed();
+    close(ec->conn.fd); // También lo quita del conjunto de epoll
+    free(ec);
+}
+
+// Vuelve a vigilar la conexión. Después de esto el hilo actual ya no puede usarla
+void epoll_rearm(EpollConn *ec) {
+    struct epoll_event ev;
+    ev.events = EPOLLIN | EPOLLRDHUP | EPOLLONESHOT;
+    ev.data.ptr = ec;
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_MOD, ec->conn.fd, &ev) < 0) {
+        perror("Error en epoll_ctl");
+        epoll_close(ec);
+    }
+}
+
+void work_push(EpollConn *ec) {
+    pthread_mutex_lock(&work_mutex);
+    ec->next = NULL;
+    if (work_tail != NULL) {
+        work_tail->next = ec;
+    } else {
+        work_head = ec;
+    }
+    work_tail = ec;
+    pthread_cond_signal(&work_cond);
+    pthread_mutex_unlock(&work_mutex);
+}
+
+EpollConn *work_pop(void) {
+    pthread_mutex_lock(&work_mutex);
+    while (work_head == NULL) {
+        pthread_cond_wait(&work_cond, &work_mutex);
+    }
+    EpollConn *ec = work_head;
+    work_head = ec->next;
+    if (work_head == NULL) {
+        work_tail = NULL;
+    }
+    pthread_mutex_unlock(&work_mutex);
+    return ec;
+}
+
+// Worker: ejecuta todas las peticiones completas de la conexión y la devuelve a epoll
+void *epoll_worker(void *arg) {
+    Request req;
+    for (;;) {
+        EpollConn *ec = work_pop();
+        bool ok = true;
+        bool owned = true;
+
+        while (ok && owned && request_ready(&ec->conn)) {
+            int r = read_request(&ec->conn, &req);
+            if (r > 0) {
+                owned = dispatch_request(&ec->conn, &req);
+            } else {
+                if (r < 0) {
+                    atomic_fetch_add_explicit(&requests_rejected, 1, memory_order_relaxed);
+                }
+                ok = false;
+            }
+        }
+
+        if (!owned) {
+            // La conexión es ahora de un suscriptor. Con EPOLLONESHOT sigue
+            // desactivada en epoll hasta que el hilo de notificaciones la cierra
+            metrics_connection_closed();
+            free(ec);
+        } else if (!ok || ec->eof) {
+            epoll_close(ec);
+        } else {
+            epoll_rearm(ec);
+        }
+    }
+    return NULL;
+}
+
+// Lee lo que haya disponible en el socket sin bloquearse y decide qué hacer
+// con la conexión
+void epoll_readable(EpollConn *ec) {
+    Connection *conn = &ec->conn;
+
+    // Mover los bytes pendientes al principio para dejar sitio
+    if (conn->start > 0) {
+        memmove(conn->buf, conn->buf + conn->start, conn->end - conn->start);
+        conn->end -= conn->start;
+        conn->start = 0;
+    }
+
+    while (conn->end < CONN_BUFFER_SIZE) {
+        ssize_t r = recv(conn->fd, conn->buf + conn->end, CONN_BUFFER_SIZE - conn->end, MSG_DONTWAIT);
+        if (r > 0) {
+            conn->end += r;
+        } else if (r == 0) {
+            ec->eof = true;
+            break;
+        } else if (errno == EINTR) {
+            continue;
+        } else {
+            if (errno != EAGAIN && errno != EWOULDBLOCK) {
+                ec->eof = true;
+            }
+            break;
+        }
+    }
+
+    if (request_ready(conn)) {
+        work_push(ec);
+    } else if (ec->eof || conn->end == CONN_BUFFER_SIZE) {
+        // Cerrada a mitad de una petición, o petición que no cabe en el buffer
+        epoll_close(ec);
+    } else {
+        epoll_rearm(ec);
+    }
+}
+
+// Bucle principal del modo epoll
+int run_epoll_server(int workers) {
+    epoll_fd = epoll_create1(0);
+    if (epoll_fd < 0) {
+        perror("Error en epoll_create1");
+        return -1;
+    }
+
+    int flags = fcntl(sd, F_GETFL, 0);
+    fcntl(sd, F_SETFL, flags | O_NONBLOCK);
+
+    struct epoll_event ev;
+    ev.events = EPOLLIN;
+    ev.data.ptr = NULL; // El socket de escucha se distingue por ptr == NULL
+    if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, sd, &ev) < 0) {
+        perror("Error en epoll_ctl");
+        return -1;
+    }
+
+    EpollConn wake_marker; // Solo se usa su dirección para reconocer wake_fd
+    wake_fd = eventfd(0, EFD_NONBLOCK);
+    ev.data.ptr = &wake_marker;
+    if (wake_fd < 0 || epoll_ctl(epoll_fd, EPOLL_CTL_ADD, wake_fd, &ev) < 0) {
+        perror("Error en eventfd");
+        return -1;
+    }
+
+    for (int i = 0; i < workers; i++) {
+        pthread_t thread_id;
+        if (pthread_create(&thread_id, NULL, epoll_worker, NULL) != 0) {
+            perror("Error creando worker");
+            return -1;
+        }
+        pthread_detach(thread_id);
+    }
+
+    struct epoll_event events[64];
+    while (server_running) {
+        int n = epoll_wait(epoll_fd, events, 64, -1);
+        if (n < 0) {
+            if (errno == EINTR) continue;
+            perror("Error en epoll_wait");
+            break;
+        }
+
+        for (int i = 0; i < n; i++) {
+            EpollConn *ec = events[i].data.ptr;
+            if (ec == &wake_marker) {
+                continue; // SIGINT: server_running ya es false
+            }
+            if (ec != NULL) {
+                epoll_readable(ec);
+                continue;
+            }
+
+            // Aceptar todas las conexiones pendientes
+            for (;;) {
+                int client_fd = accept(sd, NULL, NULL);
+                if (client_fd < 0) {
+                    if (errno == EINTR) continue;
+                    if (errno != EAGAIN && errno != EWOULDBLOCK && server_running) {
+                        perror("Error en accept");
+                    }
+                    break;
+                }
+
+                ec = malloc(sizeof(EpollConn));
+                if (ec == NULL) {
+                    perror("Error asignando memoria para la conexión");
+                    close(client_fd);
+                    continue;
+                }
+                conn_init(&ec->conn, client_fd);
+                ec->eof = false;
+                metrics_connection_opened();
+
+                struct epoll_event cev;
+                cev.events = EPOLLIN | EPOLLRDHUP | EPOLLONESHOT;
+                cev.data.ptr = ec;
+                if (epoll_ctl(epoll_fd, EPOLL_CTL_ADD, client_fd, &cev) < 0) {
+                    perror("Error en epoll_ctl");
+                    epoll_close(ec);
+                }
+            }
+        }
+    }
+
+    close(epoll_fd);
+    return 0;
+}
+
 int main(int argc, char *argv[]) {
 
     struct sockaddr_in server_addr, client_addr;
@@ -612,17 +3845,119 @@ int main(int argc, char *argv[]) {
     // Manejar señal SIGINT para apagado ordenado
     signal(SIGINT, handle_signal);
 
+    // SIGUSR1 imprime las estadísticas de los cerrojos. Se bloquea antes de
+    // crear hilos para que solo la reciba lock_stats_thread
+    sigset_t stats_set;
+    sigemptyset(&stats_set);
+    sigaddset(&stats_set, SIGUSR1);
+    pthread_sigmask(SIG_BLOCK, &stats_set, NULL);
+    if (pthread_create(&thread_id, NULL, lock_stats_thread, NULL) == 0) {
+        pthread_detach(thread_id);
+    }
+
+    // Cada arranque tiene su época, para que un cliente no aplique los
+    // cambios de un arranque a lo que obtuvo de otro
+    struct timespec boot;
+    clock_gettime(CLOCK_REALTIME, &boot);
+    catalog_epoch = ((uint64_t)boot.tv_sec * 1000000000ULL + boot.tv_nsec) ^ ((uint64_t)getpid() << 32);
+
     // Verificar argumentos
-    if (argc != 3 || strcmp(argv[1], "-p") != 0) {
-        fprintf(stderr, "Debes de introducir: %s -p <port>\n", argv[0]);
+    port = -1;
+    bool bad_args = false;
+    bool use_epoll = false;
+    int workers = 16;
+    int backlog = SOMAXCONN;
+    int log_capacity = 0;
+    const char *log_policy = "drop";
+    const char *log_spill = NULL;
+    const char *data_path = NULL;
+    bool sync_wal = true;
+    const char *capture_path = NULL;
+    int metrics_port = -1;
+    int opt;
+    while ((opt = getopt(argc, argv, "p:u:f:m:w:b:q:l:s:d:y:c:e:")) != -1) {
+        switch (opt) {
+        case 'p':
+            port = atoi(optarg);
+            break;
+        case 'u':
+            max_users = atoi(optarg);
+            break;
+        case 'f':
+            max_files = atoi(optarg);
+            break;
+        case 'm':
+            if (strcmp(optarg, "epoll") == 0) {
+                use_epoll = true;
+            } else if (strcmp(optarg, "threads") != 0) {
+                bad_args = true;
+            }
+            break;
+        case 'w':
+            workers = atoi(optarg);
+            break;
+        case 'b':
+            backlog = atoi(optarg);
+            break;
+        case 'q':
+            log_capacity = atoi(optarg);
+            break;
+        case 'l':
+            log_policy = optarg;
+            break;
+        case 's':
+            log_spill = optarg;
+            break;
+        case 'd':
+            data_path = optarg;
+            break;
+        case 'y':
+            if (strcmp(optarg, "write") == 0) {
+                sync_wal = false;
+            } else if (strcmp(optarg, "fsync") != 0) {
+                bad_args = true;
+            }
+            break;
+        case 'c':
+            capture_path = optarg;
+            break;
+        case 'e':
+            metrics_port = atoi(optarg);
+            break;
+        default:
+            bad_args = true;
+            break;
+        }
+    }
+    if (bad_args || port == -1 || optind != argc || max_users < 0 || max_files < 0 ||
+        workers < 1 || backlog < 1 || log_capacity < 0 ||
+        log_rpc_start(log_capacity, log_policy, log_spill) < 0) {
+        fprintf(stderr, "Debes de introducir: %s -p <port> [-u <max_users>] [-f <max_files>] "
+                "[-m threads|epoll] [-w <workers>] [-b <backlog>] "
+                "[-q <log_queue>] [-l drop|block|spill] [-s <spill_file>] "
+                "[-d <data_dir>] [-y fsync|write] [-c <capture_file>] "
+                "[-e <metrics_port>]\n", argv[0]);
         exit(1);
     }
 
-    port = atoi(argv[2]);
-    if (port < 1024 || port > 65535) {
+    if (port < 1024 || port > 65535 || (metrics_port != -1 && (metrics_port < 1024 || metrics_port > 65535))) {
         fprintf(stderr, "El puerto debe de estar entre 1024 y 65535\n");
         exit(1);
     }
+    started_ns = now_ns();
+
+    // Recuperar el directorio guardado antes de atender a nadie
+    if (data_path != NULL && persist_open(data_path, sync_wal) < 0) {
+        exit(1);
+    }
+
+    if (capture_path != NULL) {
+        capture_fd = open(capture_path, O_WRONLY | O_CREAT | O_APPEND, 0644);
+        if (capture_fd < 0) {
+            perror("Error al abrir el fichero de captura");
+            exit(1);
+        }
+    }
 
     // Crear socket
     sd = socket(AF_INET, SOCK_STREAM, IPPROTO_TCP);
@@ -653,7 +3988,7 @@ int main(int argc, char *argv[]) {
     }
 
     // Escuchar conexiones
-    if (listen(sd, 10) < 0) {
+    if (listen(sd, backlog) < 0) {
         perror("Error en listen");
         close(sd);
         exit(1);
@@ -661,8 +3996,22 @@ int main(int argc, char *argv[]) {
 
     printf("s> init server %s:%d\n", inet_ntoa(server_addr.sin_addr), port);
 
-    // Bucle principal de aceptación de conexiones
-while (server_running) {
+    if (metrics_port != -1) {
+        if (metrics_start(metrics_port) < 0) {
+            close(sd);
+            exit(1);
+        }
+        printf("s> métricas en http://%s:%d/metrics\n", inet_ntoa(server_addr.sin_addr), metrics_port);
+    }
+
+    // Modo epoll: un hilo de eventos y un pool fijo de workers
+    if (use_epoll && run_epoll_server(workers) < 0) {
+        close(sd);
+        exit(1);
+    }
+
+    // Bucle principal de aceptación de conexiones (un hilo por conexión)
+while (server_running && !use_epoll) {
     client_len = sizeof(client_addr);
 
     // Asignar memoria dinámica para el descriptor del cliente
@@ -689,8 +4038,11 @@ while (server_running) {
     }
 }
 
-    // Limpieza antes de salir
+    // Limpieza antes de salir: enviar los registros pendientes
     close(sd);
+    log_rpc_stop();
+    print_lock_stats();
+    log_rpc_print_stats();
     printf("Servidor desconectado\n");
     return 0;
 }
\ No newline at end of file
@@ -1,25 +1,164 @@
 #include <stdio.h>
+#include <stdlib.h>
 #include <string.h>
+#include <stdbool.h>
+#include <pthread.h>
+#include <signal.h>
+#include <time.h>
+#include <unistd.h>
 #include "claves_rpc.h"
 
-int *log_operation_1_svc(struct log_entry *entry, struct svc_req *req) {
-    static int result;
-    FILE *fp = fopen("logs.txt", "a");
-    
-    if (fp == NULL) {
-        result = -1;
-        return &result;
+// Registro estructurado (log_estructurado.c)
+int seglog_open(void);
+int seglog_append(const struct log_entry *entry);
+void seglog_flush(bool sync);
+
+// logs.txt se abre una sola vez y las entradas se acumulan en el buffer de
+// stdio. Se vuelcan al fichero todas juntas (group commit) cuando hay
+// LOG_FLUSH_BYTES bytes pendientes o cuando la entrada más antigua sin volcar
+// tiene LOG_FLUSH_MS milisegundos. Con LOG_FSYNC=1 cada volcado termina con
+// fdatasync. Los tres valores se leen de variables de entorno con ese nombre.
+// Las entradas que aún no se han volcado se pierden si el proceso muere de
+// golpe; con SIGINT o SIGTERM se vuelcan antes de salir. Cada entrada se
+// escribe también en el registro estructurado, que se vuelca a la vez.
+
+#define DEFAULT_FLUSH_BYTES (64 * 1024)
+#define DEFAULT_FLUSH_MS 200
+
+static FILE *log_fp = NULL;
+static size_t flush_bytes = DEFAULT_FLUSH_BYTES;
+static long flush_ms = DEFAULT_FLUSH_MS;
+static bool use_fsync = false;
+
+static size_t pending_bytes = 0;        // Escritos en el buffer y sin volcar
+static struct timespec pending_since;   // Momento de la entrada más antigua sin volcar
+static pthread_mutex_t log_mutex = PTHREAD_MUTEX_INITIALIZER;
+static pthread_once_t log_once = PTHREAD_ONCE_INIT;
+
+static long elapsed_ms(const struct timespec *since) {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (now.tv_sec - since->tv_sec) * 1000 + (now.tv_nsec - since->tv_nsec) / 1000000;
+}
+
+// Vuelca lo pendiente. Se llama con log_mutex tomado
+static void log_commit(void) {
+    if (pending_bytes == 0) {
+        return;
+    }
+    fflush(log_fp);
+    if (use_fsync) {
+        fdatasync(fileno(log_fp));
+    }
+    seglog_flush(use_fsync);
+    pending_bytes = 0;
+}
+
+// Hilo que vuelca por tiempo y, al recibir SIGINT o SIGTERM, vuelca y termina
+static void *flusher_thread(void *arg) {
+    sigset_t *signals = arg;
+    long interval = (flush_ms > 1) ? flush_ms / 2 : 1;
+    struct timespec timeout = { interval / 1000, (interval % 1000) * 1000000L };
+
+    for (;;) {
+        int sig = sigtimedwait(signals, NULL, &timeout);
+
+        pthread_mutex_lock(&log_mutex);
+        if (sig > 0 || (pending_bytes > 0 && elapsed_ms(&pending_since) >= flush_ms)) {
+            log_commit();
+        }
+        pthread_mutex_unlock(&log_mutex);
+
+        if (sig > 0) {
+            exit(0);
+        }
     }
+    return NULL;
+}
 
+static void log_init(void) {
+    const char *value;
+    if ((value = getenv("LOG_FLUSH_BYTES")) != NULL) {
+        flush_bytes = strtoul(value, NULL, 10);
+    }
+    if ((value = getenv("LOG_FLUSH_MS")) != NULL) {
+        flush_ms = strtol(value, NULL, 10);
+    }
+    if ((value = getenv("LOG_FSYNC")) != NULL) {
+        use_fsync = strcmp(value, "1") == 0;
+    }
+
+    log_fp = fopen("logs.txt", "a");
+    if (log_fp == NULL) {
+        return;
+    }
+    setvbuf(log_fp, NULL, _IOFBF, flush_bytes > BUFSIZ ? flush_bytes * 2 : BUFSIZ);
+    seglog_open();
+
+    // Las señales de parada se atienden en el hilo de volcado: se bloquean
+    // aquí (hilo de svc_run) antes de crearlo para que lo herede
+    static sigset_t signals;
+    sigemptyset(&signals);
+    sigaddset(&signals, SIGINT);
+    sigaddset(&signals, SIGTERM);
+    pthread_sigmask(SIG_BLOCK, &signals, NULL);
+
+    pthread_t thread;
+    if (pthread_create(&thread, NULL, flusher_thread, &signals) == 0) {
+        pthread_detach(thread);
+    }
+}
+
+// Escribe una entrada en el buffer. Se llama con log_mutex tomado
+static int log_write(const struct log_entry *entry) {
+    int n;
     // Imprimir según la operación
     if (strcmp(entry->operacion, "PUBLISH") == 0 || strcmp(entry->operacion, "DELETE") == 0) {
-        fprintf(fp, "[%s] %s -> %s %s\n", entry->fecha, entry->usuario, entry->operacion, entry->param1);
+        n = fprintf(log_fp, "[%s] %s -> %s %s\n", entry->fecha, entry->usuario, entry->operacion, entry->param1);
     } else {
-        fprintf(fp, "[%s] %s -> %s\n", entry->fecha, entry->usuario, entry->operacion);
+        n = fprintf(log_fp, "[%s] %s -> %s\n", entry->fecha, entry->usuario, entry->operacion);
+    }
+    if (n < 0) {
+        return -1;
+    }
+
+    if (pending_bytes == 0) {
+        clock_gettime(CLOCK_MONOTONIC, &pending_since);
+    }
+    pending_bytes += n;
+    return seglog_append(entry);
+}
+
+// Escribe count entradas y hace group commit si se ha pasado algún umbral
+static int log_entries(const struct log_entry *entries, unsigned int count) {
+    pthread_once(&log_once, log_init);
+    if (log_fp == NULL) {
+        return -1;
     }
 
-    fflush(fp);
-    fclose(fp);
-    result = 0;
+    int result = 0;
+    pthread_mutex_lock(&log_mutex);
+    for (unsigned int i = 0; i < count; i++) {
+        if (log_write(&entries[i]) < 0) {
+            result = -1;
+        }
+    }
+    if (pending_bytes >= flush_bytes || elapsed_ms(&pending_since) >= flush_ms) {
+        log_commit();
+    }
+    pthread_mutex_unlock(&log_mutex);
+    return result;
+}
+
+int *log_operation_1_svc(struct log_entry *entry, struct svc_req *req) {
+    static int result;
+    result = log_entries(entry, 1);
+    return &result;
+}
+
+// Versión 2: un lote de entradas por llamada
+int *log_operations_2_svc(log_batch *batch, struct svc_req *req) {
+    static int result;
+    result = log_entries(batch->log_batch_val, batch->log_batch_len);
     return &result;
 }
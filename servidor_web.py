@@ -1,5 +1,6 @@
 from flask import Flask
 from datetime import datetime
+from werkzeug.serving import WSGIRequestHandler
 
 app = Flask(__name__)
 
@@ -8,5 +9,13 @@ def obtener_fecha():
     now = datetime.now()
     return now.strftime("%d/%m/%Y %H:%M:%S")
 
+# Hora actual en segundos desde epoch con precisión de microsegundos. Los
+# clientes la usan para sincronizar su reloj y generar las fechas localmente.
+@app.route("/sync")
+def sincronizar():
+    return "%.6f" % datetime.now().timestamp()
+
 if __name__ == "__main__":
+    # HTTP/1.1 para que los clientes puedan reutilizar la conexión
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run(host="0.0.0.0", port=8000)
@@ -0,0 +1,144 @@
+"""Pruebas de la descarga por rangos de client.py contra un cliente remoto simulado
+que sirve GET_RANGE y puede corromper bloques.
+
+Uso: python3 -m unittest discover -s tests
+"""
+import hashlib
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from client import client
+
+CHUNK = 1024
+
+
+class FakeSeeder:
+    """Servidor P2P mínimo: responde GET_RANGE con data y corrompe el bloque
+    corrupt_index las primeras corrupt_times veces que se pide"""
+
+    def __init__(self, data, corrupt_index, corrupt_times):
+        self.data = data
+        self.corrupt_index = corrupt_index
+        self.corrupt_times = corrupt_times
+        self.requests = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.endpoint = self.sock.getsockname()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        r = client.SocketReader(conn)
+        with conn:
+            while r.read_string() == "GET_RANGE":
+                r.read_string()
+                offset, length = int(r.read_string()), int(r.read_string())
+                index = offset // CHUNK
+                self.requests.append(index)
+                chunk = self.data[offset:offset + length]
+                if index == self.corrupt_index and self.requests.count(index) <= self.corrupt_times:
+                    chunk = bytes([chunk[0] ^ 0xFF]) + chunk[1:]
+                conn.sendall(bytes([0]) + client._encode_fields([str(len(chunk))]) + chunk)
+
+    def close(self):
+        self.sock.close()
+
+
+class RangeDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (client._chunk_size, client._download_connections)
+        client._chunk_size = CHUNK
+        client._download_connections = 1
+        self.data = os.urandom(CHUNK * 4 + 100)
+        self.leaves = [hashlib.sha256(self.data[i:i + CHUNK]).hexdigest()
+                       for i in range(0, len(self.data), CHUNK)]
+        self.tmp = tempfile.TemporaryDirectory()
+        self.local = os.path.join(self.tmp.name, "descarga")
+
+    def tearDown(self):
+        client._chunk_size, client._download_connections = self.saved
+        self.tmp.cleanup()
+
+    def download(self, seeder):
+        identity = {"owner": "ana", "remote": "f", "size": len(self.data), "mtime": "0",
+                    "chunk_size": CHUNK, "root": client.merkle_root(self.leaves)}
+        return client._download_ranges([(seeder.endpoint, "f")], self.local, len(self.data),
+                                       identity, self.leaves)
+
+    def test_corrupt_chunk_is_refetched_from_single_seeder(self):
+        seeder = FakeSeeder(self.data, corrupt_index=2, corrupt_times=1)
+        try:
+            self.assertTrue(self.download(seeder))
+        finally:
+            seeder.close()
+        with open(self.local, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        # Solo se repite el bloque corrupto
+        self.assertEqual(seeder.requests.count(2), 2)
+        self.assertEqual(len(seeder.requests), len(self.leaves) + 1)
+
+    def test_seeder_dropped_after_repeated_corruption(self):
+        seeder = FakeSeeder(self.data, corrupt_index=1, corrupt_times=client.CHUNK_RETRIES)
+        try:
+            self.assertFalse(self.download(seeder))
+        finally:
+            seeder.close()
+        self.assertEqual(seeder.requests.count(1), client.CHUNK_RETRIES)
+        self.assertFalse(os.path.exists(self.local))
+
+
+class ServePeerRangeTest(unittest.TestCase):
+    """GET_RANGE del servidor P2P del cliente, por una sola conexión"""
+
+    def setUp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        client._listen_port = sock.getsockname()[1]
+        sock.close()
+        client._running = True
+        client._listen_thread = threading.Thread(target=client._listen_thread_function)
+        client._listen_thread.start()
+        self.tmp = tempfile.NamedTemporaryFile(delete=False)
+        self.tmp.write(b"abcdef")
+        self.tmp.close()
+        client._share("f", self.tmp.name)
+
+    def tearDown(self):
+        client._stop_listen_thread()
+        client._published.pop("f", None)
+        client._published_paths.pop(self.tmp.name, None)
+        os.remove(self.tmp.name)
+
+    def test_empty_ranges_keep_the_connection_in_sync(self):
+        for _ in range(50):
+            try:
+                s = socket.create_connection(('127.0.0.1', client._listen_port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.01)
+        with s:
+            r = client.SocketReader(s)
+            for offset, length, expected in [(2, 0, b""), (6, 4, b""), (1, 3, b"bcd")]:
+                s.sendall(client._encode_fields(["GET_RANGE", "f", str(offset), str(length)]))
+                self.assertEqual(r.read_byte(), 0)
+                n = int(r.read_string())
+                self.assertEqual(r.recv(n) if n else b"", expected)
+
+
+if __name__ == "__main__":
+    unittest.main()